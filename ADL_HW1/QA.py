@@ -23,12 +23,314 @@ import csv
 from typing import Optional, Tuple
 
 import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
 from tqdm.auto import tqdm
 
 
 logger = logging.getLogger(__name__)
 
 
+def _top_k_indices(logits: np.ndarray, k: int) -> np.ndarray:
+    """
+    Returns the indices of the `k` greatest logits of every row, best first, using `argpartition` instead of a full
+    sort. Ties are broken towards the greatest index, like the reversed `np.argsort` the loop version relied on.
+    """
+    if k < logits.shape[1]:
+        indices = np.argpartition(logits, logits.shape[1] - k, axis=1)[:, -k:]
+    else:
+        indices = np.broadcast_to(np.arange(logits.shape[1]), logits.shape)
+    values = np.take_along_axis(logits, indices, axis=1)
+    order = np.lexsort((-indices, -values), axis=1)
+    return np.take_along_axis(indices, order, axis=1)
+
+
+# Columns of the validation features that are only used by the post-processing, not by the model.
+MAX_CONTEXT_COLUMNS = ["max_context_start", "max_context_end"]
+POSTPROCESS_COLUMNS = ["example_id", "offset_mapping"] + MAX_CONTEXT_COLUMNS
+
+
+def remove_postprocess_columns(features):
+    """The features without the columns the model does not take."""
+    return features.remove_columns([column for column in POSTPROCESS_COLUMNS if column in features.column_names])
+
+
+class OffsetMappings:
+    """
+    The `offset_mapping` column of the validation features, read without copying it out of Arrow. Every feature
+    stores its `(num_tokens, 2)` int32 character offsets flattened (`[start_0, end_0, start_1, ...]`), with -1 for the
+    tokens that are not part of the context; `offset_mappings[i]` is a `(num_tokens, 2)` view of feature `i`.
+
+    Args:
+        features: The processed dataset (see `prepare_validation_features`).
+    """
+
+    def __init__(self, features):
+        column = features.with_format("arrow")["offset_mapping"]
+        chunks = column.chunks if isinstance(column, pa.ChunkedArray) else [column]
+        self._values = []
+        self._row_offsets = []
+        for chunk in chunks:
+            # The row offsets of a sliced chunk point into its full child array.
+            self._values.append(chunk.values.to_numpy(zero_copy_only=True).reshape(-1, 2))
+            self._row_offsets.append(chunk.offsets.to_numpy() // 2)
+        self._chunk_starts = np.cumsum([0] + [len(chunk) for chunk in chunks])
+
+    def __len__(self):
+        return int(self._chunk_starts[-1])
+
+    def __getitem__(self, index):
+        chunk = np.searchsorted(self._chunk_starts, index, side="right") - 1
+        row_offsets = self._row_offsets[chunk]
+        row = index - self._chunk_starts[chunk]
+        return self._values[chunk][row_offsets[row] : row_offsets[row + 1]]
+
+    def context_mask(self, max_len: int, start: int = 0, stop: Optional[int] = None) -> np.ndarray:
+        """The `(stop - start, max_len)` boolean mask of the context tokens of the features `start` to `stop`."""
+        stop = len(self) if stop is None else stop
+        mask = np.zeros((stop - start, max_len), dtype=bool)
+        positions = np.arange(max_len)
+        for chunk, (chunk_start, chunk_stop) in enumerate(zip(self._chunk_starts[:-1], self._chunk_starts[1:])):
+            first, last = max(start, chunk_start), min(stop, chunk_stop)
+            if first >= last:
+                continue
+            row_offsets = self._row_offsets[chunk][first - chunk_start : last - chunk_start + 1]
+            in_row = positions < np.diff(row_offsets)[:, None]
+            token_indices = np.where(in_row, row_offsets[:-1, None] + positions, 0)
+            mask[first - start : last - start] = in_row & (self._values[chunk][token_indices, 0] >= 0)
+        return mask
+
+
+class ExampleFeatureIndex:
+    """
+    Maps every example to its features, built from the `example_id` column of the features alone (read as Arrow, so
+    the other columns, `input_ids` included, are never decoded). The features of example `i` are
+    `feature_order[feature_starts[i] : feature_starts[i + 1]]`, a contiguous range of features when they are grouped
+    by example in the order of the examples (`contiguous`), which is what the feature creation with `Dataset.map`
+    produces.
+
+    Args:
+        examples: The non-preprocessed dataset (see the main script for more information).
+        features: The processed dataset (see the main script for more information).
+    """
+
+    def __init__(self, examples, features):
+        example_ids = examples.with_format("arrow")["id"]
+        feature_ids = features.with_format("arrow")["example_id"]
+        if isinstance(example_ids, pa.ChunkedArray):
+            example_ids = example_ids.combine_chunks()
+        feature_example_indices = pc.index_in(feature_ids, value_set=example_ids)
+        if feature_example_indices.null_count > 0:
+            raise ValueError("Some features have an `example_id` that is not the id of any example.")
+        feature_example_indices = feature_example_indices.to_numpy().astype(np.int64)
+
+        self.num_features_per_example = np.bincount(feature_example_indices, minlength=len(examples))
+        self.feature_starts = np.concatenate([[0], np.cumsum(self.num_features_per_example)])
+        self.contiguous = not np.any(np.diff(feature_example_indices) < 0)
+        if self.contiguous:
+            self.feature_order = np.arange(len(feature_example_indices))
+        else:
+            self.feature_order = np.argsort(feature_example_indices, kind="stable")
+
+    def __len__(self):
+        return len(self.num_features_per_example)
+
+    def __getitem__(self, example_index):
+        return self.feature_order[self.feature_starts[example_index] : self.feature_starts[example_index + 1]]
+
+
+def _flatten_offset_mappings(tokenized_examples):
+    """Stores the `(num_tokens, 2)` offset arrays of the features flattened, the layout `OffsetMappings` reads."""
+    tokenized_examples["offset_mapping"] = [offsets.reshape(-1) for offsets in tokenized_examples["offset_mapping"]]
+    return tokenized_examples
+
+
+def _span_validity_masks(context_mask: np.ndarray, max_context_ranges) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Builds the `(num_features, max_len)` boolean masks of the token positions that may start and end an answer from
+    the mask of the context tokens (see `OffsetMappings.context_mask`): the start must also be in the
+    `[max_context_start, max_context_end)` range of the feature if `max_context_ranges` is provided.
+    """
+    end_mask = context_mask
+    start_mask = end_mask.copy()
+    max_len = context_mask.shape[1]
+    if max_context_ranges is not None:
+        starts, ends = (np.asarray(column, dtype=np.int64)[:, None] for column in max_context_ranges)
+        positions = np.arange(max_len)
+        start_mask &= (positions >= starts) & (positions < ends)
+    return start_mask, end_mask
+
+
+def batched_span_search(
+    all_start_logits: np.ndarray,
+    all_end_logits: np.ndarray,
+    start_mask: np.ndarray,
+    end_mask: np.ndarray,
+    n_best_size: int = 20,
+    max_answer_length: int = 30,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Scores the candidate answer spans of a batch of features at once.
+
+    For every feature, the `n_best_size` greatest start and end logits are paired and each pair gets the score
+    `start_logit + end_logit`, or `-inf` when the span is not a valid answer (a position outside of the context, an end
+    before the start or a span longer than `max_answer_length`).
+
+    Args:
+        all_start_logits (:obj:`np.ndarray`):
+            The start logits, of shape `(num_features, max_len)`.
+        all_end_logits (:obj:`np.ndarray`):
+            The end logits, of shape `(num_features, max_len)`.
+        start_mask (:obj:`np.ndarray`):
+            Boolean mask of shape `(num_features, max_len)` of the positions that can start an answer.
+        end_mask (:obj:`np.ndarray`):
+            Boolean mask of shape `(num_features, max_len)` of the positions that can end an answer.
+        n_best_size (:obj:`int`, `optional`, defaults to 20):
+            The number of start and end positions to consider for each feature.
+        max_answer_length (:obj:`int`, `optional`, defaults to 30):
+            The maximum length of an answer, in tokens.
+
+    Returns:
+        A tuple `(start_indexes, end_indexes, scores)`: the candidate start and end positions of shape
+        `(num_features, k)`, best first, and the span scores of shape `(num_features, k, k)` where `k` is `n_best_size`
+        capped to `max_len`.
+    """
+    k = min(n_best_size, all_start_logits.shape[1])
+    start_indexes = _top_k_indices(all_start_logits, k)
+    end_indexes = _top_k_indices(all_end_logits, k)
+
+    start_valid = np.take_along_axis(start_mask, start_indexes, axis=1)
+    end_valid = np.take_along_axis(end_mask, end_indexes, axis=1)
+    lengths = end_indexes[:, None, :] - start_indexes[:, :, None] + 1
+    valid = (
+        start_valid[:, :, None] & end_valid[:, None, :] & (lengths >= 1) & (lengths <= max_answer_length)
+    )
+
+    # The scores are summed in float64 whatever the dtype of the logits, so float32 logits rank the spans exactly like
+    # their float64 copies.
+    scores = (
+        np.take_along_axis(all_start_logits, start_indexes, axis=1).astype(np.float64)[:, :, None]
+        + np.take_along_axis(all_end_logits, end_indexes, axis=1)[:, None, :]
+    )
+    return start_indexes, end_indexes, np.where(valid, scores, -np.inf)
+
+
+def _postprocess_example(
+    context: str,
+    start_logits: np.ndarray,
+    end_logits: np.ndarray,
+    offset_mappings,
+    start_indexes: np.ndarray,
+    end_indexes: np.ndarray,
+    span_scores: np.ndarray,
+    version_2_with_negative: bool = False,
+    n_best_size: int = 20,
+    null_score_diff_threshold: float = 0.0,
+):
+    """
+    Picks the answer of one example from its context paragraph and the logits and the `batched_span_search` results
+    of its features.
+
+    Returns a tuple `(prediction, nbest, score_diff)`: the answer text, the JSON-serializable n-best predictions and,
+    if :obj:`version_2_with_negative=True`, the difference between the null and the best answer scores (else `None`).
+    """
+    min_null_prediction = None
+    prelim_predictions = []
+    k = start_indexes.shape[1] if len(start_indexes) > 0 else 0
+
+    if len(start_logits) > 0:
+        # Minimum null prediction over the features (the first one wins in case of ties).
+        feature_null_scores = start_logits[:, 0].astype(np.float64) + end_logits[:, 0]
+        null_index = np.argmin(feature_null_scores)
+        min_null_prediction = {
+            "offsets": (0, 0),
+            "score": feature_null_scores[null_index],
+            "start_logit": start_logits[null_index, 0],
+            "end_logit": end_logits[null_index, 0],
+        }
+
+        # The candidates are enumerated feature by feature, best start first then best end first, so a stable
+        # sort keeps the same order as the original nested loops for equal scores.
+        candidate_scores = span_scores.reshape(-1)
+        num_valid = int(np.isfinite(candidate_scores).sum())
+        best = np.argsort(-candidate_scores, kind="stable")[: min(n_best_size, num_valid)]
+        for flat_index in best.tolist():
+            feature_index, rest = divmod(flat_index, k * k)
+            start_rank, end_rank = divmod(rest, k)
+            start_index = start_indexes[feature_index, start_rank]
+            end_index = end_indexes[feature_index, end_rank]
+            offset_mapping = offset_mappings[feature_index]
+            prelim_predictions.append(
+                {
+                    "offsets": (offset_mapping[start_index][0], offset_mapping[end_index][1]),
+                    "score": candidate_scores[flat_index],
+                    "start_logit": start_logits[feature_index, start_index],
+                    "end_logit": end_logits[feature_index, end_index],
+                }
+            )
+
+    if version_2_with_negative and min_null_prediction is not None:
+        # Add the minimum null prediction
+        prelim_predictions.append(min_null_prediction)
+        null_score = min_null_prediction["score"]
+
+    # Only keep the best `n_best_size` predictions.
+    predictions = sorted(prelim_predictions, key=lambda x: x["score"], reverse=True)[:n_best_size]
+
+    # Add back the minimum null prediction if it was removed because of its low score.
+    if (
+        version_2_with_negative
+        and min_null_prediction is not None
+        and not any(p["offsets"] == (0, 0) for p in predictions)
+    ):
+        predictions.append(min_null_prediction)
+
+    # Use the offsets to gather the answer text in the original context.
+    for pred in predictions:
+        offsets = pred.pop("offsets")
+        pred["text"] = context[offsets[0] : offsets[1]]
+
+    # In the very rare edge case we have not a single non-null prediction, we create a fake prediction to avoid
+    # failure.
+    if len(predictions) == 0 or (len(predictions) == 1 and predictions[0]["text"] == ""):
+        predictions.insert(0, {"text": "empty", "start_logit": 0.0, "end_logit": 0.0, "score": 0.0})
+
+    # Compute the softmax of all scores (we do it with numpy to stay independent from torch/tf in this file, using
+    # the LogSumExp trick).
+    scores = np.array([pred.pop("score") for pred in predictions])
+    exp_scores = np.exp(scores - np.max(scores))
+    probs = exp_scores / exp_scores.sum()
+
+    # Include the probabilities in our predictions.
+    for prob, pred in zip(probs, predictions):
+        pred["probability"] = prob
+
+    # Pick the best prediction. If the null answer is not possible, this is easy.
+    score_diff = None
+    if not version_2_with_negative:
+        prediction = predictions[0]["text"]
+    else:
+        # Otherwise we first need to find the best non-empty prediction.
+        i = 0
+        while predictions[i]["text"] == "":
+            i += 1
+        best_non_null_pred = predictions[i]
+
+        # Then we compare to the null prediction using the threshold.
+        score_diff = float(null_score - best_non_null_pred["start_logit"] - best_non_null_pred["end_logit"])
+        if score_diff > null_score_diff_threshold:
+            prediction = ""
+        else:
+            prediction = best_non_null_pred["text"]
+
+    # Make `predictions` JSON-serializable by casting np.float back to float.
+    nbest = [
+        {k: (float(v) if isinstance(v, (np.float16, np.float32, np.float64)) else v) for k, v in pred.items()}
+        for pred in predictions
+    ]
+    return prediction, nbest, score_diff
+
+
 def postprocess_qa_predictions(
     examples,
     features,
@@ -75,9 +377,6 @@ def postprocess_qa_predictions(
         log_level (:obj:`int`, `optional`, defaults to ``logging.WARNING``):
             ``logging`` log level (e.g., ``logging.WARNING``)
     """
-    # print("preprocess_qa_examplea")
-    # print(examples)
-    # print('###')
     if len(predictions) != 2:
         raise ValueError("`predictions` should be a tuple with two elements (start_logits, end_logits).")
     all_start_logits, all_end_logits = predictions
@@ -85,11 +384,10 @@ def postprocess_qa_predictions(
     if len(predictions[0]) != len(features):
         raise ValueError(f"Got {len(predictions[0])} predictions and {len(features)} features.")
 
-    # Build a map example to its corresponding features.
-    example_id_to_index = {k: i for i, k in enumerate(examples["id"])}
-    features_per_example = collections.defaultdict(list)
-    for i, feature in enumerate(features):
-        features_per_example[example_id_to_index[feature["example_id"]]].append(i)
+    # Build a map example to its corresponding features, and read the example columns we need once.
+    features_per_example = ExampleFeatureIndex(examples, features)
+    example_ids = examples["id"]
+    relevant_ids = examples["relevant"]
 
     # The dictionaries we have to fill.
     all_predictions = collections.OrderedDict()
@@ -101,182 +399,178 @@ def postprocess_qa_predictions(
     logger.setLevel(log_level)
     logger.info(f"Post-processing {len(examples)} example predictions split into {len(features)} features.")
 
+    # Score the `n_best_size` x `n_best_size` candidate spans of every feature in one batched pass.
+    offset_mappings = OffsetMappings(features)
+    max_context_ranges = None
+    if "max_context_start" in features.column_names:
+        max_context_ranges = (features["max_context_start"], features["max_context_end"])
+    start_mask, end_mask = _span_validity_masks(
+        offset_mappings.context_mask(all_start_logits.shape[1]), max_context_ranges
+    )
+    start_indexes, end_indexes, span_scores = batched_span_search(
+        all_start_logits, all_end_logits, start_mask, end_mask, n_best_size, max_answer_length
+    )
+
     # Let's loop over all the examples!
-    for example_index, example in enumerate(tqdm(examples)):
+    for example_index, example_id in enumerate(tqdm(example_ids)):
         # Those are the indices of the features associated to the current example.
         feature_indices = features_per_example[example_index]
 
-        min_null_prediction = None
-        prelim_predictions = []
-
-        # Looping through all the features associated to the current example.
-        for feature_index in feature_indices:
-            # We grab the predictions of the model for this feature.
-            start_logits = all_start_logits[feature_index]
-            end_logits = all_end_logits[feature_index]
-            # This is what will allow us to map some the positions in our logits to span of texts in the original
-            # context.
-            offset_mapping = features[feature_index]["offset_mapping"]
-            # Optional `token_is_max_context`, if provided we will remove answers that do not have the maximum context
-            # available in the current feature.
-            token_is_max_context = features[feature_index].get("token_is_max_context", None)
-
-            # Update minimum null prediction.
-            feature_null_score = start_logits[0] + end_logits[0]
-            if min_null_prediction is None or min_null_prediction["score"] > feature_null_score:
-                min_null_prediction = {
-                    "offsets": (0, 0),
-                    "score": feature_null_score,
-                    "start_logit": start_logits[0],
-                    "end_logit": end_logits[0],
-                }
-
-            # Go through all possibilities for the `n_best_size` greater start and end logits.
-            start_indexes = np.argsort(start_logits)[-1 : -n_best_size - 1 : -1].tolist()
-            end_indexes = np.argsort(end_logits)[-1 : -n_best_size - 1 : -1].tolist()
-            for start_index in start_indexes:
-                for end_index in end_indexes:
-                    # Don't consider out-of-scope answers, either because the indices are out of bounds or correspond
-                    # to part of the input_ids that are not in the context.
-                    if (
-                        start_index >= len(offset_mapping)
-                        or end_index >= len(offset_mapping)
-                        or offset_mapping[start_index] is None
-                        or len(offset_mapping[start_index]) < 2
-                        or offset_mapping[end_index] is None
-                        or len(offset_mapping[end_index]) < 2
-                    ):
-                        continue
-                    # Don't consider answers with a length that is either < 0 or > max_answer_length.
-                    if end_index < start_index or end_index - start_index + 1 > max_answer_length:
-                        continue
-                    # Don't consider answer that don't have the maximum context available (if such information is
-                    # provided).
-                    if token_is_max_context is not None and not token_is_max_context.get(str(start_index), False):
-                        continue
-
-                    prelim_predictions.append(
-                        {
-                            "offsets": (offset_mapping[start_index][0], offset_mapping[end_index][1]),
-                            "score": start_logits[start_index] + end_logits[end_index],
-                            "start_logit": start_logits[start_index],
-                            "end_logit": end_logits[end_index],
-                        }
-                    )
-        if version_2_with_negative and min_null_prediction is not None:
-            # Add the minimum null prediction
-            prelim_predictions.append(min_null_prediction)
-            null_score = min_null_prediction["score"]
-
-        # Only keep the best `n_best_size` predictions.
-        predictions = sorted(prelim_predictions, key=lambda x: x["score"], reverse=True)[:n_best_size]
-
-        # Add back the minimum null prediction if it was removed because of its low score.
-        if (
-            version_2_with_negative
-            and min_null_prediction is not None
-            and not any(p["offsets"] == (0, 0) for p in predictions)
-        ):
-            predictions.append(min_null_prediction)
-
-        # Use the offsets to gather the answer text in the original context.
-        # print(context_list)
-        context = context_list[example["relevant"]]
-        # print(context)
-
-        for pred in predictions:
-
-            offsets = pred.pop("offsets")
-            # print("--offsets")
-            # print(offsets)
-            # print("--offsets")
-            pred["text"] = context[offsets[0] : offsets[1]]
-
-        # In the very rare edge case we have not a single non-null prediction, we create a fake prediction to avoid
-        # failure.
-        if len(predictions) == 0 or (len(predictions) == 1 and predictions[0]["text"] == ""):
-            predictions.insert(0, {"text": "empty", "start_logit": 0.0, "end_logit": 0.0, "score": 0.0})
-            # print("preprocess_qa")
-            # print(predictions)
-
-        # Compute the softmax of all scores (we do it with numpy to stay independent from torch/tf in this file, using
-        # the LogSumExp trick).
-        scores = np.array([pred.pop("score") for pred in predictions])
-        exp_scores = np.exp(scores - np.max(scores))
-        probs = exp_scores / exp_scores.sum()
-
-        # Include the probabilities in our predictions.
-        for prob, pred in zip(probs, predictions):
-            pred["probability"] = prob
-
-        # print(predictions[0])
-
-        # Pick the best prediction. If the null answer is not possible, this is easy.
-        if not version_2_with_negative:
-            # print(predictions[0]["text"])
-            all_predictions[example["id"]] = predictions[0]["text"]
-        else:
-            # Otherwise we first need to find the best non-empty prediction.
-            i = 0
-            while predictions[i]["text"] == "":
-                i += 1
-            best_non_null_pred = predictions[i]
-
-            # Then we compare to the null prediction using the threshold.
-            score_diff = null_score - best_non_null_pred["start_logit"] - best_non_null_pred["end_logit"]
-            scores_diff_json[example["id"]] = float(score_diff)  # To be JSON-serializable.
-            if score_diff > null_score_diff_threshold:
-                all_predictions[example["id"]] = ""
-                # print("******")
-            else:
-                all_predictions[example["id"]] = best_non_null_pred["text"]
-
-        # Make `predictions` JSON-serializable by casting np.float back to float.
-        all_nbest_json[example["id"]] = [
-            {k: (float(v) if isinstance(v, (np.float16, np.float32, np.float64)) else v) for k, v in pred.items()}
-            for pred in predictions
-        ]
+        prediction, nbest, score_diff = _postprocess_example(
+            context_list[relevant_ids[example_index]],
+            all_start_logits[feature_indices],
+            all_end_logits[feature_indices],
+            [offset_mappings[i] for i in feature_indices],
+            start_indexes[feature_indices],
+            end_indexes[feature_indices],
+            span_scores[feature_indices],
+            version_2_with_negative=version_2_with_negative,
+            n_best_size=n_best_size,
+            null_score_diff_threshold=null_score_diff_threshold,
+        )
+        all_predictions[example_id] = prediction
+        all_nbest_json[example_id] = nbest
+        if version_2_with_negative:
+            scores_diff_json[example_id] = score_diff
 
-    # for (all_prediction)
-
-    # If we have an output_dir, let's save all those dicts.
-    # if output_dir is not None:
-    #     print(all_predictions)
-    #     with open(output_dir, 'w', newline='', encoding='utf-8') as csv_file:
-    #         fieldnames = ['id', 'answer']
-    #         writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
-    #         writer.writeheader()
-    #         writer.writerows(json.dumps(all_predictions, indent=4))
-        # if not os.path.isdir(output_dir):
-        #     raise EnvironmentError(f"{output_dir} is not a directory.")
-        
-
-
-        # prediction_file = os.path.join(
-        #     output_dir, "predictions.json" if prefix is None else f"{prefix}_predictions.json"
-        # )
-        # nbest_file = os.path.join(
-        #     output_dir, "nbest_predictions.json" if prefix is None else f"{prefix}_nbest_predictions.json"
-        # )
-        # if version_2_with_negative:
-        #     null_odds_file = os.path.join(
-        #         output_dir, "null_odds.json" if prefix is None else f"{prefix}_null_odds.json"
-        #     )
-
-        # logger.info(f"Saving predictions to {prediction_file}.")
-        # with open(prediction_file, "w") as writer:
-        #     writer.write(json.dumps(all_predictions, indent=4) + "\n")
-        # logger.info(f"Saving nbest_preds to {nbest_file}.")
-        # with open(nbest_file, "w") as writer:
-        #     writer.write(json.dumps(all_nbest_json, indent=4) + "\n")
-        # if version_2_with_negative:
-        #     logger.info(f"Saving null_odds to {null_odds_file}.")
-        #     with open(null_odds_file, "w") as writer:
-        #         writer.write(json.dumps(scores_diff_json, indent=4) + "\n")
-    # print(all_predictions)
     return all_predictions
 
 
+class StreamingQAPostProcessor:
+    """
+    Streaming version of :func:`postprocess_qa_predictions`: the logits are fed batch by batch with :meth:`add_batch`
+    and every example is post-processed as soon as the logits of all its features have been received. Only the
+    (float32) logits of the features of the examples that are not complete yet are kept, instead of a dense
+    `(num_features, max_len)` array of the whole dataset. The answers are the same as the ones of
+    :func:`postprocess_qa_predictions`.
+
+    The features of an example must be contiguous and in the order of the examples, which is what the feature
+    creation with `Dataset.map` produces.
+
+    Args:
+        examples: The non-preprocessed dataset (see the main script for more information).
+        features: The processed dataset (see the main script for more information).
+        context_list: The paragraphs of context.json, indexed by the `relevant` ids.
+        version_2_with_negative, n_best_size, max_answer_length, null_score_diff_threshold:
+            See :func:`postprocess_qa_predictions`.
+    """
+
+    def __init__(
+        self,
+        examples,
+        features,
+        context_list,
+        version_2_with_negative: bool = False,
+        n_best_size: int = 20,
+        max_answer_length: int = 30,
+        null_score_diff_threshold: float = 0.0,
+    ):
+        self.example_ids = examples["id"]
+        self.relevant_ids = examples["relevant"]
+        self.context_list = context_list
+        self.version_2_with_negative = version_2_with_negative
+        self.n_best_size = n_best_size
+        self.max_answer_length = max_answer_length
+        self.null_score_diff_threshold = null_score_diff_threshold
+
+        # Only the columns needed to decode the answers are read back: the offsets as views of the Arrow column.
+        self.offset_mappings = OffsetMappings(features)
+        self.max_context_ranges = None
+        if "max_context_start" in features.column_names:
+            self.max_context_ranges = (
+                np.asarray(features["max_context_start"], dtype=np.int64),
+                np.asarray(features["max_context_end"], dtype=np.int64),
+            )
+
+        feature_index = ExampleFeatureIndex(examples, features)
+        if not feature_index.contiguous:
+            raise ValueError("The features of each example must be contiguous and in the order of the examples.")
+        self.num_features_per_example = feature_index.num_features_per_example
+
+        self.all_predictions = collections.OrderedDict()
+        self.all_nbest_json = collections.OrderedDict()
+        self.scores_diff_json = collections.OrderedDict() if version_2_with_negative else None
+
+        self._pending_start_logits = []
+        self._pending_end_logits = []
+        self._next_example = 0
+        self._next_feature = 0
+
+    def add_batch(self, start_logits: np.ndarray, end_logits: np.ndarray):
+        """Receives the logits of the next batch of features and post-processes the examples they complete."""
+        num_features = len(self.offset_mappings)
+        # `gather_for_metrics` already drops the samples duplicated to even out the last batch.
+        for start_row, end_row in zip(start_logits, end_logits):
+            if self._next_feature + len(self._pending_start_logits) >= num_features:
+                break
+            self._pending_start_logits.append(np.asarray(start_row, dtype=np.float32))
+            self._pending_end_logits.append(np.asarray(end_row, dtype=np.float32))
+        while self._next_example < len(self.example_ids):
+            num_example_features = self.num_features_per_example[self._next_example]
+            if num_example_features > len(self._pending_start_logits):
+                break
+            self._process_next_example(num_example_features)
+
+    @property
+    def num_pending_features(self) -> int:
+        """Number of features whose logits are kept until their example is complete."""
+        return len(self._pending_start_logits)
+
+    def _process_next_example(self, num_example_features: int):
+        start_rows = self._pending_start_logits[:num_example_features]
+        end_rows = self._pending_end_logits[:num_example_features]
+        del self._pending_start_logits[:num_example_features]
+        del self._pending_end_logits[:num_example_features]
+
+        max_len = max([len(row) for row in start_rows], default=1)
+        start_logits = np.full((num_example_features, max_len), -100, dtype=np.float32)
+        end_logits = np.full((num_example_features, max_len), -100, dtype=np.float32)
+        for i, (start_row, end_row) in enumerate(zip(start_rows, end_rows)):
+            start_logits[i, : len(start_row)] = start_row
+            end_logits[i, : len(end_row)] = end_row
+
+        first, last = self._next_feature, self._next_feature + num_example_features
+        max_context_ranges = None
+        if self.max_context_ranges is not None:
+            max_context_ranges = tuple(column[first:last] for column in self.max_context_ranges)
+        start_mask, end_mask = _span_validity_masks(
+            self.offset_mappings.context_mask(max_len, first, last), max_context_ranges
+        )
+        start_indexes, end_indexes, span_scores = batched_span_search(
+            start_logits, end_logits, start_mask, end_mask, self.n_best_size, self.max_answer_length
+        )
+
+        example_id = self.example_ids[self._next_example]
+        prediction, nbest, score_diff = _postprocess_example(
+            self.context_list[self.relevant_ids[self._next_example]],
+            start_logits,
+            end_logits,
+            [self.offset_mappings[i] for i in range(first, last)],
+            start_indexes,
+            end_indexes,
+            span_scores,
+            version_2_with_negative=self.version_2_with_negative,
+            n_best_size=self.n_best_size,
+            null_score_diff_threshold=self.null_score_diff_threshold,
+        )
+        self.all_predictions[example_id] = prediction
+        self.all_nbest_json[example_id] = nbest
+        if self.version_2_with_negative:
+            self.scores_diff_json[example_id] = score_diff
+
+        self._next_example += 1
+        self._next_feature += num_example_features
+
+    def finalize(self):
+        """Checks that every example has been post-processed and returns the predictions, by example id."""
+        if self._next_example != len(self.example_ids):
+            raise ValueError(
+                f"Got the logits of {self._next_feature + self.num_pending_features} features, but "
+                f"{len(self.offset_mappings)} are needed to post-process the {len(self.example_ids)} examples."
+            )
+        return self.all_predictions
+
+
 # def postprocess_qa_predictions_with_beam_search(
 #     examples,
 #     features,
@@ -499,7 +793,6 @@ import random
 from pathlib import Path
 
 import datasets
-import evaluate
 import numpy as np
 import torch
 from accelerate import Accelerator
@@ -507,7 +800,6 @@ from accelerate.logging import get_logger
 from accelerate.utils import set_seed
 from datasets import load_dataset
 from huggingface_hub import Repository, create_repo
-from torch.utils.data import DataLoader
 from tqdm.auto import tqdm
 # from utils_qa import postprocess_qa_predictions
 
@@ -527,6 +819,13 @@ from transformers import (
 from transformers.utils import check_min_version, send_example_telemetry
 from transformers.utils.versions import require_version
 
+from batching import make_dataloader
+from context_store import ContextStore, encode_windows
+from feature_cache import FeatureCache
+from onnx_export import load_onnx_model
+from quantization import quantization_report, quantize_dynamic_int8
+from squad.compute_score import compute_score_columns
+
 
 # Will error if the minimal version of Transformers is not installed. Remove at your own risks.
 # check_min_version("4.35.0.dev0")
@@ -603,6 +902,70 @@ def parse_args():
         action="store_true",
         help="If passed, pad all samples to `max_seq_length`. Otherwise, dynamic padding is used.",
     )
+    parser.add_argument(
+        "--group_by_length",
+        action="store_true",
+        help=(
+            "If passed, the evaluation and prediction features are batched by similar lengths (longest first) to "
+            "reduce dynamic padding, and the logits are put back in dataset order before post-processing."
+        ),
+    )
+    parser.add_argument(
+        "--max_tokens_per_batch",
+        type=int,
+        default=None,
+        help=(
+            "If passed, the features are sorted by length and packed in batches of at most this many padded "
+            "tokens, instead of batches of `per_device_eval_batch_size` features."
+        ),
+    )
+    parser.add_argument(
+        "--runtime",
+        type=str,
+        default="pytorch",
+        choices=["pytorch", "onnx"],
+        help="Run the model in PyTorch or, on CPU, the ONNX export of the checkpoint (see onnx_export.py).",
+    )
+    parser.add_argument(
+        "--onnx_file",
+        type=str,
+        default=None,
+        help="The ONNX model used with `--runtime onnx`. Defaults to `model.onnx` in `model_name_or_path`.",
+    )
+    parser.add_argument(
+        "--onnx_num_threads",
+        type=int,
+        default=None,
+        help="Number of intra-op threads of ONNX Runtime. Defaults to the number of threads of PyTorch.",
+    )
+    parser.add_argument(
+        "--quantize",
+        type=str,
+        default=None,
+        choices=["dynamic-int8"],
+        help=(
+            "If passed, the Linear layers run in int8 on CPU (see `--quantize_compare` to compare the results with "
+            "the fp32 model)."
+        ),
+    )
+    parser.add_argument(
+        "--quantize_compare",
+        action="store_true",
+        help=(
+            "With `--quantize`, the fp32 model also runs on the test file and the number of unchanged predictions "
+            "is logged, with the exact match of both models when the file is labeled (for evaluation: this doubles "
+            "the cost of inference)."
+        ),
+    )
+    parser.add_argument(
+        "--quantize_cache_dir",
+        type=str,
+        default=None,
+        help=(
+            "With `--quantize` and a local `model_name_or_path`, directory where the int8 weights of the checkpoint "
+            "are cached, so that later runs skip their quantization."
+        ),
+    )
     parser.add_argument(
         "--model_name_or_path",
         type=str,
@@ -762,6 +1125,48 @@ def parse_args():
         default=None,
         help="context.json",
     )
+    parser.add_argument(
+        "--context_store",
+        type=str,
+        default=None,
+        help=(
+            "A context store built from context.json by context_store.py. If passed, the paragraphs are sliced from "
+            "its pre-tokenized arrays instead of being tokenized again, and `--context_file` is not needed."
+        ),
+    )
+
+    parser.add_argument(
+        "--max_context",
+        action="store_true",
+        help=(
+            "If passed, an answer can only start in the window where its first token has the most context around "
+            "it."
+        ),
+    )
+    parser.add_argument(
+        "--stream_postprocess",
+        action="store_true",
+        help=(
+            "If passed, every example is post-processed as soon as the logits of all its features are gathered, "
+            "instead of keeping the logits of the whole dataset in memory."
+        ),
+    )
+    parser.add_argument(
+        "--feature_cache_dir",
+        type=str,
+        default=None,
+        help=(
+            "If passed, the tokenized features are cached in this directory, keyed by the content of the examples, "
+            "context.json, the tokenizer and the preprocessing arguments, and reused by the next runs (of this script "
+            "or multiple_choice.py) instead of tokenizing again."
+        ),
+    )
+    parser.add_argument(
+        "--feature_cache_max_gb",
+        type=float,
+        default=10.0,
+        help="Maximum size of `--feature_cache_dir` on disk, the least recently used features are removed beyond it.",
+    )
 
     parser.add_argument(
         "--checkpointing_steps",
@@ -819,18 +1224,235 @@ def parse_args():
             extension = args.test_file.split(".")[-1]
             assert extension in ["csv", "json"], "`test_file` should be a csv or a json file."
 
+    if args.quantize is not None and args.runtime == "onnx":
+        raise ValueError("`--quantize` quantizes the PyTorch model and cannot be used with `--runtime onnx`.")
+    if args.quantize_compare and args.quantize is None:
+        raise ValueError("`--quantize_compare` needs `--quantize`.")
+
+    if (args.group_by_length or args.max_tokens_per_batch is not None) and args.stream_postprocess:
+        raise ValueError(
+            "`--stream_postprocess` needs the features in dataset order and cannot be used with `--group_by_length` "
+            "or `--max_tokens_per_batch`."
+        )
+
     if args.push_to_hub:
         assert args.output_dir is not None, "Need an `output_dir` to create a repo when `--push_to_hub` is passed."
 
     return args
 
+
+def _max_context_ranges(window_starts: np.ndarray, window_lengths: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the `(starts, ends)` arrays of the paragraph positions every window of a paragraph has the maximum context
+    for, given the first paragraph position and the number of paragraph tokens of each window. A token has the
+    maximum context in the window where `min(left context, right context) + 0.01 * window length` is the largest (the
+    first one on ties), as in the original SQuAD scripts. Since the windows are ordered, the ranges are contiguous
+    and split the paragraph; some of them may be empty.
+    """
+    positions = np.arange(window_starts[-1] + window_lengths[-1])
+    left = positions[None, :] - window_starts[:, None]
+    right = (window_starts + window_lengths - 1)[:, None] - positions[None, :]
+    scores = np.minimum(left, right) + 0.01 * window_lengths[:, None]
+    scores[(left < 0) | (right < 0)] = -np.inf
+    best_window = np.argmax(scores, axis=0)
+    windows = np.arange(len(window_starts))
+    return np.searchsorted(best_window, windows, side="left"), np.searchsorted(best_window, windows, side="right")
+
+
+def _add_max_context_ranges(tokenized_examples, doc_stride):
+    """
+    Adds the `max_context_start` and `max_context_end` columns to validation features: the range of feature positions
+    whose paragraph tokens have their maximum context in this feature.
+    """
+    example_ids = tokenized_examples["example_id"]
+    num_features = len(example_ids)
+    context_starts = np.zeros(num_features, dtype=np.int64)
+    context_lengths = np.zeros(num_features, dtype=np.int64)
+    for i, offset_mapping in enumerate(tokenized_examples["offset_mapping"]):
+        context_positions = np.flatnonzero(offset_mapping[:, 0] >= 0)
+        context_starts[i] = context_positions[0] if len(context_positions) > 0 else 0
+        context_lengths[i] = len(context_positions)
+
+    max_context_start = np.zeros(num_features, dtype=np.int64)
+    max_context_end = np.zeros(num_features, dtype=np.int64)
+    # The features of an example are contiguous, one per window of its paragraph.
+    boundaries = [0] + [i for i in range(1, num_features) if example_ids[i] != example_ids[i - 1]] + [num_features]
+    for first, last in zip(boundaries[:-1], boundaries[1:]):
+        window_lengths = context_lengths[first:last]
+        # The windows move forward by the paragraph tokens of a full window minus the stride.
+        window_starts = np.arange(last - first) * max(window_lengths[0] - doc_stride, 0)
+        starts, ends = _max_context_ranges(window_starts, window_lengths)
+        shift = context_starts[first:last] - window_starts
+        max_context_start[first:last] = starts + shift
+        max_context_end[first:last] = ends + shift
+
+    tokenized_examples["max_context_start"] = max_context_start.tolist()
+    tokenized_examples["max_context_end"] = max_context_end.tolist()
+    return tokenized_examples
+
+
+def prepare_validation_features(
+    examples,
+    tokenizer,
+    context_list,
+    max_seq_length,
+    doc_stride,
+    pad_on_right=True,
+    pad_to_max_length=False,
+    max_context=False,
+):
+    """
+    Tokenizes the questions with their relevant paragraph into (possibly several overlapping) features, keeping the
+    `example_id` and the context `offset_mapping` needed to map the predictions back to the paragraph. The offsets of
+    a feature are an int32 `(num_tokens, 2)` array with -1 for the tokens outside of the context, stored flattened
+    (see `OffsetMappings`).
+
+    Args:
+        examples: A batch of examples with the `id`, `question` and `relevant` columns.
+        tokenizer: The (fast) tokenizer used for encoding the data.
+        context_list: The paragraphs of context.json, indexed by the `relevant` ids. With a `ContextStore`, the
+            features are assembled from the pre-tokenized paragraphs instead of tokenizing the text again.
+        max_seq_length (:obj:`int`):
+            The maximum total input sequence length after tokenization.
+        doc_stride (:obj:`int`):
+            How much stride to take between the chunks of a long paragraph.
+        pad_on_right (:obj:`bool`, `optional`, defaults to :obj:`True`):
+            Whether the context comes after the question (depends on the padding side of the tokenizer).
+        pad_to_max_length (:obj:`bool`, `optional`, defaults to :obj:`False`):
+            Whether to pad all the features to `max_seq_length`.
+        max_context (:obj:`bool`, `optional`, defaults to :obj:`False`):
+            Whether to add the `max_context_start`/`max_context_end` columns, the positions where an answer can start
+            in each window (see `_add_max_context_ranges`). Every window is kept.
+    """
+    examples["question"] = [q.lstrip() for q in examples["question"]]
+    if isinstance(context_list, ContextStore):
+        tokenized_examples = _prepare_validation_features_from_store(
+            examples, tokenizer, context_list, max_seq_length, doc_stride, pad_on_right, pad_to_max_length
+        )
+        if max_context:
+            tokenized_examples = _add_max_context_ranges(tokenized_examples, doc_stride)
+        return _flatten_offset_mappings(tokenized_examples)
+    second_sentence = [context_list[index] for index in examples["relevant"]]
+
+    # Tokenize our examples with truncation and maybe padding, but keep the overflows using a stride. This results
+    # in one example possible giving several features when a context is long, each of those features having a
+    # context that overlaps a bit the context of the previous feature.
+    tokenized_examples = tokenizer(
+        examples["question"],
+        second_sentence,
+        truncation="only_second",  # You may need to adjust this based on your dataset format
+        max_length=max_seq_length,
+        stride=doc_stride,
+        return_overflowing_tokens=True,
+        return_offsets_mapping=True,
+        padding="max_length" if pad_to_max_length else False,
+    )
+
+    # Since one example might give us several features if it has a long context, we need a map from a feature to
+    # its corresponding example. This key gives us just that.
+    sample_mapping = tokenized_examples.pop("overflow_to_sample_mapping")
+
+    # For evaluation, we will need to convert our predictions to substrings of the context, so we keep the
+    # corresponding example_id and we will store the offset mappings.
+    tokenized_examples["example_id"] = []
+
+    for i in range(len(tokenized_examples["input_ids"])):
+        # Grab the sequence corresponding to that example (to know what is the context and what is the question).
+        sequence_ids = tokenized_examples.sequence_ids(i)
+        context_index = 1 if pad_on_right else 0
+
+        # One example can give several spans, this is the index of the example containing this span of text.
+        sample_index = sample_mapping[i]
+        tokenized_examples["example_id"].append(examples["id"][sample_index])
+
+        # Set to -1 the offset_mapping that are not part of the context so it's easy to determine if a token
+        # position is part of the context or not.
+        offset_mapping = np.asarray(tokenized_examples["offset_mapping"][i], dtype=np.int32).reshape(-1, 2)
+        offset_mapping[[sequence_id != context_index for sequence_id in sequence_ids]] = -1
+        tokenized_examples["offset_mapping"][i] = offset_mapping
+
+    if max_context:
+        tokenized_examples = _add_max_context_ranges(tokenized_examples, doc_stride)
+    return _flatten_offset_mappings(tokenized_examples)
+
+
+def _prepare_validation_features_from_store(
+    examples, tokenizer, context_store, max_seq_length, doc_stride, pad_on_right, pad_to_max_length
+):
+    """Same features as `prepare_validation_features`, with the paragraphs sliced from a `ContextStore`."""
+    if not pad_on_right:
+        raise ValueError("The context store only supports tokenizers that put the context after the question.")
+
+    question_ids = tokenizer(examples["question"], add_special_tokens=False)["input_ids"]
+    tokenized_examples = collections.defaultdict(list)
+    for i, index in enumerate(examples["relevant"]):
+        windows = encode_windows(
+            tokenizer,
+            question_ids[i],
+            context_store.token_ids(index),
+            context_store.offsets(index),
+            max_seq_length,
+            doc_stride,
+        )
+        for window in windows:
+            for k, v in window.items():
+                tokenized_examples[k].append(v)
+            tokenized_examples["example_id"].append(examples["id"][i])
+
+    if pad_to_max_length:
+        offset_mapping = tokenized_examples.pop("offset_mapping")
+        example_id = tokenized_examples.pop("example_id")
+        tokenized_examples = tokenizer.pad(dict(tokenized_examples), padding="max_length", max_length=max_seq_length)
+        tokenized_examples["offset_mapping"] = [
+            np.concatenate([offsets, np.full((max_seq_length - len(offsets), 2), -1, dtype=np.int32)])
+            for offsets in offset_mapping
+        ]
+        tokenized_examples["example_id"] = example_id
+    return dict(tokenized_examples)
+
+
+def create_and_fill_np_array(start_or_end_logits, dataset, max_len):
+    """
+    Create and fill numpy array of size len_of_validation_data * max_length_of_output_tensor
+
+    Args:
+        start_or_end_logits(:obj:`tensor`):
+            This is the output predictions of the model. We can only enter either start or end logits.
+        eval_dataset: Evaluation dataset
+        max_len(:obj:`int`):
+            The maximum length of the output tensor. ( See the model.eval() part for more details )
+    """
+
+    step = 0
+    # create a numpy array and fill it with -100.
+    logits_concat = np.full((len(dataset), max_len), -100, dtype=np.float64)
+    # Now since we have create an array now we will populate it with the outputs gathered using accelerator.gather_for_metrics
+    for i, output_logit in enumerate(start_or_end_logits):  # populate columns
+        # We have to fill it such that we have to take the whole tensor and replace it on the newly created array
+        # And after every iteration we have to change the step
+
+        batch_size = output_logit.shape[0]
+        cols = output_logit.shape[1]
+
+        if step + batch_size < len(dataset):
+            logits_concat[step : step + batch_size, :cols] = output_logit
+        else:
+            logits_concat[step:, :cols] = output_logit[: len(dataset) - step]
+
+        step += batch_size
+
+    return logits_concat
+
+
 def main():
     args = parse_args()
 
     # Sending telemetry. Tracking the example usage helps us better allocate resources to maintain them. The
     # information sent is the one passed as arguments along with your Python/PyTorch versions.
     send_example_telemetry("run_qa_no_trainer", args)
-    if args.context_file:
+    if args.context_store:
+        context_list = ContextStore(args.context_store)
+    elif args.context_file:
         with open(args.context_file, 'r') as file:
             context_list = json.load(file)
 
@@ -941,7 +1563,15 @@ def main():
             "You can do it from another script, save it, and load it from here, using --tokenizer_name."
         )
 
-    if args.model_name_or_path:
+    if args.context_store:
+        context_list.check_tokenizer(tokenizer)
+
+    if args.runtime == "onnx":
+        # Only the ONNX export runs, so the PyTorch checkpoint is never loaded.
+        model = load_onnx_model(
+            args.model_name_or_path, args.onnx_file, num_threads=args.onnx_num_threads, device=accelerator.device
+        )
+    elif args.model_name_or_path:
         model = AutoModelForQuestionAnswering.from_pretrained(
             args.model_name_or_path,
             from_tf=bool(".ckpt" in args.model_name_or_path),
@@ -1089,52 +1719,47 @@ def main():
     #         train_dataset = train_dataset.select(range(args.max_train_samples))
 
     # Validation preprocessing
-    def prepare_validation_features(examples):
-
-        examples["question"] = [q.lstrip() for q in examples["question"]]
-        second_sentence = [context_list [index] for index in examples["relevant"]]
-
-        # Tokenize our examples with truncation and maybe padding, but keep the overflows using a stride. This results
-        # in one example possible giving several features when a context is long, each of those features having a
-        # context that overlaps a bit the context of the previous feature.
-        tokenized_examples = tokenizer(
-            examples["question"],
-            second_sentence,
-            truncation="only_second",  # You may need to adjust this based on your dataset format
-            max_length=max_seq_length,
-            stride=args.doc_stride,
-            return_overflowing_tokens=True,
-            return_offsets_mapping=True,
-            padding="max_length" if args.pad_to_max_length else False,
+    def prepare_validation_features_fn(examples):
+        return prepare_validation_features(
+            examples,
+            tokenizer,
+            context_list,
+            max_seq_length,
+            args.doc_stride,
+            pad_on_right=pad_on_right,
+            pad_to_max_length=args.pad_to_max_length,
+            max_context=args.max_context,
         )
 
+    feature_cache = None
+    if args.feature_cache_dir is not None:
+        feature_cache = FeatureCache(args.feature_cache_dir, max_size=int(args.feature_cache_max_gb * 1024**3))
 
-        # Since one example might give us several features if it has a long context, we need a map from a feature to
-        # its corresponding example. This key gives us just that.
-        sample_mapping = tokenized_examples.pop("overflow_to_sample_mapping")
-
-        # For evaluation, we will need to convert our predictions to substrings of the context, so we keep the
-        # corresponding example_id and we will store the offset mappings.
-        tokenized_examples["example_id"] = []
-
-        for i in range(len(tokenized_examples["input_ids"])):
-            # Grab the sequence corresponding to that example (to know what is the context and what is the question).
-            sequence_ids = tokenized_examples.sequence_ids(i)
-            context_index = 1 if pad_on_right else 0
-
-            # One example can give several spans, this is the index of the example containing this span of text.
-            sample_index = sample_mapping[i]
-            tokenized_examples["example_id"].append(examples["id"][sample_index])
-
-            # Set to None the offset_mapping that are not part of the context so it's easy to determine if a token
-            # position is part of the context or not.
-            tokenized_examples["offset_mapping"][i] = [
-                (o if sequence_ids[k] == context_index else None)
-                for k, o in enumerate(tokenized_examples["offset_mapping"][i])
-            ]
-
+    def create_validation_features(examples, desc):
+        def create_features():
+            return examples.map(
+                prepare_validation_features_fn,
+                batched=True,
+                num_proc=args.preprocessing_num_workers,
+                remove_columns=column_names,
+                load_from_cache_file=not args.overwrite_cache,
+                desc=desc,
+            )
 
-        return tokenized_examples
+        if feature_cache is None:
+            return create_features()
+        key = feature_cache.key(
+            "qa",
+            examples,
+            tokenizer,
+            context_list,
+            args.context_file,
+            max_seq_length=max_seq_length,
+            doc_stride=args.doc_stride,
+            pad_to_max_length=args.pad_to_max_length,
+            max_context=args.max_context,
+        )
+        return feature_cache.get_or_create(key, create_features)
 
     if "validation" not in raw_datasets:
         raise ValueError("--do_eval requires a validation dataset")
@@ -1144,14 +1769,7 @@ def main():
         eval_examples = eval_examples.select(range(args.max_eval_samples))
     # Validation Feature Creation
     with accelerator.main_process_first():
-        eval_dataset = eval_examples.map(
-            prepare_validation_features,
-            batched=True,
-            num_proc=args.preprocessing_num_workers,
-            remove_columns=column_names,
-            load_from_cache_file=not args.overwrite_cache,
-            desc="Running tokenizer on validation dataset",
-        )
+        eval_dataset = create_validation_features(eval_examples, "Running tokenizer on validation dataset")
 
     if args.max_eval_samples is not None:
         # During Feature creation dataset samples might increase, we will select required samples again
@@ -1166,14 +1784,7 @@ def main():
             predict_examples = predict_examples.select(range(args.max_predict_samples))
         # Predict Feature Creation
         with accelerator.main_process_first():
-            predict_dataset = predict_examples.map(
-                prepare_validation_features,
-                batched=True,
-                num_proc=args.preprocessing_num_workers,
-                remove_columns=column_names,
-                load_from_cache_file=not args.overwrite_cache,
-                desc="Running tokenizer on prediction dataset",
-            )
+            predict_dataset = create_validation_features(predict_examples, "Running tokenizer on prediction dataset")
             if args.max_predict_samples is not None:
                 # During Feature creation dataset samples might increase, we will select required samples again
                 predict_dataset = predict_dataset.select(range(args.max_predict_samples))
@@ -1197,15 +1808,15 @@ def main():
     #     train_dataset, shuffle=True, collate_fn=data_collator, batch_size=args.per_device_train_batch_size
     # )
 
-    eval_dataset_for_model = eval_dataset.remove_columns(["example_id", "offset_mapping"])
-    eval_dataloader = DataLoader(
-        eval_dataset_for_model, collate_fn=data_collator, batch_size=args.per_device_eval_batch_size
+    eval_dataset_for_model = remove_postprocess_columns(eval_dataset)
+    eval_dataloader, eval_sampler = make_dataloader(
+        eval_dataset_for_model, data_collator, args, accelerator.num_processes
     )
 
     if args.do_predict:
-        predict_dataset_for_model = predict_dataset.remove_columns(["example_id", "offset_mapping"])
-        predict_dataloader = DataLoader(
-            predict_dataset_for_model, collate_fn=data_collator, batch_size=args.per_device_eval_batch_size
+        predict_dataset_for_model = remove_postprocess_columns(predict_dataset)
+        predict_dataloader, predict_sampler = make_dataloader(
+            predict_dataset_for_model, data_collator, args, accelerator.num_processes
         )
 
     # Post-processing:
@@ -1225,7 +1836,12 @@ def main():
             null_score_diff_threshold=args.null_score_diff_threshold,
             output_dir=args.output_dir,
             prefix=stage,
+            # Post-processing shares the logger of this script: keep it at the level set by `logging.basicConfig`.
+            log_level=logging.INFO,
         )
+        return format_predictions(examples, predictions)
+
+    def format_predictions(examples, predictions):
         # Format the result to the format the metric expects.
         # if args.version_2_with_negative:
         #     formatted_predictions = [
@@ -1239,6 +1855,18 @@ def main():
         references = [{"id": ex["id"]} for ex in examples]
         return EvalPrediction(predictions=formatted_predictions, label_ids=references)
 
+    def make_stream_processor(examples, features):
+        # Post-processes every example as soon as the logits of all its features are gathered.
+        return StreamingQAPostProcessor(
+            examples=examples,
+            features=features,
+            context_list=context_list,
+            version_2_with_negative=args.version_2_with_negative,
+            n_best_size=args.n_best_size,
+            max_answer_length=args.max_answer_length,
+            null_score_diff_threshold=args.null_score_diff_threshold,
+        )
+
     # converted_predictions = [{'id': p['id'], 'prediction_text': [p['prediction_text']]} for p in predictions]
     # converted_references = [{'id': r['id'], 'answers': [{'text': a['text'], 'answer_start': a['start']} for a in r['answers']]} for r in references]
 
@@ -1246,55 +1874,21 @@ def main():
     # custom_metrics = {'predictions': converted_predictions, 'references': converted_references}
 
 
-    metric = evaluate.load("squad_v2" if args.version_2_with_negative else "squad")
-
-    # Create and fill numpy array of size len_of_validation_data * max_length_of_output_tensor
-    def create_and_fill_np_array(start_or_end_logits, dataset, max_len):
-        """
-        Create and fill numpy array of size len_of_validation_data * max_length_of_output_tensor
-
-        Args:
-            start_or_end_logits(:obj:`tensor`):
-                This is the output predictions of the model. We can only enter either start or end logits.
-            eval_dataset: Evaluation dataset
-            max_len(:obj:`int`):
-                The maximum length of the output tensor. ( See the model.eval() part for more details )
-        """
-
-        step = 0
-        # create a numpy array and fill it with -100.
-        logits_concat = np.full((len(dataset), max_len), -100, dtype=np.float64)
-        # Now since we have create an array now we will populate it with the outputs gathered using accelerator.gather_for_metrics
-        for i, output_logit in enumerate(start_or_end_logits):  # populate columns
-            # We have to fill it such that we have to take the whole tensor and replace it on the newly created array
-            # And after every iteration we have to change the step
-
-            batch_size = output_logit.shape[0]
-            cols = output_logit.shape[1]
-
-            if step + batch_size < len(dataset):
-                logits_concat[step : step + batch_size, :cols] = output_logit
-            else:
-                logits_concat[step:, :cols] = output_logit[: len(dataset) - step]
-
-            step += batch_size
-
-        return logits_concat
-
     # Optimizer
     # Split weights in two groups, one with weight decay and the other not.
-    no_decay = ["bias", "LayerNorm.weight"]
-    optimizer_grouped_parameters = [
-        {
-            "params": [p for n, p in model.named_parameters() if not any(nd in n for nd in no_decay)],
-            "weight_decay": args.weight_decay,
-        },
-        {
-            "params": [p for n, p in model.named_parameters() if any(nd in n for nd in no_decay)],
-            "weight_decay": 0.0,
-        },
-    ]
-    optimizer = torch.optim.AdamW(optimizer_grouped_parameters, lr=args.learning_rate)
+    if args.runtime == "pytorch":
+        no_decay = ["bias", "LayerNorm.weight"]
+        optimizer_grouped_parameters = [
+            {
+                "params": [p for n, p in model.named_parameters() if not any(nd in n for nd in no_decay)],
+                "weight_decay": args.weight_decay,
+            },
+            {
+                "params": [p for n, p in model.named_parameters() if any(nd in n for nd in no_decay)],
+                "weight_decay": 0.0,
+            },
+        ]
+        optimizer = torch.optim.AdamW(optimizer_grouped_parameters, lr=args.learning_rate)
 
     # Scheduler and math around the number of training steps.
     overrode_max_train_steps = False
@@ -1311,9 +1905,19 @@ def main():
     # )
 
     # Prepare everything with our `accelerator`.
-    model, optimizer, eval_dataloader = accelerator.prepare(
-        model, optimizer, eval_dataloader
-    )
+    if args.runtime == "onnx":
+        eval_dataloader = accelerator.prepare(eval_dataloader)
+    else:
+        model, optimizer, eval_dataloader = accelerator.prepare(model, optimizer, eval_dataloader)
+    if args.quantize == "dynamic-int8":
+        if accelerator.device.type != "cpu":
+            raise ValueError(
+                f"`--quantize dynamic-int8` runs on CPU, but the accelerator device is {accelerator.device}."
+            )
+        fp32_model = model if args.quantize_compare else None
+        model = quantize_dynamic_int8(
+            accelerator.unwrap_model(model), args.model_name_or_path, args.quantize_cache_dir
+        )
 
     # We need to recalculate our total training steps as the size of the training dataloader may have changed.
     # num_update_steps_per_epoch = math.ceil(len(train_dataloader) / args.gradient_accumulation_steps)
@@ -1438,46 +2042,83 @@ def main():
     #                 commit_message=f"Training in progress epoch {epoch}", blocking=False, auto_lfs_prune=True
     #             )
 
-    # Evaluation
-    logger.info("***** Running Evaluation *****")
-    logger.info(f"  Num examples = {len(eval_dataset)}")
-    logger.info(f"  Batch size = {args.per_device_eval_batch_size}")
+    def predict_answers(model, dataloader, sampler, examples, dataset):
+        # Runs the model on the features and post-processes the gathered logits into the answers of the examples.
+        all_start_logits = []
+        all_end_logits = []
+        if args.stream_postprocess:
+            stream_processor = make_stream_processor(examples, dataset)
 
-    all_start_logits = []
-    all_end_logits = []
+        model.eval()
 
-    model.eval()
+        for step, batch in enumerate(dataloader):
+            with torch.no_grad():
+                outputs = model(**batch)
+                start_logits = outputs.start_logits
+                end_logits = outputs.end_logits
+
+                if not args.pad_to_max_length:  # necessary to pad predictions and labels for being gathered
+                    start_logits = accelerator.pad_across_processes(start_logits, dim=1, pad_index=-100)
+                    end_logits = accelerator.pad_across_processes(end_logits, dim=1, pad_index=-100)
 
-    for step, batch in enumerate(eval_dataloader):
-        with torch.no_grad():
-            outputs = model(**batch)
-            start_logits = outputs.start_logits
-            end_logits = outputs.end_logits
+                start_logits = accelerator.gather_for_metrics(start_logits).cpu().numpy()
+                end_logits = accelerator.gather_for_metrics(end_logits).cpu().numpy()
+                if args.stream_postprocess:
+                    stream_processor.add_batch(start_logits, end_logits)
+                else:
+                    all_start_logits.append(start_logits)
+                    all_end_logits.append(end_logits)
+        # print('---Prediction.---')
+        # print(all_start_logits)
+        # print(all_end_logits)
+        # print('---Prediction.---')
+
+        if args.stream_postprocess:
+            return format_predictions(examples, stream_processor.finalize())
 
-            if not args.pad_to_max_length:  # necessary to pad predictions and labels for being gathered
-                start_logits = accelerator.pad_across_processes(start_logits, dim=1, pad_index=-100)
-                end_logits = accelerator.pad_across_processes(end_logits, dim=1, pad_index=-100)
+        max_len = max([x.shape[1] for x in all_start_logits])  # Get the max_length of the tensor
 
-            all_start_logits.append(accelerator.gather_for_metrics(start_logits).cpu().numpy())
-            all_end_logits.append(accelerator.gather_for_metrics(end_logits).cpu().numpy())
-    # print('---Prediction.---')
-    # print(all_start_logits)
-    # print(all_end_logits)
-    # print('---Prediction.---')
+        # concatenate the numpy array
+        start_logits_concat = create_and_fill_np_array(all_start_logits, dataset, max_len)
+        end_logits_concat = create_and_fill_np_array(all_end_logits, dataset, max_len)
+        if sampler is not None:
+            start_logits_concat = sampler.restore_order(start_logits_concat)
+            end_logits_concat = sampler.restore_order(end_logits_concat)
 
-    max_len = max([x.shape[1] for x in all_start_logits])  # Get the max_length of the tensor
+        # delete the list of numpy arrays
+        del all_start_logits
+        del all_end_logits
 
-    # concatenate the numpy array
-    start_logits_concat = create_and_fill_np_array(all_start_logits, eval_dataset, max_len)
-    end_logits_concat = create_and_fill_np_array(all_end_logits, eval_dataset, max_len)
+        outputs_numpy = (start_logits_concat, end_logits_concat)
 
-    # delete the list of numpy arrays
-    del all_start_logits
-    del all_end_logits
+        return post_processing_function(examples, dataset, outputs_numpy)
 
-    outputs_numpy = (start_logits_concat, end_logits_concat)
+    # Evaluation
+    logger.info("***** Running Evaluation *****")
+    logger.info(f"  Num examples = {len(eval_dataset)}")
+    logger.info(f"  Batch size = {args.per_device_eval_batch_size}")
 
-    prediction = post_processing_function(eval_examples, eval_dataset, outputs_numpy)
+    prediction = predict_answers(model, eval_dataloader, eval_sampler, eval_examples, eval_dataset)
+
+    if args.quantize_compare:
+        fp32_prediction = predict_answers(fp32_model, eval_dataloader, eval_sampler, eval_examples, eval_dataset)
+        answers = [item["prediction_text"] for item in prediction.predictions]
+        fp32_answers = [item["prediction_text"] for item in fp32_prediction.predictions]
+        exact_match = fp32_exact_match = None
+        if answer_column_name in eval_examples.column_names:
+            # Exact match against the labeled answers of the validation file.
+            references = [[answer["text"]] for answer in eval_examples[answer_column_name]]
+            exact_match = compute_score_columns(answers, references, cjk=True)["exact_match"]
+            fp32_exact_match = compute_score_columns(fp32_answers, references, cjk=True)["exact_match"]
+        logger.info(
+            quantization_report(
+                "exact match",
+                exact_match,
+                fp32_exact_match,
+                sum(answer == fp32_answer for answer, fp32_answer in zip(answers, fp32_answers)),
+                len(answers),
+            )
+        )
 
     # print('###')
     # # print(eval_dataset)
@@ -1511,37 +2152,16 @@ def main():
         logger.info(f"  Num examples = {len(predict_dataset)}")
         logger.info(f"  Batch size = {args.per_device_eval_batch_size}")
 
-        all_start_logits = []
-        all_end_logits = []
-
-        model.eval()
-
-        for step, batch in enumerate(predict_dataloader):
-            with torch.no_grad():
-                outputs = model(**batch)
-                start_logits = outputs.start_logits
-                end_logits = outputs.end_logits
-
-                if not args.pad_to_max_length:  # necessary to pad predictions and labels for being gathered
-                    start_logits = accelerator.pad_across_processes(start_logits, dim=1, pad_index=-100)
-                    end_logits = accelerator.pad_across_processes(end_logits, dim=1, pad_index=-100)
-
-                all_start_logits.append(accelerator.gather_for_metrics(start_logits).cpu().numpy())
-                all_end_logits.append(accelerator.gather_for_metrics(end_logits).cpu().numpy())
-
-        max_len = max([x.shape[1] for x in all_start_logits])  # Get the max_length of the tensor
-        # concatenate the numpy array
-        start_logits_concat = create_and_fill_np_array(all_start_logits, predict_dataset, max_len)
-        end_logits_concat = create_and_fill_np_array(all_end_logits, predict_dataset, max_len)
-
-        # delete the list of numpy arrays
-        del all_start_logits
-        del all_end_logits
-
-        outputs_numpy = (start_logits_concat, end_logits_concat)
-        prediction = post_processing_function(predict_examples, predict_dataset, outputs_numpy)
-        predict_metric = metric.compute(predictions=prediction.predictions, references=prediction.label_ids)
-        logger.info(f"Predict metrics: {predict_metric}")
+        prediction = predict_answers(model, predict_dataloader, predict_sampler, predict_examples, predict_dataset)
+        if answer_column_name in predict_examples.column_names:
+            # Scored by character, as the answers are Chinese (see `compute_score_columns`).
+            predicted_answers = {item["id"]: item["prediction_text"] for item in prediction.predictions}
+            predict_metric = compute_score_columns(
+                [predicted_answers.get(example_id) for example_id in predict_examples["id"]],
+                [[answer["text"]] for answer in predict_examples[answer_column_name]],
+                cjk=True,
+            )
+            logger.info(f"Predict metrics: {predict_metric}")
 
     # if args.with_tracking:
     #     log = {
@@ -0,0 +1,191 @@
+# coding=utf-8
+"""
+Batch samplers for the inference dataloaders.
+
+With dynamic padding every batch is padded to its longest member, so batching the features in dataset order spends
+a lot of the compute on pad tokens. `LengthGroupedBatchSampler` sorts the features by length before cutting the
+batches, so that each batch holds features of similar lengths, and `restore_order` puts the gathered outputs back in
+dataset order afterwards. The batches either hold a fixed number of features or, with `max_tokens`, as many features
+as fit in a budget of padded tokens, so short inputs go in large batches and long ones in small batches.
+"""
+
+import logging
+
+import numpy as np
+import pyarrow as pa
+from torch.utils.data import DataLoader, Sampler
+
+
+logger = logging.getLogger(__name__)
+
+
+def _list_lengths(list_array):
+    # Number of values of every list of a (possibly sliced) Arrow list array, from its offsets alone.
+    return np.diff(np.asarray(list_array.offsets, dtype=np.int64))
+
+
+def feature_lengths(features):
+    """
+    Returns the `(lengths, num_rows)` arrays of a tokenized dataset: the number of tokens of each feature and the
+    number of sequences it holds. For multiple choice features (one sequence per choice), the length is the one of the
+    longest choice and `num_rows` the number of choices, which is how `DataCollatorForMultipleChoice` pads them.
+
+    The lengths are read from the offsets of the Arrow `input_ids` column, so the token ids are never loaded.
+    """
+    # A slice of the table without an indices mapping, else only the `input_ids` column is gathered (in Arrow).
+    input_ids = features.with_format("arrow", columns=["input_ids"])[:]["input_ids"]
+    lengths = [np.zeros(0, dtype=np.int64)]
+    num_rows = [np.zeros(0, dtype=np.int64)]
+    for chunk in input_ids.chunks:
+        if pa.types.is_list(chunk.type.value_type) or pa.types.is_large_list(chunk.type.value_type):
+            chunk_num_rows = _list_lengths(chunk)
+            choice_lengths = _list_lengths(chunk.flatten())
+            chunk_lengths = np.zeros(len(chunk), dtype=np.int64)
+            non_empty = chunk_num_rows > 0
+            if np.any(non_empty):
+                starts = np.concatenate([[0], np.cumsum(chunk_num_rows)[:-1]])
+                chunk_lengths[non_empty] = np.maximum.reduceat(choice_lengths, starts[non_empty])
+        else:
+            chunk_lengths = _list_lengths(chunk)
+            chunk_num_rows = np.ones(len(chunk), dtype=np.int64)
+        lengths.append(chunk_lengths)
+        num_rows.append(chunk_num_rows)
+    return np.concatenate(lengths), np.concatenate(num_rows)
+
+
+def padded_size(batch_size, num_rows, max_length, pad_to_multiple_of=None):
+    """Number of input positions (real and pad tokens) of a batch once the collator has padded it."""
+    if pad_to_multiple_of is not None and max_length % pad_to_multiple_of != 0:
+        max_length = (max_length // pad_to_multiple_of + 1) * pad_to_multiple_of
+    return batch_size * num_rows * max_length
+
+
+class LengthGroupedBatchSampler(Sampler):
+    """
+    Batch sampler yielding batches of features of similar lengths, longest first (so that running out of memory
+    happens on the first batch). The outputs gathered batch after batch are in the order of :attr:`order`, and
+    `restore_order` maps them back to the order of the dataset.
+
+    Args:
+        lengths (:obj:`np.ndarray`):
+            The number of tokens of each feature (see `feature_lengths`).
+        batch_size (:obj:`int`, `optional`):
+            The number of features per batch. Needed unless `max_tokens` is given.
+        num_rows (:obj:`np.ndarray`, `optional`):
+            The number of sequences of each feature (the number of choices in multiple choice), defaults to 1.
+        pad_to_multiple_of (:obj:`int`, `optional`):
+            The `pad_to_multiple_of` of the data collator.
+        max_tokens (:obj:`int`, `optional`):
+            If given, every batch takes as many features as fit in `max_tokens` input positions once padded (pad
+            tokens included), with at most `batch_size` features if it is also given. A feature longer than the
+            budget gets a batch of its own.
+    """
+
+    def __init__(self, lengths, batch_size=None, num_rows=None, pad_to_multiple_of=None, max_tokens=None):
+        if batch_size is None and max_tokens is None:
+            raise ValueError("Need either a `batch_size` or a `max_tokens` budget.")
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.num_rows = np.ones_like(self.lengths) if num_rows is None else np.asarray(num_rows, dtype=np.int64)
+        self.batch_size = batch_size
+        self.pad_to_multiple_of = pad_to_multiple_of
+        self.max_tokens = max_tokens
+        # Sort by padded size of a feature; the stable sort keeps the dataset order among equal lengths.
+        self.order = np.argsort(-(self.lengths * self.num_rows), kind="stable")
+        self.batches = self._cut_batches(self.order)
+
+    def _cut_batches(self, indices):
+        if self.max_tokens is None:
+            return [
+                indices[start : start + self.batch_size].tolist() for start in range(0, len(indices), self.batch_size)
+            ]
+        batches = []
+        batch = []
+        max_length = max_rows = 0
+        for index in indices.tolist():
+            length = max(max_length, int(self.lengths[index]))
+            rows = max(max_rows, int(self.num_rows[index]))
+            full = self.batch_size is not None and len(batch) == self.batch_size
+            over_budget = padded_size(len(batch) + 1, rows, length, self.pad_to_multiple_of) > self.max_tokens
+            if batch and (full or over_budget):
+                batches.append(batch)
+                batch = []
+                length, rows = int(self.lengths[index]), int(self.num_rows[index])
+            batch.append(index)
+            max_length, max_rows = length, rows
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def __iter__(self):
+        yield from self.batches
+
+    def __len__(self):
+        return len(self.batches)
+
+    def restore_order(self, outputs):
+        """Puts outputs (indexed along the first axis) concatenated in batch order back in dataset order."""
+        outputs = np.asarray(outputs)
+        if len(outputs) != len(self.order):
+            raise ValueError(f"Got {len(outputs)} outputs for {len(self.order)} features.")
+        restored = np.empty_like(outputs)
+        restored[self.order] = outputs
+        return restored
+
+    def padding_report(self):
+        """
+        Compares the padded input positions of these batches with the ones of batches cut the same way in dataset
+        order. Returns a dict with `tokens` (the input positions of the features padded on their own),
+        `padded_in_order` and `padded_grouped` (the padding added by the collator in both cases) and `saved`.
+        """
+        num_tokens = int(np.sum(self.lengths * self.num_rows))
+        in_order = sum(self._padded_size(batch) for batch in self._cut_batches(np.arange(len(self.lengths))))
+        grouped = sum(self._padded_size(batch) for batch in self.batches)
+        return {
+            "tokens": num_tokens,
+            "padded_in_order": in_order - num_tokens,
+            "padded_grouped": grouped - num_tokens,
+            "saved": in_order - grouped,
+        }
+
+    def _padded_size(self, batch):
+        return padded_size(
+            len(batch), int(np.max(self.num_rows[batch])), int(np.max(self.lengths[batch])), self.pad_to_multiple_of
+        )
+
+    def summary(self):
+        """One-line description of `padding_report`, for the logs."""
+        report = self.padding_report()
+        in_order = report["tokens"] + report["padded_in_order"]
+        ratio = report["saved"] / in_order if in_order > 0 else 0.0
+        return (
+            f"Length-grouped batches: {len(self.batches)} batches, {report['padded_grouped']} padding tokens instead "
+            f"of {report['padded_in_order']}, {report['saved']} input positions saved ({ratio:.1%})."
+        )
+
+
+def make_dataloader(features, data_collator, args, num_processes=1, num_rows=False, **dataloader_kwargs):
+    """
+    Returns the inference dataloader of `features` and, with `--group_by_length` or `--max_tokens_per_batch`, the
+    `LengthGroupedBatchSampler` that restores the order of the outputs (else `None`). `args` holds the batching
+    arguments shared by the scripts, `num_rows` tells whether the features hold several sequences (multiple choice)
+    and `dataloader_kwargs` are passed to the `DataLoader`.
+    """
+    if not args.group_by_length and args.max_tokens_per_batch is None:
+        dataloader = DataLoader(
+            features, collate_fn=data_collator, batch_size=args.per_device_eval_batch_size, **dataloader_kwargs
+        )
+        return dataloader, None
+    if args.max_tokens_per_batch is not None and num_processes > 1:
+        raise ValueError(
+            "`--max_tokens_per_batch` gives batches of different sizes, which only works on a single process."
+        )
+    lengths, feature_num_rows = feature_lengths(features)
+    sampler = LengthGroupedBatchSampler(
+        lengths,
+        args.per_device_eval_batch_size if args.max_tokens_per_batch is None else None,
+        num_rows=feature_num_rows if num_rows else None,
+        pad_to_multiple_of=getattr(data_collator, "pad_to_multiple_of", None),
+        max_tokens=args.max_tokens_per_batch,
+    )
+    logger.info(sampler.summary())
+    return DataLoader(features, collate_fn=data_collator, batch_sampler=sampler, **dataloader_kwargs), sampler
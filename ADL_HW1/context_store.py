@@ -0,0 +1,264 @@
+# coding=utf-8
+"""
+Memory-mapped, pre-tokenized store of the context.json paragraphs.
+
+`build_context_store` tokenizes every paragraph once and writes flat arrays of token ids and character offsets (plus
+the UTF-8 text itself) to a directory. `ContextStore` maps those files back read-only: it behaves like the list
+returned by `json.load(context.json)` (indexing gives the paragraph text), and `token_ids(i)` / `offsets(i)` slice the
+pre-tokenized paragraph without running the tokenizer again. The pair encodings the models need are then assembled
+from the cached pieces by `encode_pair` (multiple choice) and `encode_windows` (question answering), which follow the
+truncation rules of the 🤗 Tokenizers library.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+from collections.abc import Sequence
+
+import numpy as np
+
+
+STORE_META_FILE = "meta.json"
+TEXT_FILE = "text.bin"
+TEXT_INDEX_FILE = "text_index.bin"
+INPUT_IDS_FILE = "input_ids.bin"
+OFFSETS_FILE = "offsets.bin"
+TOKEN_INDEX_FILE = "token_index.bin"
+
+
+def file_sha256(path, block_size=1 << 20):
+    """Hashes a file by blocks, so the whole file never has to be in memory."""
+    sha = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(block_size), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def tokenizer_fingerprint(tokenizer):
+    """Hash of the full serialized fast tokenizer (normalizer, pre-tokenizer, vocabulary, ...)."""
+    if not getattr(tokenizer, "is_fast", False):
+        raise ValueError("The context store can only be built and used with a fast tokenizer.")
+    return hashlib.sha256(tokenizer.backend_tokenizer.to_str().encode("utf-8")).hexdigest()
+
+
+def build_context_store(context_file, tokenizer, store_dir, batch_size=1000):
+    """
+    Tokenizes every paragraph of `context_file` once and writes the memory-mappable store to `store_dir`.
+
+    Args:
+        context_file (:obj:`str`):
+            Path to context.json (a json list of paragraphs).
+        tokenizer: The fast tokenizer the models use.
+        store_dir (:obj:`str`):
+            The directory to write the store to.
+        batch_size (:obj:`int`, `optional`, defaults to 1000):
+            Number of paragraphs tokenized at a time.
+    """
+    with open(context_file, "r") as file:
+        context_list = json.load(file)
+
+    os.makedirs(store_dir, exist_ok=True)
+    text_index = [0]
+    token_index = [0]
+    with open(os.path.join(store_dir, TEXT_FILE), "wb") as text_file, open(
+        os.path.join(store_dir, INPUT_IDS_FILE), "wb"
+    ) as ids_file, open(os.path.join(store_dir, OFFSETS_FILE), "wb") as offsets_file:
+        for start in range(0, len(context_list), batch_size):
+            paragraphs = context_list[start : start + batch_size]
+            tokenized = tokenizer(paragraphs, add_special_tokens=False, return_offsets_mapping=True)
+            for paragraph, input_ids, offsets in zip(
+                paragraphs, tokenized["input_ids"], tokenized["offset_mapping"]
+            ):
+                encoded = paragraph.encode("utf-8")
+                text_file.write(encoded)
+                text_index.append(text_index[-1] + len(encoded))
+                ids_file.write(np.asarray(input_ids, dtype=np.int32).tobytes())
+                offsets_file.write(np.asarray(offsets, dtype=np.int32).reshape(-1, 2).tobytes())
+                token_index.append(token_index[-1] + len(input_ids))
+
+    np.asarray(text_index, dtype=np.int64).tofile(os.path.join(store_dir, TEXT_INDEX_FILE))
+    np.asarray(token_index, dtype=np.int64).tofile(os.path.join(store_dir, TOKEN_INDEX_FILE))
+    meta = {
+        "num_paragraphs": len(context_list),
+        "num_tokens": token_index[-1],
+        "context_sha256": file_sha256(context_file),
+        "tokenizer_name_or_path": tokenizer.name_or_path,
+        "tokenizer_sha256": tokenizer_fingerprint(tokenizer),
+    }
+    with open(os.path.join(store_dir, STORE_META_FILE), "w") as file:
+        json.dump(meta, file, indent=4)
+    return meta
+
+
+class ContextStore(Sequence):
+    """
+    Read-only, memory-mapped view of a store written by `build_context_store`.
+
+    `store[i]` is the text of paragraph `i`, so the store can be passed wherever the context list is expected, and
+    `token_ids(i)` / `offsets(i)` are zero-copy views of its tokens and their `(start, end)` character offsets.
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, STORE_META_FILE), "r") as file:
+            self.meta = json.load(file)
+        self._open()
+
+    def _open(self):
+        num_paragraphs = self.meta["num_paragraphs"]
+        num_tokens = self.meta["num_tokens"]
+        self._text_index = np.memmap(
+            os.path.join(self.store_dir, TEXT_INDEX_FILE), dtype=np.int64, mode="r", shape=(num_paragraphs + 1,)
+        )
+        self._token_index = np.memmap(
+            os.path.join(self.store_dir, TOKEN_INDEX_FILE), dtype=np.int64, mode="r", shape=(num_paragraphs + 1,)
+        )
+        # Empty files cannot be memory-mapped.
+        if int(self._text_index[-1]) > 0:
+            self._text = np.memmap(os.path.join(self.store_dir, TEXT_FILE), dtype=np.uint8, mode="r")
+        else:
+            self._text = np.zeros(0, dtype=np.uint8)
+        if num_tokens > 0:
+            self._input_ids = np.memmap(
+                os.path.join(self.store_dir, INPUT_IDS_FILE), dtype=np.int32, mode="r", shape=(num_tokens,)
+            )
+            self._offsets = np.memmap(
+                os.path.join(self.store_dir, OFFSETS_FILE), dtype=np.int32, mode="r", shape=(num_tokens, 2)
+            )
+        else:
+            self._input_ids = np.zeros(0, dtype=np.int32)
+            self._offsets = np.zeros((0, 2), dtype=np.int32)
+
+    # Memory maps are pickled as full in-memory copies, so only the location and the metadata travel to the
+    # `datasets.map` workers (and into its fingerprint), and the files are mapped again on the other side.
+    def __getstate__(self):
+        return {"store_dir": self.store_dir, "meta": self.meta}
+
+    def __setstate__(self, state):
+        self.store_dir = state["store_dir"]
+        self.meta = state["meta"]
+        self._open()
+
+    def __len__(self):
+        return self.meta["num_paragraphs"]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        start, end = self._text_index[index], self._text_index[index + 1]
+        return self._text[start:end].tobytes().decode("utf-8")
+
+    def token_ids(self, index):
+        return self._input_ids[self._token_index[index] : self._token_index[index + 1]]
+
+    def offsets(self, index):
+        return self._offsets[self._token_index[index] : self._token_index[index + 1]]
+
+    def check_tokenizer(self, tokenizer):
+        """Raises an error if the store was not built with `tokenizer`."""
+        if tokenizer_fingerprint(tokenizer) != self.meta["tokenizer_sha256"]:
+            raise ValueError(
+                f"The context store in {self.store_dir} was built with the tokenizer of "
+                f"{self.meta['tokenizer_name_or_path']}, not {tokenizer.name_or_path}. Rebuild it with "
+                "`python context_store.py`."
+            )
+
+
+def _truncate_longest_first(first_length, second_length, max_length):
+    """Lengths kept by the `longest_first` truncation strategy of 🤗 Tokenizers for a pair of sequences."""
+    if first_length + second_length <= max_length:
+        return first_length, second_length
+    swap = first_length > second_length
+    shortest, longest = (second_length, first_length) if swap else (first_length, second_length)
+    if shortest > max_length:
+        longest = shortest
+    else:
+        longest = max(shortest, max_length - shortest)
+    if shortest + longest > max_length:
+        shortest = max_length // 2
+        longest = shortest + max_length % 2
+    return (longest, shortest) if swap else (shortest, longest)
+
+
+def _pair_inputs(tokenizer, first_ids, second_ids):
+    """Adds the special tokens to a (question, paragraph) pair of token ids."""
+    encoding = {"input_ids": tokenizer.build_inputs_with_special_tokens(first_ids, second_ids)}
+    if "token_type_ids" in tokenizer.model_input_names:
+        encoding["token_type_ids"] = tokenizer.create_token_type_ids_from_sequences(first_ids, second_ids)
+    encoding["attention_mask"] = [1] * len(encoding["input_ids"])
+    return encoding
+
+
+def encode_pair(tokenizer, question_ids, paragraph_ids, max_length):
+    """
+    Assembles the encoding of `tokenizer(question, paragraph, max_length=max_length, truncation=True)` from the
+    already tokenized question and paragraph (without special tokens).
+    """
+    question_ids = list(question_ids)
+    paragraph_ids = [int(token_id) for token_id in paragraph_ids]
+    budget = max_length - tokenizer.num_special_tokens_to_add(pair=True)
+    question_length, paragraph_length = _truncate_longest_first(len(question_ids), len(paragraph_ids), budget)
+    return _pair_inputs(tokenizer, question_ids[:question_length], paragraph_ids[:paragraph_length])
+
+
+def encode_windows(tokenizer, question_ids, paragraph_ids, paragraph_offsets, max_length, stride):
+    """
+    Assembles the features of `tokenizer(question, paragraph, truncation="only_second", max_length=max_length,
+    stride=stride, return_overflowing_tokens=True, return_offsets_mapping=True)` from the already tokenized question
+    and paragraph.
+
+    Returns one encoding per window of the paragraph, where `offset_mapping` is an int32 `(num_tokens, 2)` array
+    holding -1 for every token that is not part of the paragraph.
+    """
+    question_ids = list(question_ids)
+    paragraph_ids = [int(token_id) for token_id in paragraph_ids]
+    paragraph_offsets = np.asarray(paragraph_offsets, dtype=np.int32).reshape(-1, 2)
+    budget = max_length - len(question_ids) - tokenizer.num_special_tokens_to_add(pair=True)
+    if budget <= 0:
+        raise ValueError(
+            f"The question has {len(question_ids)} tokens, which leaves no room for the paragraph in "
+            f"max_length={max_length}."
+        )
+    if len(paragraph_ids) > budget and stride >= budget:
+        raise ValueError(f"The stride ({stride}) must be smaller than the room left for the paragraph ({budget}).")
+
+    # Number of tokens (question and special tokens) in front of the paragraph.
+    num_prefix = tokenizer.build_inputs_with_special_tokens(question_ids, [-1]).index(-1)
+
+    windows = []
+    start = 0
+    while True:
+        end = min(start + budget, len(paragraph_ids))
+        encoding = _pair_inputs(tokenizer, question_ids, paragraph_ids[start:end])
+        # e.g. [CLS] question [SEP] paragraph [SEP]: only the paragraph tokens keep their offsets.
+        offset_mapping = np.full((len(encoding["input_ids"]), 2), -1, dtype=np.int32)
+        offset_mapping[num_prefix : num_prefix + end - start] = paragraph_offsets[start:end]
+        encoding["offset_mapping"] = offset_mapping
+        windows.append(encoding)
+        if end == len(paragraph_ids):
+            return windows
+        start += budget - stride
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pre-tokenize context.json into a memory-mapped context store")
+    parser.add_argument("--context_file", type=str, required=True, help="context.json")
+    parser.add_argument(
+        "--tokenizer_name", type=str, required=True, help="Pretrained tokenizer name or path (a model directory)."
+    )
+    parser.add_argument("--output_dir", type=str, required=True, help="Where to write the context store.")
+    args = parser.parse_args()
+
+    from transformers import AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_name, use_fast=True)
+    meta = build_context_store(args.context_file, tokenizer, args.output_dir)
+    print(json.dumps(meta, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Dense retrieval of candidate paragraphs from the whole context.json with the backbone of the multiple choice model
+(`--dense_index` of multiple_choice.py and inference.py).
+
+`update_dense_index` encodes the paragraphs (mean-pooled, L2-normalized last hidden states) into a float16 matrix
+that is memory-mapped from disk. A hash of every paragraph is kept next to it, so when context.json gains or changes
+paragraphs only those rows are encoded again; a different encoder re-encodes everything. `DenseIndex` answers a batch
+of query vectors with a matrix product over blocks of paragraphs, keeping a running top-k, or, once
+`build_ivf` has clustered the paragraphs, only over the clusters closest to each query.
+
+    python dense_retrieval.py --model_name_or_path ./HW1_final/multiple_choice --context_file context.json \
+        --output_dir dense_index [--ivf_lists 64]
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+import torch
+
+
+logger = logging.getLogger(__name__)
+
+INDEX_META_FILE = "meta.json"
+EMBEDDINGS_FILE = "embeddings.bin"
+PARAGRAPH_HASHES_FILE = "paragraph_hashes.bin"
+IVF_CENTROIDS_FILE = "ivf_centroids.bin"
+IVF_LISTS_FILE = "ivf_lists.bin"
+IVF_INDEX_FILE = "ivf_index.bin"
+HASH_SIZE = 20
+
+
+def paragraph_hashes(context_list):
+    """The `(num_paragraphs, HASH_SIZE)` uint8 array of the sha1 digests of the paragraphs."""
+    hashes = np.zeros((len(context_list), HASH_SIZE), dtype=np.uint8)
+    for i in range(len(context_list)):
+        hashes[i] = np.frombuffer(hashlib.sha1(context_list[i].encode("utf-8")).digest(), dtype=np.uint8)
+    return hashes
+
+
+def encoder_fingerprint(encoder, tokenizer, max_length):
+    """Hash of everything the vectors depend on: the weights of the encoder, its tokenizer and `max_length`."""
+    if not getattr(tokenizer, "is_fast", False):
+        raise ValueError("The dense index can only be built and used with a fast tokenizer.")
+    sha = hashlib.sha256()
+    for name, tensor in encoder.state_dict().items():
+        sha.update(name.encode("utf-8"))
+        sha.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    # Calling the tokenizer with `truncation`/`padding` stores them in its state, which the vectors do not depend on.
+    state = json.loads(tokenizer.backend_tokenizer.to_str())
+    state.pop("truncation", None)
+    state.pop("padding", None)
+    sha.update(json.dumps(state, sort_keys=True).encode("utf-8"))
+    sha.update(str(max_length).encode("utf-8"))
+    return sha.hexdigest()
+
+
+def encode(texts, encoder, tokenizer, max_length=512, batch_size=32, device=None):
+    """The `(len(texts), hidden_size)` float32 array of the mean-pooled, L2-normalized vectors of `texts`."""
+    device = device if device is not None else next(encoder.parameters()).device
+    vectors = np.zeros((len(texts), encoder.config.hidden_size), dtype=np.float32)
+    # Encoding the texts by length makes the batches nearly free of padding.
+    order = np.argsort([len(text) for text in texts], kind="stable")
+    encoder.eval()
+    for start in range(0, len(texts), batch_size):
+        indices = order[start : start + batch_size]
+        inputs = tokenizer(
+            [texts[i] for i in indices], max_length=max_length, truncation=True, padding=True, return_tensors="pt"
+        ).to(device)
+        with torch.no_grad():
+            hidden_states = encoder(**inputs).last_hidden_state
+        mask = inputs["attention_mask"].unsqueeze(-1).to(hidden_states.dtype)
+        pooled = (hidden_states * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+        vectors[indices] = torch.nn.functional.normalize(pooled, dim=-1).float().cpu().numpy()
+    return vectors
+
+
+def update_dense_index(index_dir, context_list, encoder, tokenizer, max_length=512, batch_size=32, device=None):
+    """
+    Creates or brings up to date the dense index of `context_list` in `index_dir`, encoding only the paragraphs that
+    are new or changed since the last update. Returns the metadata of the index and the number of paragraphs encoded.
+
+    Args:
+        index_dir (:obj:`str`):
+            The directory of the index.
+        context_list (:obj:`list` or :class:`~context_store.ContextStore`):
+            The paragraphs of context.json.
+        encoder (:obj:`transformers.PreTrainedModel`):
+            The backbone of the multiple choice model (e.g. `model.base_model`).
+        tokenizer: The tokenizer of the model.
+        max_length (:obj:`int`, `optional`, defaults to 512):
+            Paragraphs are truncated to this many tokens.
+        batch_size (:obj:`int`, `optional`, defaults to 32):
+            Number of paragraphs encoded at a time.
+        device (:obj:`torch.device`, `optional`):
+            Where to run the encoder, defaults to the device of its weights.
+    """
+    os.makedirs(index_dir, exist_ok=True)
+    meta_file = os.path.join(index_dir, INDEX_META_FILE)
+    hashes_file = os.path.join(index_dir, PARAGRAPH_HASHES_FILE)
+    embeddings_file = os.path.join(index_dir, EMBEDDINGS_FILE)
+    fingerprint = encoder_fingerprint(encoder, tokenizer, max_length)
+    hashes = paragraph_hashes(context_list)
+    num_paragraphs = len(context_list)
+    dim = encoder.config.hidden_size
+
+    meta = None
+    if os.path.exists(meta_file):
+        with open(meta_file, "r") as file:
+            meta = json.load(file)
+    row_size = dim * np.dtype(np.float16).itemsize
+    old_hashes = np.zeros((0, HASH_SIZE), dtype=np.uint8)
+    if meta is not None and meta["encoder_sha256"] != fingerprint:
+        logger.info(f"The dense index in {index_dir} was built with another encoder, encoding everything again.")
+    elif meta is not None and os.path.exists(hashes_file):
+        old_hashes = np.fromfile(hashes_file, dtype=np.uint8).reshape(-1, HASH_SIZE)
+        # An interrupted update may have resized the vectors already, but never below the rows that can be kept.
+        num_reused = min(len(old_hashes), num_paragraphs)
+        embeddings_size = os.path.getsize(embeddings_file) if os.path.exists(embeddings_file) else -1
+        if embeddings_size < num_reused * row_size or embeddings_size % row_size != 0:
+            logger.info(f"The vectors of the dense index in {index_dir} are missing or corrupt, encoding everything.")
+            old_hashes = np.zeros((0, HASH_SIZE), dtype=np.uint8)
+    num_kept = min(len(old_hashes), num_paragraphs)
+    changed = np.flatnonzero(np.any(hashes[:num_kept] != old_hashes[:num_kept], axis=1))
+    rows = np.concatenate([changed, np.arange(num_kept, num_paragraphs)])
+
+    # The existing rows stay where they are: the file only grows (or shrinks) at the end.
+    with open(embeddings_file, "r+b" if len(old_hashes) > 0 else "wb") as file:
+        file.truncate(num_paragraphs * row_size)
+    if len(rows) > 0:
+        embeddings = np.memmap(embeddings_file, dtype=np.float16, mode="r+", shape=(num_paragraphs, dim))
+        chunk_size = 64 * batch_size
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start : start + chunk_size]
+            embeddings[chunk] = encode(
+                [context_list[i] for i in chunk], encoder, tokenizer, max_length, batch_size, device
+            )
+        embeddings.flush()
+        del embeddings
+    # Written after the vectors: rows encoded by an interrupted update are encoded again by the next one.
+    hashes.tofile(hashes_file)
+
+    ivf_lists = meta.get("ivf_lists") if meta is not None else None
+    ivf_stale = len(rows) > 0 or len(old_hashes) != num_paragraphs
+    meta = {
+        "num_paragraphs": num_paragraphs,
+        "dim": dim,
+        "max_length": max_length,
+        "encoder_name_or_path": getattr(encoder, "name_or_path", None),
+        "encoder_sha256": fingerprint,
+        "ivf_lists": ivf_lists,
+    }
+    with open(meta_file, "w") as file:
+        json.dump(meta, file, indent=4)
+    if ivf_lists is not None and ivf_stale:
+        # The clusters are cheap to compute next to the encoding, so they are rebuilt rather than patched.
+        meta = build_ivf(index_dir, ivf_lists)
+    return meta, len(rows)
+
+
+def build_ivf(index_dir, num_lists, num_iterations=10, block_size=16384, seed=0):
+    """
+    Clusters the paragraphs of the index in `index_dir` into `num_lists` lists with spherical k-means, so that
+    `DenseIndex.search_vectors` can score only the lists closest to a query (`nprobe`).
+    """
+    index = DenseIndex(index_dir)
+    num_paragraphs = index.num_paragraphs
+    if num_paragraphs == 0:
+        raise ValueError(f"The dense index in {index_dir} has no paragraphs to cluster.")
+    num_lists = max(1, min(num_lists, num_paragraphs))
+    rng = np.random.default_rng(seed)
+    centroids = index.embeddings[np.sort(rng.choice(num_paragraphs, num_lists, replace=False))].astype(np.float32)
+    assignments = np.zeros(num_paragraphs, dtype=np.int64)
+    for _ in range(num_iterations):
+        sums = np.zeros_like(centroids)
+        for start in range(0, num_paragraphs, block_size):
+            block = index.embeddings[start : start + block_size].astype(np.float32)
+            assignments[start : start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+            np.add.at(sums, assignments[start : start + len(block)], block)
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        # An empty list keeps its centroid.
+        centroids = np.where(norms > 0, sums / np.maximum(norms, 1e-12), centroids)
+
+    lists = np.argsort(assignments, kind="stable").astype(np.int32)
+    list_index = np.zeros(num_lists + 1, dtype=np.int64)
+    np.cumsum(np.bincount(assignments, minlength=num_lists), out=list_index[1:])
+    centroids.tofile(os.path.join(index_dir, IVF_CENTROIDS_FILE))
+    lists.tofile(os.path.join(index_dir, IVF_LISTS_FILE))
+    list_index.tofile(os.path.join(index_dir, IVF_INDEX_FILE))
+
+    meta = dict(index.meta, ivf_lists=num_lists)
+    with open(os.path.join(index_dir, INDEX_META_FILE), "w") as file:
+        json.dump(meta, file, indent=4)
+    return meta
+
+
+def _merge_top_k(scores, ids, top_k):
+    """The `top_k` best `(scores, ids)` of every row, best first (ties broken by the smaller id)."""
+    if scores.shape[1] > top_k:
+        candidates = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+        scores = np.take_along_axis(scores, candidates, axis=1)
+        ids = np.take_along_axis(ids, candidates, axis=1)
+    order = np.lexsort((ids, -scores), axis=1)
+    return np.take_along_axis(scores, order, axis=1), np.take_along_axis(ids, order, axis=1)
+
+
+class DenseIndex:
+    """
+    Read-only view of an index written by `update_dense_index`: the float16 vectors are memory-mapped and converted
+    to float32 block by block when scored.
+
+    Args:
+        index_dir (:obj:`str`):
+            The directory of the index.
+    """
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        with open(os.path.join(index_dir, INDEX_META_FILE), "r") as file:
+            self.meta = json.load(file)
+        self.num_paragraphs = self.meta["num_paragraphs"]
+        if self.num_paragraphs > 0:
+            self.embeddings = np.memmap(
+                os.path.join(index_dir, EMBEDDINGS_FILE),
+                dtype=np.float16,
+                mode="r",
+                shape=(self.num_paragraphs, self.meta["dim"]),
+            )
+        else:
+            self.embeddings = np.zeros((0, self.meta["dim"]), dtype=np.float16)
+        self.centroids = self.lists = self.list_index = None
+        if self.meta.get("ivf_lists") is not None:
+            self.centroids = np.fromfile(os.path.join(index_dir, IVF_CENTROIDS_FILE), dtype=np.float32).reshape(
+                -1, self.meta["dim"]
+            )
+            self.lists = np.fromfile(os.path.join(index_dir, IVF_LISTS_FILE), dtype=np.int32)
+            self.list_index = np.fromfile(os.path.join(index_dir, IVF_INDEX_FILE), dtype=np.int64)
+
+    def search_vectors(self, queries, top_k, nprobe=None, block_size=16384):
+        """
+        Returns the `(len(queries), top_k)` array of the ids of the paragraphs closest to every query vector, best
+        first. With `nprobe` (and an IVF index), only the paragraphs of the `nprobe` closest lists are scored.
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        top_k = min(top_k, self.num_paragraphs)
+        if nprobe is not None and self.centroids is not None:
+            return self._search_ivf(queries, top_k, nprobe)
+
+        best_scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+        best_ids = np.zeros((len(queries), 0), dtype=np.int64)
+        for start in range(0, self.num_paragraphs, block_size):
+            block = self.embeddings[start : start + block_size].astype(np.float32)
+            block_ids = np.broadcast_to(np.arange(start, start + len(block)), (len(queries), len(block)))
+            best_scores, best_ids = _merge_top_k(
+                np.concatenate([best_scores, queries @ block.T], axis=1),
+                np.concatenate([best_ids, block_ids], axis=1),
+                top_k,
+            )
+        return best_ids
+
+    def _search_ivf(self, queries, top_k, nprobe):
+        # The queries are grouped by probed list: every list is read from the memory map once for the whole batch and
+        # scored against all the queries probing it with one matrix product.
+        num_lists = len(self.centroids)
+        nprobe = min(nprobe, num_lists)
+        probes = np.argsort(-(queries @ self.centroids.T), axis=1, kind="stable")
+        # Lists can be small: a query probes more of them until there are enough candidates.
+        probed_sizes = np.cumsum(np.diff(self.list_index)[probes], axis=1)
+        enough = probed_sizes >= top_k
+        num_probed = np.where(enough.any(axis=1), np.argmax(enough, axis=1) + 1, num_lists)
+        num_probed = np.maximum(num_probed, nprobe)
+        probed = np.zeros((len(queries), num_lists), dtype=bool)
+        np.put_along_axis(probed, probes, np.arange(num_lists)[None, :] < num_probed[:, None], axis=1)
+
+        best_scores = np.full((len(queries), top_k), -np.inf, dtype=np.float32)
+        best_ids = np.full((len(queries), top_k), -1, dtype=np.int64)
+        for j in range(num_lists):
+            query_indices = np.flatnonzero(probed[:, j])
+            ids = np.sort(self.lists[self.list_index[j] : self.list_index[j + 1]]).astype(np.int64)
+            if len(query_indices) == 0 or len(ids) == 0:
+                continue
+            scores = queries[query_indices] @ self.embeddings[ids].astype(np.float32).T
+            best_scores[query_indices], best_ids[query_indices] = _merge_top_k(
+                np.concatenate([best_scores[query_indices], scores], axis=1),
+                np.concatenate([best_ids[query_indices], np.broadcast_to(ids, scores.shape)], axis=1),
+                top_k,
+            )
+        return best_ids
+
+
+class DenseRetriever:
+    """
+    Encodes questions with the same encoder as the paragraphs of `index` and searches it, with the `search` interface
+    of `retrieval.BM25Index` (so it can be passed to `retrieval.with_retrieved_paragraphs`).
+    """
+
+    def __init__(self, index, encoder, tokenizer, device=None, nprobe=None):
+        self.index = index
+        self.encoder = encoder
+        self.tokenizer = tokenizer
+        self.device = device
+        self.nprobe = nprobe
+
+    def search(self, questions, top_k, batch_size=256):
+        questions = list(questions)
+        results = np.zeros((len(questions), min(top_k, self.index.num_paragraphs)), dtype=np.int64)
+        for start in range(0, len(questions), batch_size):
+            queries = encode(
+                questions[start : start + batch_size],
+                self.encoder,
+                self.tokenizer,
+                max_length=self.index.meta["max_length"],
+                device=self.device,
+            )
+            results[start : start + len(queries)] = self.index.search_vectors(queries, top_k, nprobe=self.nprobe)
+        return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Encode the paragraphs of context.json into a dense index")
+    parser.add_argument(
+        "--model_name_or_path", type=str, required=True, help="The multiple choice checkpoint whose backbone encodes."
+    )
+    parser.add_argument("--context_file", type=str, required=True, help="context.json")
+    parser.add_argument("--output_dir", type=str, required=True, help="The index to create or update.")
+    parser.add_argument("--max_length", type=int, default=512, help="Paragraphs are truncated to this many tokens.")
+    parser.add_argument("--batch_size", type=int, default=32, help="Number of paragraphs encoded at a time.")
+    parser.add_argument(
+        "--ivf_lists", type=int, default=None, help="If passed, also cluster the paragraphs into this many IVF lists."
+    )
+    args = parser.parse_args()
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO,
+    )
+
+    from transformers import AutoModel, AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model_name_or_path, use_fast=True)
+    encoder = AutoModel.from_pretrained(args.model_name_or_path)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    encoder.to(device)
+    with open(args.context_file, "r") as file:
+        context_list = json.load(file)
+
+    meta, num_encoded = update_dense_index(
+        args.output_dir, context_list, encoder, tokenizer, args.max_length, args.batch_size, device
+    )
+    logger.info(f"Encoded {num_encoded} of {meta['num_paragraphs']} paragraphs into {args.output_dir}.")
+    if args.ivf_lists is not None and meta["ivf_lists"] != args.ivf_lists:
+        meta = build_ivf(args.output_dir, args.ivf_lists)
+    print(json.dumps(meta, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+# coding=utf-8
+"""
+Content-addressed on-disk cache of the tokenized features of multiple_choice.py and QA.py (`--feature_cache_dir`).
+
+The features only depend on the examples, the paragraphs of context.json, the tokenizer and the preprocessing
+settings (`max_seq_length`, `doc_stride`, ...), so `FeatureCache.key` hashes exactly those: changing the output path,
+the batch size or the model weights reuses the features of a previous run and skips the tokenization entirely. Every
+entry is a dataset saved with `save_to_disk` in `<cache_dir>/<key>`, and the least recently used entries are removed
+once the cache grows over its maximum size.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+
+import datasets
+import pyarrow as pa
+
+from context_store import ContextStore, file_sha256
+
+
+logger = logging.getLogger(__name__)
+
+# Bumped whenever the feature creation changes, so that the features of older versions are never loaded.
+FEATURE_CACHE_VERSION = 1
+ENTRY_META_FILE = "feature_cache.json"
+
+
+class _HashWriter:
+    """Write-only file object that hashes what is written to it."""
+
+    def __init__(self):
+        self.sha = hashlib.sha256()
+        self.closed = False
+
+    def write(self, data):
+        self.sha.update(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+def dataset_sha256(dataset):
+    """Hash of the content of `dataset` (its rows in order, after any `select`, and its features)."""
+    # The JSON loader does not always give the columns in the same order, which the features do not depend on.
+    table = dataset.with_format("arrow")[:]
+    table = table.select(sorted(table.column_names)).replace_schema_metadata(None).combine_chunks()
+    writer = _HashWriter()
+    writer.write(json.dumps(dataset.features.to_dict(), sort_keys=True).encode("utf-8"))
+    with pa.ipc.new_stream(pa.PythonFile(writer, mode="w"), table.schema) as stream:
+        stream.write_table(table)
+    return writer.sha.hexdigest()
+
+
+def tokenizer_sha256(tokenizer):
+    """Hash of the serialized fast tokenizer and of the settings the features depend on."""
+    if not getattr(tokenizer, "is_fast", False):
+        raise ValueError("The feature cache can only be used with a fast tokenizer.")
+    # `truncation`/`padding` are only the settings of the last call, which the features do not depend on.
+    state = json.loads(tokenizer.backend_tokenizer.to_str())
+    state.pop("truncation", None)
+    state.pop("padding", None)
+    state["padding_side"] = tokenizer.padding_side
+    return hashlib.sha256(json.dumps(state, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def _directory_size(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+class FeatureCache:
+    """
+    Cache of tokenized features, keyed by the content they are computed from.
+
+    Args:
+        cache_dir (:obj:`str`):
+            The directory of the cache, created if needed. It can be shared by several scripts and runs.
+        max_size (:obj:`int`, `optional`):
+            Maximum size of the cache on disk, in bytes. The least recently used entries are removed when a new entry
+            makes the cache larger than this. No limit if not provided.
+    """
+
+    def __init__(self, cache_dir, max_size=None):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, kind, examples, tokenizer, context_list, context_file=None, **settings):
+        """
+        The key of the features of `examples`, created by `kind` ("multiple_choice", "qa") with `tokenizer` and the
+        paragraphs of `context_list` (a `ContextStore` or the list loaded from `context_file`). `settings` are the
+        other preprocessing arguments the features depend on (`max_seq_length`, `doc_stride`, ...), which must be
+        JSON-serializable.
+        """
+        if isinstance(context_list, ContextStore):
+            context_sha256 = context_list.meta["context_sha256"]
+        elif context_file is not None:
+            context_sha256 = file_sha256(context_file)
+        else:
+            raise ValueError("The feature cache needs the context.json file the paragraphs were loaded from.")
+        parts = {
+            "version": FEATURE_CACHE_VERSION,
+            "kind": kind,
+            "examples_sha256": dataset_sha256(examples),
+            "context_sha256": context_sha256,
+            "tokenizer_sha256": tokenizer_sha256(tokenizer),
+            "settings": settings,
+        }
+        return hashlib.sha256(json.dumps(parts, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def load(self, key):
+        """The cached features of `key`, or `None` if they are not in the cache."""
+        entry_dir = self._entry_dir(key)
+        meta_file = os.path.join(entry_dir, ENTRY_META_FILE)
+        if not os.path.isfile(meta_file):
+            return None
+        features = datasets.load_from_disk(entry_dir)
+        # The modification time of the metadata file is the last use of the entry.
+        os.utime(meta_file)
+        return features
+
+    def save(self, key, features):
+        """Adds `features` to the cache under `key`, then evicts the least recently used entries if needed."""
+        entry_dir = self._entry_dir(key)
+        # Written next to its final location then renamed, so that a partial entry is never loaded.
+        tmp_dir = f"{entry_dir}.tmp-{os.getpid()}"
+        features.save_to_disk(tmp_dir)
+        with open(os.path.join(tmp_dir, ENTRY_META_FILE), "w") as file:
+            json.dump({"num_rows": len(features), "created": time.time()}, file, indent=4)
+        if os.path.isdir(entry_dir) and not os.path.isfile(os.path.join(entry_dir, ENTRY_META_FILE)):
+            # Left over by an interrupted eviction, never loaded without its metadata file.
+            shutil.rmtree(entry_dir, ignore_errors=True)
+        try:
+            os.rename(tmp_dir, entry_dir)
+            logger.info(f"Cached {len(features)} features in {entry_dir}.")
+        except OSError:
+            # Another process has cached the same features in the meantime.
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        self.evict(keep=key)
+
+    def get_or_create(self, key, create_features):
+        """
+        Returns the cached features of `key`, or creates them with `create_features()` and caches them. The features
+        are read back from the cache, so they are memory-mapped in both cases (unless they could not be cached).
+        """
+        features = self.load(key)
+        if features is not None:
+            logger.info(f"Loaded {len(features)} cached features from {self._entry_dir(key)}.")
+            return features
+        features = create_features()
+        self.save(key, features)
+        cached_features = self.load(key)
+        if cached_features is None:
+            logger.warning(f"Could not cache the features in {self._entry_dir(key)}, using them from memory.")
+            return features
+        return cached_features
+
+    def entries(self):
+        """The `(last_used, size, key)` of every entry of the cache, least recently used first."""
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            meta_file = os.path.join(self._entry_dir(key), ENTRY_META_FILE)
+            if os.path.isfile(meta_file):
+                entries.append((os.path.getmtime(meta_file), _directory_size(self._entry_dir(key)), key))
+        return sorted(entries)
+
+    def evict(self, keep=None):
+        """Removes the least recently used entries (never `keep`) until the cache fits in `max_size`."""
+        if self.max_size is None:
+            return
+        entries = self.entries()
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, key in entries:
+            if total_size <= self.max_size:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+            total_size -= size
+            logger.info(f"Evicted the cached features {key} ({size} bytes).")
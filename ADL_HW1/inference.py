@@ -0,0 +1,538 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+End-to-end inference: paragraph selection (multiple choice) followed by span extraction (question answering).
+
+Both models and context.json are loaded once, and the paragraphs chosen by the multiple-choice model are handed to
+the question-answering feature creation in memory, chunk by chunk, instead of going through data.json and a second
+Python process.
+"""
+
+import argparse
+import collections
+import csv
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import datasets
+import numpy as np
+import torch
+from accelerate import Accelerator
+from accelerate.logging import get_logger
+from accelerate.utils import send_to_device
+from datasets import load_dataset
+from tqdm.auto import tqdm
+
+import transformers
+from transformers import (
+    AutoModel,
+    AutoModelForMultipleChoice,
+    AutoModelForQuestionAnswering,
+    AutoTokenizer,
+    DataCollatorWithPadding,
+    default_data_collator,
+)
+
+from batching import make_dataloader
+from context_store import ContextStore
+from dense_retrieval import DenseIndex, DenseRetriever, update_dense_index
+from multiple_choice import (
+    DataCollatorForMultipleChoice,
+    mask_padded_choices,
+    prepare_multiple_choice_features,
+    select_relevant_paragraphs,
+)
+from onnx_export import load_onnx_model
+from pipeline import ThreadLocalCopies, ordered_prefetch
+from QA import (
+    create_and_fill_np_array,
+    postprocess_qa_predictions,
+    prepare_validation_features,
+    remove_postprocess_columns,
+)
+from retrieval import BM25Index, with_retrieved_paragraphs
+
+
+logger = get_logger(__name__)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run paragraph selection and question answering in one process")
+    parser.add_argument("--context_file", type=str, default=None, help="context.json")
+    parser.add_argument(
+        "--context_store",
+        type=str,
+        default=None,
+        help=(
+            "A context store built from context.json by context_store.py, used instead of `--context_file`. Both "
+            "models must share the tokenizer it was built with."
+        ),
+    )
+    parser.add_argument(
+        "--test_file", type=str, required=True, help="A json file with the questions and their candidate paragraphs."
+    )
+    parser.add_argument(
+        "--retrieval_index",
+        type=str,
+        default=None,
+        help=(
+            "A BM25 index of context.json built by retrieval.py. If passed, the candidate paragraphs of every "
+            "question are retrieved from the whole context.json instead of being read from the `paragraphs` column."
+        ),
+    )
+    parser.add_argument(
+        "--retrieval_top_k",
+        type=int,
+        default=4,
+        help="Number of candidate paragraphs retrieved per question with `--retrieval_index` or `--dense_index`.",
+    )
+    parser.add_argument(
+        "--dense_index",
+        type=str,
+        default=None,
+        help=(
+            "A dense index of context.json (dense_retrieval.py), created or brought up to date with the backbone of "
+            "the multiple choice model. If passed, the candidate paragraphs of every question are retrieved from it."
+        ),
+    )
+    parser.add_argument(
+        "--dense_nprobe",
+        type=int,
+        default=None,
+        help="With `--dense_index` built with IVF lists, only score the paragraphs of this many lists per question.",
+    )
+    parser.add_argument("--output_file", type=str, required=True, help="Where to write the `id,answer` csv file.")
+    parser.add_argument(
+        "--mc_model_name_or_path",
+        type=str,
+        default="./HW1_final/multiple_choice",
+        help="Path to the multiple choice (paragraph selection) model.",
+    )
+    parser.add_argument(
+        "--qa_model_name_or_path",
+        type=str,
+        default="./HW1_final/QA",
+        help="Path to the question answering model.",
+    )
+    parser.add_argument(
+        "--mc_max_seq_length",
+        type=int,
+        default=128,
+        help="The maximum total input sequence length of the multiple choice model after tokenization.",
+    )
+    parser.add_argument(
+        "--qa_max_seq_length",
+        type=int,
+        default=384,
+        help="The maximum total input sequence length of the question answering model after tokenization.",
+    )
+    parser.add_argument(
+        "--pad_to_max_length",
+        action="store_true",
+        help="If passed, pad all samples to the maximum length. Otherwise, dynamic padding is used.",
+    )
+    parser.add_argument(
+        "--group_by_length",
+        action="store_true",
+        help="If passed, the features are batched by similar lengths (longest first) to reduce dynamic padding.",
+    )
+    parser.add_argument(
+        "--max_tokens_per_batch",
+        type=int,
+        default=None,
+        help=(
+            "If passed, the features are sorted by length and packed in batches of at most this many padded "
+            "tokens, instead of batches of `per_device_eval_batch_size` features."
+        ),
+    )
+    parser.add_argument(
+        "--runtime",
+        type=str,
+        default="pytorch",
+        choices=["pytorch", "onnx"],
+        help=(
+            "Run the models in PyTorch or, on CPU, their ONNX exports (`model.onnx` in both model directories, see "
+            "onnx_export.py)."
+        ),
+    )
+    parser.add_argument(
+        "--onnx_num_threads",
+        type=int,
+        default=None,
+        help="Number of intra-op threads of ONNX Runtime. Defaults to the number of threads of PyTorch.",
+    )
+    parser.add_argument(
+        "--doc_stride",
+        type=int,
+        default=128,
+        help="When splitting up a long document into chunks how much stride to take between chunks.",
+    )
+    parser.add_argument(
+        "--max_context",
+        action="store_true",
+        help=(
+            "If passed, an answer can only start in the window where its first token has the most context around "
+            "it."
+        ),
+    )
+    parser.add_argument(
+        "--n_best_size",
+        type=int,
+        default=20,
+        help="The total number of n-best predictions to generate when looking for an answer.",
+    )
+    parser.add_argument(
+        "--max_answer_length",
+        type=int,
+        default=30,
+        help=(
+            "The maximum length of an answer that can be generated. This is needed because the start "
+            "and end predictions are not conditioned on one another."
+        ),
+    )
+    parser.add_argument(
+        "--per_device_eval_batch_size",
+        type=int,
+        default=8,
+        help="Batch size (per device) for both models.",
+    )
+    parser.add_argument(
+        "--chunk_size",
+        type=int,
+        default=256,
+        help="Number of questions going through both stages at a time.",
+    )
+    parser.add_argument(
+        "--pipeline",
+        action="store_true",
+        help=(
+            "If passed, the features of the next chunks are created and the answers of the previous ones are "
+            "post-processed in background threads while the models run on the current chunk."
+        ),
+    )
+    parser.add_argument(
+        "--tokenization_workers",
+        type=int,
+        default=2,
+        help="Number of background threads of `--pipeline`.",
+    )
+    parser.add_argument(
+        "--prefetch_chunks",
+        type=int,
+        default=2,
+        help="With `--pipeline`, number of chunks whose multiple choice features are created ahead of the model.",
+    )
+    parser.add_argument(
+        "--dataloader_num_workers",
+        type=int,
+        default=0,
+        help="Number of worker processes collating the batches of the dataloaders (0 for the main process).",
+    )
+    parser.add_argument(
+        "--dataloader_prefetch_factor",
+        type=int,
+        default=2,
+        help="Number of batches collated in advance by each dataloader worker.",
+    )
+    args = parser.parse_args()
+
+    if args.context_file is None and args.context_store is None:
+        raise ValueError("Need either a `--context_file` or a `--context_store`.")
+    if args.retrieval_index is not None and args.dense_index is not None:
+        raise ValueError("Pass either `--retrieval_index` or `--dense_index`, not both.")
+    if args.tokenization_workers < 1 or args.prefetch_chunks < 1:
+        raise ValueError("`--tokenization_workers` and `--prefetch_chunks` must be at least 1.")
+
+    return args
+
+
+def dataloader_worker_kwargs(args):
+    """The `DataLoader` arguments of `--dataloader_num_workers` and `--dataloader_prefetch_factor`."""
+    # The collation runs in worker processes with `--dataloader_num_workers`, ahead of the model.
+    worker_kwargs = {"num_workers": args.dataloader_num_workers}
+    if args.dataloader_num_workers > 0:
+        worker_kwargs["prefetch_factor"] = args.dataloader_prefetch_factor
+    return worker_kwargs
+
+
+def create_mc_features(examples, tokenizer, context_list, args):
+    """The multiple choice features of a chunk of examples."""
+    return examples.map(
+        prepare_multiple_choice_features,
+        fn_kwargs={
+            "tokenizer": tokenizer,
+            "context_list": context_list,
+            "max_seq_length": args.mc_max_seq_length,
+            "padding": "max_length" if args.pad_to_max_length else False,
+        },
+        batched=True,
+        remove_columns=examples.column_names,
+        keep_in_memory=True,
+    )
+
+
+def device_batches(dataloader, accelerator):
+    """
+    Yields the batches of the dataloader of a chunk on the device of `accelerator`. Accelerate keeps a reference to
+    every dataloader it prepares, so on a single process the batches are only moved to the device, and otherwise the
+    prepared dataloader is forgotten once the chunk is done, so that the features of past chunks can be freed.
+    """
+    if accelerator.num_processes == 1:
+        for batch in dataloader:
+            yield send_to_device(batch, accelerator.device)
+        return
+    dataloader = accelerator.prepare(dataloader)
+    try:
+        yield from dataloader
+    finally:
+        if dataloader in accelerator._dataloaders:
+            accelerator._dataloaders.remove(dataloader)
+
+
+def select_paragraphs(examples, features, model, data_collator, accelerator, args):
+    """Runs the multiple choice model on the features of a chunk of examples and returns the chosen paragraph ids."""
+    dataloader, sampler = make_dataloader(
+        features, data_collator, args, accelerator.num_processes, num_rows=True, **dataloader_worker_kwargs(args)
+    )
+
+    predictions_list = []
+    for batch in device_batches(dataloader, accelerator):
+        with torch.no_grad():
+            choice_mask = batch.pop("choice_mask", None)
+            predictions = mask_padded_choices(model(**batch).logits, choice_mask).argmax(dim=-1)
+            predictions_list.append(accelerator.gather_for_metrics(predictions).cpu().numpy())
+
+    predictions = np.concatenate(predictions_list)
+    if sampler is not None:
+        predictions = sampler.restore_order(predictions)
+    selected = select_relevant_paragraphs(examples, predictions)
+    return [output["relevant"] for output in selected]
+
+
+def with_relevant(examples, relevant):
+    """`examples` with their `relevant` column replaced by the chosen paragraph ids."""
+    if "relevant" in examples.column_names:
+        examples = examples.remove_columns("relevant")
+    return examples.add_column("relevant", relevant)
+
+
+def create_qa_features(examples, tokenizer, context_list, args):
+    """The question answering features of a chunk of examples, whose paragraphs have been chosen."""
+    return examples.map(
+        prepare_validation_features,
+        fn_kwargs={
+            "tokenizer": tokenizer,
+            "context_list": context_list,
+            "max_seq_length": min(args.qa_max_seq_length, tokenizer.model_max_length),
+            "doc_stride": args.doc_stride,
+            "pad_on_right": tokenizer.padding_side == "right",
+            "pad_to_max_length": args.pad_to_max_length,
+            "max_context": args.max_context,
+        },
+        batched=True,
+        remove_columns=examples.column_names,
+        keep_in_memory=True,
+    )
+
+
+def predict_spans(features, model, data_collator, accelerator, args):
+    """Runs the question answering model on the features of a chunk and returns the start and end logits."""
+    dataloader, sampler = make_dataloader(
+        remove_postprocess_columns(features),
+        data_collator,
+        args,
+        accelerator.num_processes,
+        **dataloader_worker_kwargs(args),
+    )
+
+    all_start_logits = []
+    all_end_logits = []
+    for batch in device_batches(dataloader, accelerator):
+        with torch.no_grad():
+            outputs = model(**batch)
+            start_logits = outputs.start_logits
+            end_logits = outputs.end_logits
+
+            if not args.pad_to_max_length:  # necessary to pad predictions and labels for being gathered
+                start_logits = accelerator.pad_across_processes(start_logits, dim=1, pad_index=-100)
+                end_logits = accelerator.pad_across_processes(end_logits, dim=1, pad_index=-100)
+
+            all_start_logits.append(accelerator.gather_for_metrics(start_logits).cpu().numpy())
+            all_end_logits.append(accelerator.gather_for_metrics(end_logits).cpu().numpy())
+
+    max_len = max([x.shape[1] for x in all_start_logits])  # Get the max_length of the tensor
+    start_logits_concat = create_and_fill_np_array(all_start_logits, features, max_len)
+    end_logits_concat = create_and_fill_np_array(all_end_logits, features, max_len)
+    if sampler is not None:
+        start_logits_concat = sampler.restore_order(start_logits_concat)
+        end_logits_concat = sampler.restore_order(end_logits_concat)
+    return start_logits_concat, end_logits_concat
+
+
+def answer_questions(examples, features, logits, context_list, args):
+    """Post-processes the logits of a chunk and returns the predicted answers by id."""
+    return postprocess_qa_predictions(
+        examples=examples,
+        features=features,
+        context_list=context_list,
+        predictions=logits,
+        n_best_size=args.n_best_size,
+        max_answer_length=args.max_answer_length,
+    )
+
+
+def main():
+    args = parse_args()
+
+    accelerator = Accelerator()
+
+    # Make one log on every process with the configuration for debugging.
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO,
+    )
+    logger.info(accelerator.state, main_process_only=False)
+    if accelerator.is_local_main_process:
+        datasets.utils.logging.set_verbosity_warning()
+        transformers.utils.logging.set_verbosity_warning()
+    else:
+        datasets.utils.logging.set_verbosity_error()
+        transformers.utils.logging.set_verbosity_error()
+
+    if args.context_store:
+        context_list = ContextStore(args.context_store)
+    else:
+        with open(args.context_file, "r") as file:
+            context_list = json.load(file)
+    test_examples = load_dataset("json", data_files={"test": args.test_file})["test"]
+
+    mc_tokenizer = AutoTokenizer.from_pretrained(args.mc_model_name_or_path, use_fast=True)
+    qa_tokenizer = AutoTokenizer.from_pretrained(args.qa_model_name_or_path, use_fast=True)
+    if args.context_store:
+        context_list.check_tokenizer(mc_tokenizer)
+        context_list.check_tokenizer(qa_tokenizer)
+    if args.runtime == "onnx":
+        mc_model = load_onnx_model(
+            args.mc_model_name_or_path, num_threads=args.onnx_num_threads, device=accelerator.device
+        )
+        qa_model = load_onnx_model(
+            args.qa_model_name_or_path, num_threads=args.onnx_num_threads, device=accelerator.device
+        )
+    else:
+        mc_model = AutoModelForMultipleChoice.from_pretrained(args.mc_model_name_or_path)
+        qa_model = AutoModelForQuestionAnswering.from_pretrained(args.qa_model_name_or_path)
+        mc_model, qa_model = accelerator.prepare(mc_model, qa_model)
+    mc_model.eval()
+    qa_model.eval()
+
+    retriever = None
+    if args.retrieval_index is not None:
+        retriever = BM25Index(args.retrieval_index)
+        retriever.check_context(context_list, args.context_file)
+    elif args.dense_index is not None:
+        if args.runtime == "onnx":
+            encoder = AutoModel.from_pretrained(args.mc_model_name_or_path).to(accelerator.device)
+        else:
+            encoder = accelerator.unwrap_model(mc_model).base_model
+        dense_meta, num_encoded = update_dense_index(
+            args.dense_index, context_list, encoder, mc_tokenizer, device=accelerator.device
+        )
+        logger.info(f"Dense index: encoded {num_encoded} of {dense_meta['num_paragraphs']} paragraphs.")
+        retriever = DenseRetriever(
+            DenseIndex(args.dense_index), encoder, mc_tokenizer, device=accelerator.device, nprobe=args.dense_nprobe
+        )
+    if retriever is not None:
+        test_examples = with_retrieved_paragraphs(test_examples, retriever, args.retrieval_top_k)
+
+    if args.pad_to_max_length:
+        mc_collator = default_data_collator
+        qa_collator = default_data_collator
+    else:
+        pad_to_multiple_of = 8 if accelerator.use_fp16 else None
+        mc_collator = DataCollatorForMultipleChoice(mc_tokenizer, pad_to_multiple_of=pad_to_multiple_of)
+        qa_collator = DataCollatorWithPadding(qa_tokenizer, pad_to_multiple_of=pad_to_multiple_of)
+
+    logger.info("***** Running inference *****")
+    logger.info(f"  Num examples = {len(test_examples)}")
+    logger.info(f"  Chunk size = {args.chunk_size}")
+
+    chunks = [
+        test_examples.select(range(chunk_start, min(chunk_start + args.chunk_size, len(test_examples))))
+        for chunk_start in range(0, len(test_examples), args.chunk_size)
+    ]
+    progress_bar = tqdm(total=len(chunks), disable=not accelerator.is_main_process)
+    start_time = time.time()
+
+    # The answers are written chunk by chunk, as soon as they are known.
+    csvfile = None
+    if accelerator.is_main_process:
+        csvfile = open(args.output_file, "w", newline="", encoding="utf-8")
+        writer = csv.DictWriter(csvfile, fieldnames=["id", "answer"])
+        writer.writeheader()
+
+    def write_answers(predictions):
+        if progress_bar.n == 0:
+            logger.info(f"  First answers after {time.time() - start_time:.1f}s")
+        progress_bar.update(1)
+        if csvfile is not None:
+            for example_id, answer in predictions.items():
+                writer.writerow({"id": example_id, "answer": answer})
+            csvfile.flush()
+
+    if not args.pipeline:
+        for examples in chunks:
+            features = create_mc_features(examples, mc_tokenizer, context_list, args)
+            relevant = select_paragraphs(examples, features, mc_model, mc_collator, accelerator, args)
+            examples = with_relevant(examples, relevant)
+            features = create_qa_features(examples, qa_tokenizer, context_list, args)
+            logits = predict_spans(features, qa_model, qa_collator, accelerator, args)
+            write_answers(answer_questions(examples, features, logits, context_list, args))
+    else:
+        mc_tokenizers = ThreadLocalCopies(mc_tokenizer)
+        qa_tokenizers = ThreadLocalCopies(qa_tokenizer)
+        with ThreadPoolExecutor(max_workers=args.tokenization_workers) as executor:
+            # The multiple choice features of the next `--prefetch_chunks` chunks are created ahead of the model, the
+            # question answering features of a chunk while the multiple choice model runs on the next one, and the
+            # answers are post-processed while the models run on the next chunks.
+            all_mc_features = ordered_prefetch(
+                executor,
+                lambda examples: create_mc_features(examples, mc_tokenizers.get(), context_list, args),
+                chunks,
+                args.prefetch_chunks,
+            )
+            pending_answers = collections.deque()
+
+            def answer_chunk(examples, features):
+                features = features.result()
+                logits = predict_spans(features, qa_model, qa_collator, accelerator, args)
+                pending_answers.append(
+                    executor.submit(answer_questions, examples, features, logits, context_list, args)
+                )
+
+            previous_chunk = None
+            for examples, features in zip(chunks, all_mc_features):
+                relevant = select_paragraphs(examples, features, mc_model, mc_collator, accelerator, args)
+                examples = with_relevant(examples, relevant)
+                qa_features = executor.submit(
+                    lambda examples: create_qa_features(examples, qa_tokenizers.get(), context_list, args), examples
+                )
+                if previous_chunk is not None:
+                    answer_chunk(*previous_chunk)
+                previous_chunk = (examples, qa_features)
+                while pending_answers and pending_answers[0].done():
+                    write_answers(pending_answers.popleft().result())
+            if previous_chunk is not None:
+                answer_chunk(*previous_chunk)
+            while pending_answers:
+                write_answers(pending_answers.popleft().result())
+
+    progress_bar.close()
+    if csvfile is not None:
+        csvfile.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -17,7 +17,6 @@ from accelerate.logging import get_logger
 from accelerate.utils import set_seed
 from datasets import load_dataset
 from huggingface_hub import Repository, create_repo
-from torch.utils.data import DataLoader
 from tqdm.auto import tqdm
 import numpy as np
 
@@ -26,6 +25,7 @@ from transformers import (
     CONFIG_MAPPING,
     MODEL_MAPPING,
     AutoConfig,
+    AutoModel,
     AutoModelForMultipleChoice,
     AutoTokenizer,
     PreTrainedTokenizerBase,
@@ -35,6 +35,15 @@ from transformers import (
 )
 from transformers.utils import PaddingStrategy, check_min_version, send_example_telemetry
 
+from batching import make_dataloader
+from context_store import ContextStore, encode_pair
+from dense_retrieval import DenseIndex, DenseRetriever, update_dense_index
+from feature_cache import FeatureCache
+from onnx_export import load_onnx_model
+from prerank import CascadeSelection, LexicalPreRanker
+from quantization import quantization_report, quantize_dynamic_int8
+from retrieval import BM25Index, retrieval_recall, with_retrieved_paragraphs
+
 
 # Will error if the minimal version of Transformers is not installed. Remove at your own risks.
 # check_min_version("4.35.0.dev0")
@@ -84,6 +93,94 @@ def parse_args():
         action="store_true",
         help="If passed, pad all samples to `max_length`. Otherwise, dynamic padding is used.",
     )
+    parser.add_argument(
+        "--preprocessing_num_workers",
+        type=int,
+        default=None,
+        help="The number of processes to use for the preprocessing.",
+    )
+    parser.add_argument(
+        "--group_by_length",
+        action="store_true",
+        help=(
+            "If passed, the test features are batched by similar lengths (longest first) to reduce dynamic padding, "
+            "and the predictions are put back in dataset order."
+        ),
+    )
+    parser.add_argument(
+        "--max_tokens_per_batch",
+        type=int,
+        default=None,
+        help=(
+            "If passed, the features are sorted by length and packed in batches of at most this many padded "
+            "tokens, instead of batches of `per_device_eval_batch_size` features."
+        ),
+    )
+    parser.add_argument(
+        "--runtime",
+        type=str,
+        default="pytorch",
+        choices=["pytorch", "onnx"],
+        help="Run the model in PyTorch or, on CPU, the ONNX export of the checkpoint (see onnx_export.py).",
+    )
+    parser.add_argument(
+        "--onnx_file",
+        type=str,
+        default=None,
+        help="The ONNX model used with `--runtime onnx`. Defaults to `model.onnx` in `model_name_or_path`.",
+    )
+    parser.add_argument(
+        "--onnx_num_threads",
+        type=int,
+        default=None,
+        help="Number of intra-op threads of ONNX Runtime. Defaults to the number of threads of PyTorch.",
+    )
+    parser.add_argument(
+        "--cascade_margin",
+        type=float,
+        default=None,
+        help=(
+            "If passed, a lexical pre-ranker scores the candidate paragraphs first (scores in [0, 1]), and only the "
+            "questions whose best candidate leads the second by less than this margin go through the model."
+        ),
+    )
+    parser.add_argument(
+        "--cascade_compare",
+        action="store_true",
+        help=(
+            "With `--cascade_margin` and a labeled test file, the model also scores the questions decided by the "
+            "pre-ranker, and its accuracy on all the questions is logged next to the one of the cascade (for "
+            "evaluation: the model then runs on every question)."
+        ),
+    )
+    parser.add_argument(
+        "--quantize",
+        type=str,
+        default=None,
+        choices=["dynamic-int8"],
+        help=(
+            "If passed, the Linear layers run in int8 on CPU (see `--quantize_compare` to compare the results with "
+            "the fp32 model)."
+        ),
+    )
+    parser.add_argument(
+        "--quantize_compare",
+        action="store_true",
+        help=(
+            "With `--quantize`, the fp32 model also runs on the test file and the number of unchanged predictions "
+            "is logged, with the accuracy of both models when the file is labeled (for evaluation: this doubles "
+            "the cost of inference)."
+        ),
+    )
+    parser.add_argument(
+        "--quantize_cache_dir",
+        type=str,
+        default=None,
+        help=(
+            "With `--quantize` and a local `model_name_or_path`, directory where the int8 weights of the checkpoint "
+            "are cached, so that later runs skip their quantization."
+        ),
+    )
     parser.add_argument(
         "--model_name_or_path",
         type=str,
@@ -103,6 +200,61 @@ def parse_args():
         default=None,
         help="context.json",
     )
+    parser.add_argument(
+        "--context_store",
+        type=str,
+        default=None,
+        help=(
+            "A context store built from context.json by context_store.py. If passed, the paragraphs are sliced from "
+            "its pre-tokenized arrays instead of being tokenized again, and `--context_file` is not needed."
+        ),
+    )
+    parser.add_argument(
+        "--feature_cache_dir",
+        type=str,
+        default=None,
+        help=(
+            "If passed, the tokenized features are cached in this directory, keyed by the content of the examples, "
+            "context.json, the tokenizer and the preprocessing arguments, and reused by the next runs (of this script "
+            "or QA.py) instead of tokenizing again."
+        ),
+    )
+    parser.add_argument(
+        "--feature_cache_max_gb",
+        type=float,
+        default=10.0,
+        help="Maximum size of `--feature_cache_dir` on disk, the least recently used features are removed beyond it.",
+    )
+    parser.add_argument(
+        "--retrieval_index",
+        type=str,
+        default=None,
+        help=(
+            "A BM25 index of context.json built by retrieval.py. If passed, the candidate paragraphs of every "
+            "question are retrieved from the whole context.json instead of being read from the `paragraphs` column."
+        ),
+    )
+    parser.add_argument(
+        "--retrieval_top_k",
+        type=int,
+        default=4,
+        help="Number of candidate paragraphs retrieved per question with `--retrieval_index` or `--dense_index`.",
+    )
+    parser.add_argument(
+        "--dense_index",
+        type=str,
+        default=None,
+        help=(
+            "A dense index of context.json (dense_retrieval.py), created or brought up to date with the backbone of "
+            "the multiple choice model. If passed, the candidate paragraphs of every question are retrieved from it."
+        ),
+    )
+    parser.add_argument(
+        "--dense_nprobe",
+        type=int,
+        default=None,
+        help="With `--dense_index` built with IVF lists, only score the paragraphs of this many lists per question.",
+    )
 
     parser.add_argument(
         "--tokenizer_name",
@@ -222,6 +374,17 @@ def parse_args():
     # args = parser.parse_args(args_string.split())
     args = parser.parse_args()
 
+    if args.retrieval_index is not None and args.dense_index is not None:
+        raise ValueError("Pass either `--retrieval_index` or `--dense_index`, not both.")
+
+    if args.quantize is not None and args.runtime == "onnx":
+        raise ValueError("`--quantize` quantizes the PyTorch model and cannot be used with `--runtime onnx`.")
+    if args.quantize_compare and args.quantize is None:
+        raise ValueError("`--quantize_compare` needs `--quantize`.")
+
+    if args.cascade_compare and args.cascade_margin is None:
+        raise ValueError("`--cascade_compare` needs `--cascade_margin`.")
+
     if args.push_to_hub:
         assert args.output_dir is not None, "Need an `output_dir` to create a repo when `--push_to_hub` is passed."
 
@@ -231,7 +394,9 @@ def parse_args():
 @dataclass
 class DataCollatorForMultipleChoice:
     """
-    Data collator that will dynamically pad the inputs for multiple choice received.
+    Data collator that will dynamically pad the inputs for multiple choice received. When the examples of a batch
+    have different numbers of choices, a boolean `choice_mask` of shape `(batch_size, num_choices)` marks the real
+    ones; it has to be popped from the batch before calling the model (see `mask_padded_choices`).
 
     Args:
         tokenizer ([`PreTrainedTokenizer`] or [`PreTrainedTokenizerFast`]):
@@ -265,9 +430,19 @@ class DataCollatorForMultipleChoice:
 
         # labels = [feature.pop(label_name) for feature in features]
         batch_size = len(features)
-        num_choices = len(features[0]["input_ids"])
+        # At least one choice per question, so that a batch of questions without candidates still has a shape.
+        num_choices = max(max(len(feature["input_ids"]) for feature in features), 1)
+        # Questions with fewer candidates are completed with empty choices, masked out by `choice_mask`. They hold a
+        # single (attention-masked) pad token, so that the padded sequences are never empty.
+        empty_choice = {"input_ids": [self.tokenizer.pad_token_id], "attention_mask": [0]}
+        if "token_type_ids" in features[0]:
+            empty_choice["token_type_ids"] = [0]
         flattened_features = [
-            [{k: v[i] for k, v in feature.items()} for i in range(num_choices)] for feature in features
+            [
+                {k: v[i] for k, v in feature.items()} if i < len(feature["input_ids"]) else empty_choice
+                for i in range(num_choices)
+            ]
+            for feature in features
         ]
         flattened_features = list(chain(*flattened_features))
 
@@ -281,15 +456,115 @@ class DataCollatorForMultipleChoice:
 
         # Un-flatten
         batch = {k: v.view(batch_size, num_choices, -1) for k, v in batch.items()}
+        if any(len(feature["input_ids"]) < num_choices for feature in features):
+            batch["choice_mask"] = torch.tensor(
+                [[i < len(feature["input_ids"]) for i in range(num_choices)] for feature in features]
+            )
         # Add back labels
         # batch["labels"] = torch.tensor(labels, dtype=torch.int64)
         return batch
 
 
+def mask_padded_choices(logits, choice_mask):
+    """Gives the choices added by `DataCollatorForMultipleChoice` to complete a batch a logit of `-inf`."""
+    if choice_mask is None:
+        return logits
+    return logits.masked_fill(~choice_mask, float("-inf"))
+
+
+def prepare_multiple_choice_features(examples, tokenizer, context_list, max_seq_length, padding=False):
+    """
+    Tokenizes every question with each of its candidate paragraphs and groups the encodings per question. The number
+    of candidate paragraphs may differ from one question to another.
+
+    Args:
+        examples: A batch of examples with the `question` and `paragraphs` columns.
+        tokenizer ([`PreTrainedTokenizer`] or [`PreTrainedTokenizerFast`]):
+            The tokenizer used for encoding the data. A fast tokenizer encodes each question and each distinct
+            paragraph only once.
+        context_list: The paragraphs of context.json, indexed by the ids found in `paragraphs`. With a
+            `ContextStore`, the pre-tokenized paragraphs are used instead of tokenizing the text again.
+        max_seq_length (`int`):
+            The maximum total input sequence length after tokenization.
+        padding (`bool` or `str`, *optional*, defaults to `False`):
+            The padding strategy passed to the tokenizer.
+    """
+    questions = examples["question"]
+    paragraphs = examples["paragraphs"]
+    num_choices = [len(indices) for indices in paragraphs]
+
+    if tokenizer.is_fast:
+        # Encode every question and every distinct paragraph of the batch once, then assemble the pairs (special
+        # tokens, truncation, token type ids) from the cached pieces.
+        question_ids = tokenizer(questions, add_special_tokens=False)["input_ids"]
+        if isinstance(context_list, ContextStore):
+            paragraph_ids = context_list.token_ids
+        else:
+            unique_indices = list(dict.fromkeys(index for indices in paragraphs for index in indices))
+            unique_paragraphs = [context_list[index] for index in unique_indices]
+            unique_ids = tokenizer(unique_paragraphs, add_special_tokens=False)["input_ids"]
+            paragraph_ids = dict(zip(unique_indices, unique_ids)).__getitem__
+        encodings = [
+            encode_pair(tokenizer, question_ids[i], paragraph_ids(index), max_seq_length)
+            for i, indices in enumerate(paragraphs)
+            for index in indices
+        ]
+        if encodings:
+            tokenized_examples = {k: [encoding[k] for encoding in encodings] for k in encodings[0]}
+            if padding:
+                tokenized_examples = tokenizer.pad(tokenized_examples, padding=padding, max_length=max_seq_length)
+        else:
+            # No question of the batch has a candidate paragraph: every question gets no choice.
+            keys = ["input_ids", "attention_mask"]
+            if "token_type_ids" in tokenizer.model_input_names:
+                keys.append("token_type_ids")
+            tokenized_examples = {k: [] for k in keys}
+    else:
+        # Create question-paragraph pairs
+        first_sentences = [[question] * n for question, n in zip(questions, num_choices)]
+        first_sentences = list(chain(*first_sentences))
+        second_sentences = [context_list[index] for indices in paragraphs for index in indices]
+
+        # Tokenize
+        tokenized_examples = tokenizer(
+            first_sentences,
+            second_sentences,
+            max_length=max_seq_length,
+            padding=padding,
+            truncation=True,
+        )
+
+    # Un-flatten: each question keeps as many choices as it has candidate paragraphs.
+    boundaries = np.cumsum([0] + num_choices).tolist()
+    return {
+        k: [v[start:end] for start, end in zip(boundaries[:-1], boundaries[1:])] for k, v in tokenized_examples.items()
+    }
+
+
+def select_relevant_paragraphs(examples, predictions):
+    """
+    Maps the predicted choice of every example back to the id of the chosen paragraph.
+
+    Returns a list of `{"id", "relevant", "question"}` dicts, the format of the `data.json` file read by QA.py.
+    """
+    output_list = []
+    if len(predictions) != len(examples):
+        raise ValueError(f"Got {len(predictions)} predictions and {len(examples)} features.")
+    for example_index, example in enumerate(tqdm(examples)):
+        output_dist = {}
+        output_dist["id"] = example["id"]
+        output_dist["relevant"] = example["paragraphs"][predictions[example_index]]
+        output_dist["question"] = example["question"]
+        output_list.append(output_dist)
+    return output_list
+
+
 def main():
     args = parse_args()
 
-    if args.context_file:
+    if args.context_store:
+        context_list = ContextStore(args.context_store)
+    elif args.context_file:
         with open(args.context_file, 'r') as file:
             context_list = json.load(file)
 
@@ -413,7 +688,13 @@ def main():
             "You can do it from another script, save it, and load it from here, using --tokenizer_name."
         )
 
-    if args.model_name_or_path:
+    if args.runtime == "onnx":
+        # Only the ONNX export runs, so the PyTorch checkpoint is never loaded (but for the backbone of the dense
+        # retriever, below).
+        model = load_onnx_model(
+            args.model_name_or_path, args.onnx_file, num_threads=args.onnx_num_threads, device=accelerator.device
+        )
+    elif args.model_name_or_path:
         model = AutoModelForMultipleChoice.from_pretrained(
             args.model_name_or_path,
             from_tf=bool(".ckpt" in args.model_name_or_path),
@@ -424,90 +705,86 @@ def main():
         logger.info("Training new model from scratch")
         model = AutoModelForMultipleChoice.from_config(config, trust_remote_code=args.trust_remote_code)
 
+    if args.context_store:
+        context_list.check_tokenizer(tokenizer)
+
+    # First stage: retrieve the candidate paragraphs from the whole context.json.
+    retriever = None
+    if args.retrieval_index is not None:
+        retriever = BM25Index(args.retrieval_index)
+        retriever.check_context(context_list, args.context_file)
+    elif args.dense_index is not None:
+        if args.runtime == "onnx":
+            encoder = AutoModel.from_pretrained(args.model_name_or_path).to(accelerator.device)
+        else:
+            encoder = model.base_model.to(accelerator.device)
+        dense_meta, num_encoded = update_dense_index(
+            args.dense_index, context_list, encoder, tokenizer, device=accelerator.device
+        )
+        logger.info(f"Dense index: encoded {num_encoded} of {dense_meta['num_paragraphs']} paragraphs.")
+        retriever = DenseRetriever(
+            DenseIndex(args.dense_index), encoder, tokenizer, device=accelerator.device, nprobe=args.dense_nprobe
+        )
+    if retriever is not None:
+        raw_datasets["test"] = with_retrieved_paragraphs(raw_datasets["test"], retriever, args.retrieval_top_k)
+        if "relevant" in raw_datasets["test"].column_names:
+            recall = retrieval_recall(raw_datasets["test"]["paragraphs"], raw_datasets["test"]["relevant"])
+            logger.info(f"Retrieval recall@{args.retrieval_top_k}: {recall:.2%}.")
+
     # We resize the embeddings only when necessary to avoid index errors. If you are creating a model from scratch
     # on a small vocab and want a smaller embedding size, remove this test.
-    embedding_size = model.get_input_embeddings().weight.shape[0]
-    if len(tokenizer) > embedding_size:
-        model.resize_token_embeddings(len(tokenizer))
+    if args.runtime == "pytorch":
+        embedding_size = model.get_input_embeddings().weight.shape[0]
+        if len(tokenizer) > embedding_size:
+            model.resize_token_embeddings(len(tokenizer))
+
+    cascade = None
+    test_examples = raw_datasets["test"]
+    if args.cascade_margin is not None:
+        # Cascaded selection: the model only scores the questions the pre-ranker is not confident about.
+        if args.cascade_compare and "relevant" not in column_names:
+            raise ValueError("`--cascade_compare` needs a test file with the `relevant` paragraphs.")
+        pre_ranker = LexicalPreRanker(context_list, chain.from_iterable(test_examples["paragraphs"]))
+        choices, margins = pre_ranker.rank(test_examples["question"], test_examples["paragraphs"])
+        cascade = CascadeSelection(
+            choices, margins, args.cascade_margin, [len(paragraphs) for paragraphs in test_examples["paragraphs"]]
+        )
+        if not args.cascade_compare:
+            test_examples = test_examples.select(cascade.model_indices)
 
     # Preprocessing the datasets.
     # First we tokenize all the texts.
     padding = "max_length" if args.pad_to_max_length else False
 
-    # newOAO
     def preprocess_function(examples):
-        # print("#####")
-        # print(examples)
-        # print("#####")
-
-        # Extract relevant paragraph indices
-        # relevant_paragraph_indices = examples["relevant"]
-        # print(relevant_paragraph_indices)
-
-        # Extract questions and paragraphs from the context JSON
-        questions = examples["question"]
-        paragraphs = examples["paragraphs"]
-        # labels = examples["relavant"]
-
-        # Create question-paragraph pairs with relevant labels
-
-        first_sentences = [[question] * 4 for question in questions]
-
-        # first_sentences = [[context] * 4 for context in examples[context_name]]
-        # question_headers = examples[question_header_name]
-        # second_sentences = [
-        #     [f"{header} {examples[end][i]}" for end in ending_names] for i, header in enumerate(question_headers)
-        # ]
-        # labels = examples[label_column_name]
-
-        # # Flatten out
-        first_sentences = list(chain(*first_sentences))
-        # second_sentences = list(chain(*second_sentences))
-
-        second_sentences = [context_list[index] for indices in paragraphs for index in indices]
-        # print(second_sentences[0:4])
-
-        # labels = []
-        # j = 0
-        # for sublist in paragraphs:
-        #   for i in range(len(sublist)):
-        #     # print(sublist)
-        #     if sublist[i] == relevant_paragraph_indices[j]:
-        #       labels.append(i)
-        #       break
-        #   j=j+1
-        # print("######################labels######################: ",labels)
-
-        # Tokenize
-        tokenized_examples = tokenizer(
-            first_sentences,
-            second_sentences,
-            max_length=args.max_seq_length,
-            padding=padding,
-            truncation=True,
+        return prepare_multiple_choice_features(examples, tokenizer, context_list, args.max_seq_length, padding)
+
+    def create_features():
+        return test_examples.map(
+            preprocess_function,
+            batched=True,
+            num_proc=args.preprocessing_num_workers,
+            remove_columns=test_examples.column_names,
         )
 
-        tokenized_inputs = {
-            "input_ids": tokenized_examples["input_ids"],
-            "attention_mask": tokenized_examples["attention_mask"],
-        }
-        tokenized_inputs = {k: [v[i : i + 4] for i in range(0, len(v), 4)] for k, v in tokenized_examples.items()}
-        # raw_datasets["labels"] = labels
-        # tokenized_inputs["labels"] = labels
-        return tokenized_inputs
-
     with accelerator.main_process_first():
-        processed_datasets = raw_datasets.map(
-            preprocess_function, batched=True, remove_columns=raw_datasets["test"].column_names
-        )
-
-    # print(processed_datasets)
-    # train_dataset = processed_datasets["train"]
-    # eval_dataset = processed_datasets["validation"]
-    test_dataset = processed_datasets["test"]
+        if args.feature_cache_dir is not None:
+            feature_cache = FeatureCache(args.feature_cache_dir, max_size=int(args.feature_cache_max_gb * 1024**3))
+            key = feature_cache.key(
+                "multiple_choice",
+                test_examples,
+                tokenizer,
+                context_list,
+                args.context_file,
+                max_seq_length=args.max_seq_length,
+                pad_to_max_length=args.pad_to_max_length,
+            )
+            test_dataset = feature_cache.get_or_create(key, create_features)
+        else:
+            test_dataset = create_features()
 
     # Log a few random samples from the training set:
-    for index in random.sample(range(len(test_dataset)), 3):
+    for index in random.sample(range(len(test_dataset)), min(3, len(test_dataset))):
         logger.info(f"Sample {index} of the training set: {test_dataset[index]}.")
 
     # DataLoaders creation:
@@ -527,7 +804,9 @@ def main():
     #     train_dataset, shuffle=True, collate_fn=data_collator, batch_size=args.per_device_train_batch_size
     # )
     # eval_dataloader = DataLoader(eval_dataset, collate_fn=data_collator, batch_size=args.per_device_eval_batch_size)
-    test_dataloader = DataLoader(test_dataset, collate_fn=data_collator, batch_size=args.per_device_eval_batch_size)
+    test_dataloader, test_sampler = make_dataloader(
+        test_dataset, data_collator, args, accelerator.num_processes, num_rows=True
+    )
     # test_dataloader = DataLoader(test_dataset, batch_size=args.per_device_eval_batch_size)
 
     # Optimizer
@@ -547,7 +826,8 @@ def main():
 
     # # Use the device given by the `accelerator` object.
     device = accelerator.device
-    model.to(device)
+    if args.runtime == "pytorch":
+        model.to(device)
 
     # Scheduler and math around the number of training steps.
     # overrode_max_train_steps = False
@@ -564,9 +844,19 @@ def main():
     # )
 
     # Prepare everything with our `accelerator`.
-    model, test_dataloader = accelerator.prepare(
-        model, test_dataloader
-    )
+    if args.runtime == "onnx":
+        test_dataloader = accelerator.prepare(test_dataloader)
+    else:
+        model, test_dataloader = accelerator.prepare(model, test_dataloader)
+    if args.quantize == "dynamic-int8":
+        if accelerator.device.type != "cpu":
+            raise ValueError(
+                f"`--quantize dynamic-int8` runs on CPU, but the accelerator device is {accelerator.device}."
+            )
+        fp32_model = model if args.quantize_compare else None
+        model = quantize_dynamic_int8(
+            accelerator.unwrap_model(model), args.model_name_or_path, args.quantize_cache_dir
+        )
 
     # # We need to recalculate our total training steps as the size of the training dataloader may have changed.
     # num_update_steps_per_epoch = math.ceil(len(train_dataloader) / args.gradient_accumulation_steps)
@@ -639,18 +929,75 @@ def main():
     # progress_bar.update(completed_steps)
 
 
-    predictions_list = []
-
-    ### predict
-    model.eval()
-    for step, batch in enumerate(test_dataloader):
-        with torch.no_grad():
-            outputs = model(**batch)
-            predictions = outputs.logits.argmax(dim=-1)
-            predictions_list.append(accelerator.gather_for_metrics(predictions).cpu().numpy())
-            # print(predictions)
+    def predict(model):
+        predictions_list = []
+
+        ### predict
+        model.eval()
+        # With `--cascade_margin`, the pre-ranker may have decided every question.
+        for step, batch in enumerate(test_dataloader if len(test_dataset) > 0 else []):
+            with torch.no_grad():
+                choice_mask = batch.pop("choice_mask", None)
+                outputs = model(**batch)
+                predictions = mask_padded_choices(outputs.logits, choice_mask).argmax(dim=-1)
+                predictions_list.append(accelerator.gather_for_metrics(predictions).cpu().numpy())
+                # print(predictions)
+
+        if len(predictions_list) == 0:
+            predictions_list_concat = np.zeros(0, dtype=np.int64)
+        else:
+            predictions_list_concat = np.concatenate(predictions_list)
+            if test_sampler is not None:
+                predictions_list_concat = test_sampler.restore_order(predictions_list_concat)
+        return predictions_list_concat
+
+    def cascade_predictions(model_predictions):
+        if cascade is None:
+            return model_predictions
+        if args.cascade_compare:
+            # The model has scored every question, the cascade only keeps its choices on the undecided ones.
+            model_predictions = model_predictions[cascade.model_indices]
+        return cascade.merge(model_predictions)
+
+    model_predictions = predict(model)
+    predictions_list_concat = cascade_predictions(model_predictions)
+
+    if cascade is not None:
+        labels = None
+        if "relevant" in column_names:
+            # -1 when the relevant paragraph was not retrieved (`--retrieval_index`, `--dense_index`).
+            labels = [
+                paragraphs.index(relevant) if relevant in paragraphs else -1
+                for paragraphs, relevant in zip(raw_datasets["test"]["paragraphs"], raw_datasets["test"]["relevant"])
+            ]
+        logger.info(
+            cascade.summary(
+                predictions_list_concat, labels, model_predictions=model_predictions if args.cascade_compare else None
+            )
+        )
 
-    predictions_list_concat = np.concatenate(predictions_list)
+    if args.quantize_compare:
+        fp32_predictions = cascade_predictions(predict(fp32_model))
+        accuracy = fp32_accuracy = None
+        if "relevant" in column_names:
+            # Accuracy of the chosen paragraphs when the test file is labeled (e.g. valid.json).
+            relevant = np.array(raw_datasets["test"]["relevant"])
+            paragraphs = raw_datasets["test"]["paragraphs"]
+            accuracy = 100.0 * np.mean(
+                [paragraphs[i][choice] for i, choice in enumerate(predictions_list_concat)] == relevant
+            )
+            fp32_accuracy = 100.0 * np.mean(
+                [paragraphs[i][choice] for i, choice in enumerate(fp32_predictions)] == relevant
+            )
+        logger.info(
+            quantization_report(
+                "accuracy",
+                accuracy,
+                fp32_accuracy,
+                int(np.sum(predictions_list_concat == fp32_predictions)),
+                len(predictions_list_concat),
+            )
+        )
 
             # if not args.pad_to_max_length:  # necessary to pad predictions and labels for being gathered
             #     start_logits = accelerator.pad_across_processes(start_logits, dim=1, pad_index=-100)
@@ -660,20 +1007,7 @@ def main():
             # all_end_logits.append(accelerator.gather_for_metrics(end_logits).cpu().numpy())
     ###
 
-    def post_processing(examples, predictions):
-        output_list = []
-        if len(predictions) != len(examples):
-            raise ValueError(f"Got {len(predictions[0])} predictions and {len(examples)} features.")
-        for example_index, example in enumerate(tqdm(examples)):
-            # print(example)
-            output_dist = {}
-            output_dist["id"] = example["id"]
-            output_dist["relevant"] = example["paragraphs"][predictions[example_index]]
-            output_dist["question"] = example["question"]
-            output_list.append(output_dist)
-        return output_list
-
-    predict_dict = post_processing(raw_datasets["test"], predictions_list_concat)
+    predict_dict = select_relevant_paragraphs(raw_datasets["test"], predictions_list_concat)
     # print(predict_dict)
 
     with open(args.output_dir + "/data.json", "w") as json_file:
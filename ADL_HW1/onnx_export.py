@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+ONNX export of the multiple choice and question answering models, and the ONNX Runtime model the scripts use with
+`--runtime onnx`.
+
+The export traces a trained checkpoint with dynamic batch, choice and sequence axes, lets ONNX Runtime apply its
+portable graph optimizations (constant folding, redundant node elimination) and saves the result next to the
+checkpoint, then checks the ONNX logits against the PyTorch ones:
+
+    python onnx_export.py --model_name_or_path ./HW1_final/multiple_choice --task multiple-choice
+    python onnx_export.py --model_name_or_path ./HW1_final/QA --task question-answering
+
+`OnnxModel` runs such a file on CPU and is called like the PyTorch model, returning the same output class.
+"""
+
+import argparse
+import inspect
+import logging
+import os
+
+import numpy as np
+import torch
+from transformers import AutoModelForMultipleChoice, AutoModelForQuestionAnswering, AutoTokenizer
+from transformers.modeling_outputs import MultipleChoiceModelOutput, QuestionAnsweringModelOutput
+
+
+logger = logging.getLogger(__name__)
+
+ONNX_FILE_NAME = "model.onnx"
+
+TASKS = {
+    "multiple-choice": (AutoModelForMultipleChoice, ["logits"]),
+    "question-answering": (AutoModelForQuestionAnswering, ["start_logits", "end_logits"]),
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Export a multiple choice or question answering model to ONNX")
+    parser.add_argument("--model_name_or_path", type=str, required=True, help="Path to the trained checkpoint.")
+    parser.add_argument("--task", type=str, required=True, choices=list(TASKS.keys()), help="The head of the model.")
+    parser.add_argument(
+        "--output_file",
+        type=str,
+        default=None,
+        help=f"Where to write the ONNX model. Defaults to `{ONNX_FILE_NAME}` in the checkpoint directory.",
+    )
+    parser.add_argument("--opset", type=int, default=14, help="The ONNX opset version.")
+    parser.add_argument(
+        "--atol", type=float, default=1e-4, help="Largest difference allowed between the ONNX and PyTorch logits."
+    )
+    return parser.parse_args()
+
+
+def default_onnx_path(model_name_or_path):
+    return os.path.join(model_name_or_path, ONNX_FILE_NAME)
+
+
+def load_onnxruntime():
+    try:
+        import onnxruntime
+    except ImportError:
+        raise ImportError("`--runtime onnx` needs ONNX Runtime: `pip install onnxruntime`.")
+    return onnxruntime
+
+
+class _PositionalWrapper(torch.nn.Module):
+    """Calls the model with keyword inputs given positionally and returns its logits as a tuple, for the tracer."""
+
+    def __init__(self, model, input_names, output_names):
+        super().__init__()
+        self.model = model
+        self.input_names = input_names
+        self.output_names = output_names
+
+    def forward(self, *inputs):
+        outputs = self.model(**dict(zip(self.input_names, inputs)))
+        return tuple(outputs[name] for name in self.output_names)
+
+
+def dummy_inputs(tokenizer, task, batch_size=2, num_choices=3):
+    """Tokenized inputs of a small batch, shaped the way the data collator of `task` shapes them."""
+    questions = ["第一個問題?", "另一個比較長的問題是什麼?"][:batch_size]
+    paragraphs = ["這是一個段落。" * 4, "這是另一個段落。" * 2][:batch_size]
+    if task == "multiple-choice":
+        inputs = tokenizer(
+            [question for question in questions for _ in range(num_choices)],
+            [paragraph for paragraph in paragraphs for _ in range(num_choices)],
+            padding=True,
+            return_tensors="pt",
+        )
+        return {name: tensor.view(batch_size, num_choices, -1) for name, tensor in inputs.items()}
+    return dict(tokenizer(questions, paragraphs, padding=True, return_tensors="pt"))
+
+
+def export_onnx(model, tokenizer, task, output_file, opset=14):
+    """
+    Exports `model` (a `task` head) to `output_file` with dynamic batch/choice/sequence axes, then saves the graph
+    optimized by ONNX Runtime in its place. Returns the input names of the ONNX model.
+    """
+    output_names = TASKS[task][1]
+    inputs = dummy_inputs(tokenizer, task)
+    input_names = [name for name in tokenizer.model_input_names if name in inputs]
+    if task == "multiple-choice":
+        input_axes = {0: "batch", 1: "choice", 2: "sequence"}
+        output_axes = {"logits": {0: "batch", 1: "choice"}}
+    else:
+        input_axes = {0: "batch", 1: "sequence"}
+        output_axes = {name: {0: "batch", 1: "sequence"} for name in output_names}
+
+    export_kwargs = {}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        # The TorchScript exporter, which handles `dynamic_axes`.
+        export_kwargs["dynamo"] = False
+    # The exporter puts the module back in the mode it had, so the wrapper has to be in eval mode too.
+    wrapper = _PositionalWrapper(model, input_names, output_names).eval()
+    with torch.no_grad():
+        torch.onnx.export(
+            wrapper,
+            tuple(inputs[name] for name in input_names),
+            output_file,
+            input_names=input_names,
+            output_names=output_names,
+            dynamic_axes={**{name: input_axes for name in input_names}, **output_axes},
+            opset_version=opset,
+            do_constant_folding=True,
+            **export_kwargs,
+        )
+
+    # Only the basic optimizations are saved: they do not depend on the hardware, the session applies the others.
+    onnxruntime = load_onnxruntime()
+    options = onnxruntime.SessionOptions()
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC
+    options.optimized_model_filepath = output_file
+    onnxruntime.InferenceSession(output_file, options, providers=["CPUExecutionProvider"])
+    return input_names
+
+
+class OnnxModel:
+    """
+    An ONNX model exported by `export_onnx`, run with ONNX Runtime on CPU. Called with the batches of the data
+    collator (PyTorch tensors), it returns a `MultipleChoiceModelOutput` or `QuestionAnsweringModelOutput` of CPU
+    tensors, so the prediction loops do not change.
+
+    Args:
+        onnx_file (:obj:`str`):
+            The exported model.
+        num_threads (:obj:`int`, `optional`):
+            The number of intra-op threads, defaults to the one of PyTorch (`torch.get_num_threads()`).
+    """
+
+    def __init__(self, onnx_file, num_threads=None):
+        onnxruntime = load_onnxruntime()
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+        # A BERT forward is a chain of large matmuls: all the threads go to the ops, none to running ops in parallel.
+        options.intra_op_num_threads = num_threads if num_threads is not None else torch.get_num_threads()
+        options.inter_op_num_threads = 1
+        self.session = onnxruntime.InferenceSession(onnx_file, options, providers=["CPUExecutionProvider"])
+        self.input_names = [node.name for node in self.session.get_inputs()]
+        self.output_names = [node.name for node in self.session.get_outputs()]
+        if self.output_names == TASKS["multiple-choice"][1]:
+            self.output_class = MultipleChoiceModelOutput
+        else:
+            self.output_class = QuestionAnsweringModelOutput
+
+    def eval(self):
+        return self
+
+    def __call__(self, **inputs):
+        missing = [name for name in self.input_names if name not in inputs]
+        if missing:
+            raise ValueError(f"The ONNX model needs the inputs {missing}, which are not in the batch.")
+        feed = {name: inputs[name].cpu().numpy() for name in self.input_names}
+        outputs = self.session.run(self.output_names, feed)
+        return self.output_class(
+            **{name: torch.from_numpy(output) for name, output in zip(self.output_names, outputs)}
+        )
+
+
+def load_onnx_model(model_name_or_path, onnx_file=None, num_threads=None, device=None):
+    """The `OnnxModel` of a checkpoint, for `--runtime onnx`. Defaults to the file written by `export_onnx`."""
+    if device is not None and torch.device(device).type != "cpu":
+        raise ValueError(f"`--runtime onnx` runs on CPU, but the accelerator device is {device}.")
+    onnx_file = onnx_file or default_onnx_path(model_name_or_path)
+    if not os.path.exists(onnx_file):
+        raise FileNotFoundError(
+            f"No ONNX model at {onnx_file}: export it first with `python onnx_export.py --model_name_or_path "
+            f"{model_name_or_path} --task ...`."
+        )
+    return OnnxModel(onnx_file, num_threads=num_threads)
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO,
+    )
+
+    model_class, output_names = TASKS[args.task]
+    tokenizer = AutoTokenizer.from_pretrained(args.model_name_or_path, use_fast=True)
+    model = model_class.from_pretrained(args.model_name_or_path)
+    model.eval()
+    output_file = args.output_file or default_onnx_path(args.model_name_or_path)
+
+    export_onnx(model, tokenizer, args.task, output_file, opset=args.opset)
+    logger.info(f"Exported {args.model_name_or_path} to {output_file}.")
+
+    # Check the exported model on a batch of another shape than the traced one.
+    inputs = dummy_inputs(tokenizer, args.task, batch_size=1, num_choices=2)
+    with torch.no_grad():
+        expected = model(**inputs)
+    actual = OnnxModel(output_file)(**inputs)
+    max_diff = max(float(np.max(np.abs(expected[name].numpy() - actual[name].numpy()))) for name in output_names)
+    if max_diff > args.atol:
+        raise ValueError(f"The ONNX logits differ from the PyTorch ones by {max_diff} (more than {args.atol}).")
+    logger.info(f"Largest difference with the PyTorch logits: {max_diff}.")
+
+
+if __name__ == "__main__":
+    main()
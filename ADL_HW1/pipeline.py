@@ -0,0 +1,43 @@
+# coding=utf-8
+"""
+Helpers of the pipelined execution of inference.py (`--pipeline`).
+
+The questions go through the models chunk by chunk. With the pipeline, the feature creation of the next chunks and the
+post-processing of the previous ones run in a pool of threads while the models run on the current chunk: the fast
+tokenizers and the models release the GIL, so the stages overlap on a CPU with spare cores, and the first answers are
+available after one chunk instead of after the tokenization of the whole dataset.
+"""
+
+import collections
+import copy
+import threading
+
+
+class ThreadLocalCopies:
+    """
+    Gives every thread its own deep copy of `obj`. A fast tokenizer cannot be called from two threads at once, since
+    every call sets its truncation and padding state.
+    """
+
+    def __init__(self, obj):
+        self.obj = obj
+        self._local = threading.local()
+
+    def get(self):
+        if not hasattr(self._local, "obj"):
+            self._local.obj = copy.deepcopy(self.obj)
+        return self._local.obj
+
+
+def ordered_prefetch(executor, fn, items, max_pending):
+    """
+    Yields `fn(item)` for every item of `items`, in order. The calls run on `executor`, at most `max_pending` of them
+    ahead of the consumer, which bounds the memory taken by the results waiting to be consumed.
+    """
+    pending = collections.deque()
+    for item in items:
+        pending.append(executor.submit(fn, item))
+        if len(pending) > max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
@@ -0,0 +1,133 @@
+# coding=utf-8
+"""
+Lexical pre-ranking of the candidate paragraphs, for the cascaded paragraph selection of multiple_choice.py
+(`--cascade_margin`).
+
+`LexicalPreRanker` scores every candidate of a question by the IDF-weighted share of the question's character
+n-grams found in the paragraph, which needs no model and no tokenizer. When the best candidate leads the second by at
+least the margin, it is taken as is; only the other questions go through the multiple choice model.
+`CascadeSelection` keeps track of which questions were decided by the pre-ranker and merges the two predictions.
+"""
+
+import math
+
+import numpy as np
+
+
+def char_ngrams(text, ngram_range=(1, 2)):
+    """The set of character n-grams of `text` (whitespace removed), for n in `ngram_range` (inclusive)."""
+    text = "".join(text.split())
+    ngrams = set()
+    for n in range(ngram_range[0], ngram_range[1] + 1):
+        ngrams.update(text[i : i + n] for i in range(len(text) - n + 1))
+    return ngrams
+
+
+class LexicalPreRanker:
+    """
+    Scores questions against their candidate paragraphs with character n-grams.
+
+    Args:
+        context_list (:obj:`list` or :class:`~context_store.ContextStore`):
+            The paragraphs, indexed by paragraph id.
+        paragraph_ids (iterable of :obj:`int`):
+            The paragraphs the document frequencies are counted on (usually every candidate of the dataset).
+        ngram_range (:obj:`tuple`, `optional`, defaults to :obj:`(1, 2)`):
+            The smallest and largest n-grams.
+    """
+
+    def __init__(self, context_list, paragraph_ids, ngram_range=(1, 2)):
+        self.ngram_range = ngram_range
+        self.paragraph_ngrams = {}
+        document_frequency = {}
+        for paragraph_id in set(paragraph_ids):
+            ngrams = char_ngrams(context_list[paragraph_id], ngram_range)
+            self.paragraph_ngrams[paragraph_id] = ngrams
+            for ngram in ngrams:
+                document_frequency[ngram] = document_frequency.get(ngram, 0) + 1
+        num_paragraphs = len(self.paragraph_ngrams)
+        self.idf = {
+            ngram: math.log((num_paragraphs - frequency + 0.5) / (frequency + 0.5) + 1.0)
+            for ngram, frequency in document_frequency.items()
+        }
+
+    def score(self, question, paragraph_ids):
+        """The scores (in [0, 1]) of the candidates `paragraph_ids` of `question`."""
+        # n-grams found in none of the paragraphs cannot tell the candidates apart: they get no weight.
+        weights = {ngram: self.idf.get(ngram, 0.0) for ngram in char_ngrams(question, self.ngram_range)}
+        total = sum(weights.values())
+        scores = np.zeros(len(paragraph_ids))
+        if total == 0:
+            return scores
+        for i, paragraph_id in enumerate(paragraph_ids):
+            paragraph_ngrams = self.paragraph_ngrams[paragraph_id]
+            scores[i] = sum(weight for ngram, weight in weights.items() if ngram in paragraph_ngrams) / total
+        return scores
+
+    def rank(self, questions, candidates):
+        """
+        Returns the `(choices, margins)` arrays: the index of the best candidate of every question and its lead over
+        the second best (1.0 when there is a single candidate). A question without candidates gets a margin of
+        `-inf`, so that it is always left to the multiple choice model.
+        """
+        choices = np.zeros(len(questions), dtype=np.int64)
+        margins = np.zeros(len(questions))
+        for i, (question, paragraph_ids) in enumerate(zip(questions, candidates)):
+            if len(paragraph_ids) == 0:
+                margins[i] = -np.inf
+                continue
+            scores = self.score(question, paragraph_ids)
+            order = np.argsort(-scores, kind="stable")
+            choices[i] = order[0]
+            margins[i] = scores[order[0]] - scores[order[1]] if len(scores) > 1 else 1.0
+        return choices, margins
+
+
+class CascadeSelection:
+    """
+    The questions decided by the pre-ranker (`margins >= margin`) and the ones left to the multiple choice model,
+    whose dataset indices are `model_indices`.
+    """
+
+    def __init__(self, choices, margins, margin, num_choices):
+        self.choices = np.asarray(choices)
+        self.confident = np.asarray(margins) >= margin
+        self.model_indices = np.flatnonzero(~self.confident)
+        self.num_choices = np.asarray(num_choices)
+
+    def merge(self, model_predictions):
+        """The choice of every question: the model's for `model_indices`, the pre-ranker's for the others."""
+        model_predictions = np.asarray(model_predictions)
+        if len(model_predictions) != len(self.model_indices):
+            raise ValueError(f"Got {len(model_predictions)} predictions for {len(self.model_indices)} questions.")
+        predictions = self.choices.copy()
+        predictions[self.model_indices] = model_predictions
+        return predictions
+
+    def summary(self, predictions=None, labels=None, model_predictions=None):
+        """
+        One-line description of the cascade, for the logs. With the gold choices `labels`, also gives the accuracy of
+        the `predictions` and of the pre-ranker on the questions it decided, and the accuracy of the model alone when
+        `model_predictions` has its choices for every question.
+        """
+        num_skipped = int(np.sum(self.confident))
+        skipped_choices = int(np.sum(self.num_choices[self.confident]))
+        total_choices = int(np.sum(self.num_choices))
+        report = (
+            f"Cascaded selection: {num_skipped} of {len(self.confident)} questions decided by the pre-ranker "
+            f"({num_skipped / max(len(self.confident), 1):.1%}), {skipped_choices} of {total_choices} choices not "
+            f"scored by the model ({skipped_choices / max(total_choices, 1):.1%})"
+        )
+        if predictions is not None and labels is not None:
+            labels = np.asarray(labels)
+            accuracy = np.mean(np.asarray(predictions) == labels)
+            report += f", accuracy {accuracy:.2%}"
+            if num_skipped > 0:
+                skipped_accuracy = np.mean(self.choices[self.confident] == labels[self.confident])
+                report += f" (pre-ranker accuracy on its questions {skipped_accuracy:.2%})"
+            if model_predictions is not None:
+                model_accuracy = np.mean(np.asarray(model_predictions) == labels)
+                report += f", model-only accuracy {model_accuracy:.2%}"
+            else:
+                report += ", model-only accuracy not measured"
+        return report + "."
@@ -0,0 +1,110 @@
+# coding=utf-8
+"""
+Dynamic int8 quantization of the multiple choice and question answering models for CPU inference (`--quantize
+dynamic-int8`).
+
+The weights of the `nn.Linear` layers are stored in int8 and the activations are quantized on the fly, batch by
+batch, so no calibration data is needed. With `--quantize_cache_dir`, the state dict of the quantized model is cached
+under a key made of the checkpoint path and the names, sizes and modification times of its weight files. A later run
+swaps the `nn.Linear` layers for empty int8 ones and loads the cached weights into them (with `weights_only=True`, so
+no pickled code is ever run), which skips the quantization of the weights. The cache is only used with the version of
+PyTorch it was written with.
+"""
+
+import copy
+import hashlib
+import json
+import logging
+import os
+
+import torch
+
+
+logger = logging.getLogger(__name__)
+
+WEIGHT_FILE_SUFFIXES = (".bin", ".safetensors")
+
+
+def checkpoint_fingerprint(model_name_or_path):
+    """Hash of the path of a checkpoint directory and of the names, sizes and modification times of its weights."""
+    model_name_or_path = os.path.abspath(model_name_or_path)
+    files = []
+    for name in sorted(os.listdir(model_name_or_path)):
+        if name.endswith(WEIGHT_FILE_SUFFIXES):
+            stat = os.stat(os.path.join(model_name_or_path, name))
+            files.append([name, stat.st_size, stat.st_mtime_ns])
+    return hashlib.sha256(json.dumps([model_name_or_path, files]).encode("utf-8")).hexdigest()
+
+
+def _quantize(model):
+    return torch.ao.quantization.quantize_dynamic(model.cpu().eval(), {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def _int8_skeleton(model):
+    """
+    Copy of `model` whose `nn.Linear` layers (the ones `quantize_dynamic` swaps) are replaced by int8 dynamic ones
+    with empty weights, to load the state dict of a quantized model into.
+    """
+    skeleton = copy.deepcopy(model).cpu().eval()
+    linear_names = [name for name, module in skeleton.named_modules() if type(module) is torch.nn.Linear]
+    for name in linear_names:
+        parent_name, _, child_name = name.rpartition(".")
+        linear = skeleton.get_submodule(name)
+        setattr(
+            skeleton.get_submodule(parent_name),
+            child_name,
+            torch.ao.nn.quantized.dynamic.Linear(
+                linear.in_features, linear.out_features, bias_=linear.bias is not None, dtype=torch.qint8
+            ),
+        )
+    return skeleton
+
+
+def quantize_dynamic_int8(model, model_name_or_path=None, cache_dir=None):
+    """
+    Returns a copy of `model` (left in fp32) with its `nn.Linear` layers dynamically quantized to int8. With a
+    `cache_dir` and a local `model_name_or_path`, the quantized weights are read from (or written to)
+    `<cache_dir>/<checkpoint_fingerprint>.pt`.
+    """
+    if cache_dir is None or model_name_or_path is None or not os.path.isdir(model_name_or_path):
+        return _quantize(model)
+
+    fingerprint = checkpoint_fingerprint(model_name_or_path)
+    cache_file = os.path.join(cache_dir, f"{fingerprint}.pt")
+    if os.path.exists(cache_file):
+        try:
+            cached = torch.load(cache_file, map_location="cpu", weights_only=True)
+        except Exception as error:
+            cached = None
+            logger.warning(f"Could not read {cache_file} ({error}), quantizing the model again.")
+        if cached is not None and cached.get("torch_version") == torch.__version__:
+            quantized_model = _int8_skeleton(model)
+            quantized_model.load_state_dict(cached["state_dict"])
+            logger.info(f"Loaded the int8 weights from {cache_file}.")
+            return quantized_model
+        if cached is not None:
+            logger.info(f"{cache_file} was written by another version of PyTorch, quantizing the model again.")
+
+    quantized_model = _quantize(model)
+    # Written to a temporary file first, so that an interrupted run never leaves a truncated cache entry.
+    tmp_file = f"{cache_file}.tmp{os.getpid()}"
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        torch.save({"torch_version": torch.__version__, "state_dict": quantized_model.state_dict()}, tmp_file)
+        os.replace(tmp_file, cache_file)
+        logger.info(f"Saved the int8 weights to {cache_file}.")
+    except OSError as error:
+        logger.warning(f"Could not write the int8 weights to {cache_dir} ({error}), they are not cached.")
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+    return quantized_model
+
+
+def quantization_report(metric_name, quantized_score, fp32_score, num_unchanged, num_predictions):
+    """One-line comparison of the int8 model with the fp32 one, for the logs."""
+    report = f"Dynamic int8 quantization: {num_unchanged} of {num_predictions} predictions unchanged"
+    if quantized_score is not None:
+        report += (
+            f", {metric_name} {quantized_score:.2f} (fp32 {fp32_score:.2f}, delta {quantized_score - fp32_score:+.2f})"
+        )
+    return report + "."
@@ -0,0 +1,257 @@
+# coding=utf-8
+"""
+BM25 retrieval of candidate paragraphs from the whole context.json, for questions that do not come with their
+`paragraphs` (`--retrieval_index` of multiple_choice.py and inference.py).
+
+`build_bm25_index` indexes the character n-grams of every paragraph (Chinese needs no word segmentation this way) and
+writes an inverted index to a directory: the posting lists are flat arrays of paragraph ids (int32) and of their
+precomputed BM25 term weights (float16), cut by term. The terms found in at least a third of the paragraphs (the
+most common characters) are stored as dense float16 rows of weights instead, which take no more room than their
+postings would. `BM25Index` maps the index back and scores a batch of questions at once: the dense rows of their
+common n-grams are summed by a matrix product, and the postings of the others are accumulated into the same
+`(batch, num_paragraphs)` score matrix.
+
+    python retrieval.py --context_file context.json --output_dir bm25_index
+"""
+
+import argparse
+import json
+import os
+from collections import Counter
+
+import numpy as np
+
+from context_store import ContextStore, file_sha256
+from prerank import char_ngrams
+
+
+INDEX_META_FILE = "meta.json"
+VOCAB_FILE = "vocab.json"
+POSTINGS_INDEX_FILE = "postings_index.bin"
+POSTINGS_PARAGRAPHS_FILE = "postings_paragraphs.bin"
+POSTINGS_WEIGHTS_FILE = "postings_weights.bin"
+DENSE_TERMS_FILE = "dense_terms.bin"
+DENSE_WEIGHTS_FILE = "dense_weights.bin"
+
+
+def char_ngram_counts(text, ngram_range=(1, 2)):
+    """The counts of the character n-grams of `text` (whitespace removed), for n in `ngram_range` (inclusive)."""
+    text = "".join(text.split())
+    counts = Counter()
+    for n in range(ngram_range[0], ngram_range[1] + 1):
+        counts.update(text[i : i + n] for i in range(len(text) - n + 1))
+    return counts, len(text)
+
+
+def build_bm25_index(context_file, index_dir, ngram_range=(1, 2), k1=1.2, b=0.75):
+    """
+    Indexes every paragraph of `context_file` and writes the BM25 inverted index to `index_dir`.
+
+    Args:
+        context_file (:obj:`str`):
+            Path to context.json (a json list of paragraphs).
+        index_dir (:obj:`str`):
+            The directory to write the index to.
+        ngram_range (:obj:`tuple`, `optional`, defaults to :obj:`(1, 2)`):
+            The smallest and largest character n-grams.
+        k1 (:obj:`float`, `optional`, defaults to 1.2):
+            Term frequency saturation of BM25.
+        b (:obj:`float`, `optional`, defaults to 0.75):
+            Length normalization of BM25 (paragraph lengths in characters).
+    """
+    with open(context_file, "r") as file:
+        context_list = json.load(file)
+
+    vocab = {}
+    term_ids = []
+    term_frequencies = []
+    lengths = np.zeros(len(context_list), dtype=np.float64)
+    for paragraph_id, paragraph in enumerate(context_list):
+        counts, lengths[paragraph_id] = char_ngram_counts(paragraph, ngram_range)
+        term_ids.append(np.fromiter((vocab.setdefault(term, len(vocab)) for term in counts), dtype=np.int32))
+        term_frequencies.append(np.fromiter(counts.values(), dtype=np.float64))
+    num_postings = np.array([len(ids) for ids in term_ids], dtype=np.int64)
+    paragraph_ids = np.repeat(np.arange(len(context_list), dtype=np.int32), num_postings)
+    term_ids = np.concatenate(term_ids) if term_ids else np.zeros(0, dtype=np.int32)
+    term_frequencies = np.concatenate(term_frequencies) if term_frequencies else np.zeros(0)
+
+    num_paragraphs = len(context_list)
+    document_frequency = np.bincount(term_ids, minlength=len(vocab))
+    average_length = float(lengths.mean()) if num_paragraphs else 0.0
+    idf = np.log((num_paragraphs - document_frequency + 0.5) / (document_frequency + 0.5) + 1.0)
+    length_norm = k1 * (1.0 - b + b * lengths / max(average_length, 1.0))
+    weights = idf[term_ids] * term_frequencies * (k1 + 1.0) / (term_frequencies + length_norm[paragraph_ids])
+
+    # A dense float16 row (2 bytes per paragraph) is no bigger than the postings (6 bytes each) of such a term.
+    dense_terms = np.flatnonzero(3 * document_frequency >= num_paragraphs).astype(np.int32)
+    dense_rows = np.full(len(vocab), -1, dtype=np.int64)
+    dense_rows[dense_terms] = np.arange(len(dense_terms))
+    in_dense = dense_rows[term_ids] >= 0
+    dense_weights = np.zeros((len(dense_terms), num_paragraphs), dtype=np.float16)
+    dense_weights[dense_rows[term_ids[in_dense]], paragraph_ids[in_dense]] = weights[in_dense]
+    term_ids, paragraph_ids, weights = term_ids[~in_dense], paragraph_ids[~in_dense], weights[~in_dense]
+
+    # Postings of a term are contiguous and sorted by paragraph id.
+    order = np.argsort(term_ids, kind="stable")
+    term_ids, paragraph_ids, weights = term_ids[order], paragraph_ids[order], weights[order]
+    postings_index = np.zeros(len(vocab) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(term_ids, minlength=len(vocab)), out=postings_index[1:])
+
+    os.makedirs(index_dir, exist_ok=True)
+    with open(os.path.join(index_dir, VOCAB_FILE), "w", encoding="utf-8") as file:
+        json.dump(list(vocab), file, ensure_ascii=False)
+    postings_index.tofile(os.path.join(index_dir, POSTINGS_INDEX_FILE))
+    paragraph_ids.tofile(os.path.join(index_dir, POSTINGS_PARAGRAPHS_FILE))
+    weights.astype(np.float16).tofile(os.path.join(index_dir, POSTINGS_WEIGHTS_FILE))
+    dense_terms.tofile(os.path.join(index_dir, DENSE_TERMS_FILE))
+    dense_weights.tofile(os.path.join(index_dir, DENSE_WEIGHTS_FILE))
+    meta = {
+        "num_paragraphs": num_paragraphs,
+        "num_terms": len(vocab),
+        "num_postings": int(postings_index[-1]),
+        "num_dense_terms": len(dense_terms),
+        "ngram_range": list(ngram_range),
+        "k1": k1,
+        "b": b,
+        "average_length": average_length,
+        "context_sha256": file_sha256(context_file),
+    }
+    with open(os.path.join(index_dir, INDEX_META_FILE), "w") as file:
+        json.dump(meta, file, indent=4)
+    return meta
+
+
+class BM25Index:
+    """
+    Read-only view of an index written by `build_bm25_index`: the postings are memory-mapped, the dense rows of the
+    common terms are loaded in float32 for the matrix product.
+
+    Args:
+        index_dir (:obj:`str`):
+            The directory of the index.
+    """
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        with open(os.path.join(index_dir, INDEX_META_FILE), "r") as file:
+            self.meta = json.load(file)
+        with open(os.path.join(index_dir, VOCAB_FILE), "r", encoding="utf-8") as file:
+            self.vocab = {term: term_id for term_id, term in enumerate(json.load(file))}
+        self.ngram_range = tuple(self.meta["ngram_range"])
+        self.num_paragraphs = self.meta["num_paragraphs"]
+        num_postings = self.meta["num_postings"]
+        self._postings_index = np.fromfile(os.path.join(index_dir, POSTINGS_INDEX_FILE), dtype=np.int64)
+        # Empty files cannot be memory-mapped.
+        if num_postings > 0:
+            self._paragraphs = np.memmap(
+                os.path.join(index_dir, POSTINGS_PARAGRAPHS_FILE), dtype=np.int32, mode="r", shape=(num_postings,)
+            )
+            self._weights = np.memmap(
+                os.path.join(index_dir, POSTINGS_WEIGHTS_FILE), dtype=np.float16, mode="r", shape=(num_postings,)
+            )
+        else:
+            self._paragraphs = np.zeros(0, dtype=np.int32)
+            self._weights = np.zeros(0, dtype=np.float16)
+        dense_terms = np.fromfile(os.path.join(index_dir, DENSE_TERMS_FILE), dtype=np.int32)
+        self._dense_rows = np.full(self.meta["num_terms"], -1, dtype=np.int64)
+        self._dense_rows[dense_terms] = np.arange(len(dense_terms))
+        self._dense_weights = (
+            np.fromfile(os.path.join(index_dir, DENSE_WEIGHTS_FILE), dtype=np.float16)
+            .astype(np.float32)
+            .reshape(len(dense_terms), self.num_paragraphs)
+        )
+
+    def check_context(self, context_list, context_file=None):
+        """
+        Raises an error if the index was not built from the paragraphs of `context_list`, a `ContextStore` or the
+        list loaded from `context_file`.
+        """
+        if isinstance(context_list, ContextStore):
+            context_sha256 = context_list.meta["context_sha256"]
+        else:
+            context_sha256 = file_sha256(context_file)
+        if context_sha256 != self.meta["context_sha256"]:
+            raise ValueError(
+                f"The retrieval index in {self.index_dir} was not built from this context.json. Rebuild it with "
+                "`python retrieval.py`."
+            )
+
+    def _query_terms(self, question):
+        return [self.vocab[term] for term in char_ngrams(question, self.ngram_range) if term in self.vocab]
+
+    def scores(self, questions):
+        """The `(len(questions), num_paragraphs)` float32 matrix of the BM25 scores of every paragraph."""
+        query_terms = [self._query_terms(question) for question in questions]
+        rows = np.repeat(np.arange(len(questions)), [len(terms) for terms in query_terms])
+        terms = np.fromiter((term for terms in query_terms for term in terms), dtype=np.int64, count=len(rows))
+
+        dense_rows = self._dense_rows[terms]
+        is_dense = dense_rows >= 0
+        term_matrix = np.zeros((len(questions), len(self._dense_weights)), dtype=np.float32)
+        term_matrix[rows[is_dense], dense_rows[is_dense]] = 1.0
+        scores = term_matrix @ self._dense_weights
+
+        rows, terms = rows[~is_dense], terms[~is_dense]
+        starts = self._postings_index[terms]
+        lengths = self._postings_index[terms + 1] - starts
+        # Positions of every posting of every (question, term) pair, without a Python loop over the terms.
+        offsets = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+        positions = np.arange(int(lengths.sum()), dtype=np.int64) + offsets
+        cells = np.repeat(rows, lengths) * self.num_paragraphs + self._paragraphs[positions]
+        sparse_scores = np.bincount(
+            cells, weights=self._weights[positions], minlength=len(questions) * self.num_paragraphs
+        )
+        scores += sparse_scores.reshape(len(questions), self.num_paragraphs)
+        return scores
+
+    def search(self, questions, top_k, batch_size=256):
+        """
+        Returns the `(len(questions), top_k)` array of the ids of the best paragraphs of every question, best first
+        (ties broken by the smaller id).
+        """
+        top_k = min(top_k, self.num_paragraphs)
+        results = np.zeros((len(questions), top_k), dtype=np.int64)
+        if top_k == 0:
+            return results
+        for start in range(0, len(questions), batch_size):
+            scores = self.scores(questions[start : start + batch_size])
+            candidates = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+            candidate_scores = np.take_along_axis(scores, candidates, axis=1)
+            order = np.lexsort((candidates, -candidate_scores), axis=1)
+            results[start : start + len(scores)] = np.take_along_axis(candidates, order, axis=1)
+        return results
+
+
+def with_retrieved_paragraphs(examples, index, top_k, batch_size=256):
+    """
+    Returns `examples` (a `datasets.Dataset` with a `question` column) whose `paragraphs` column holds the `top_k`
+    paragraphs retrieved by `index`, in place of the given candidates if there are any.
+    """
+    paragraphs = index.search(examples["question"], top_k, batch_size=batch_size)
+    if "paragraphs" in examples.column_names:
+        examples = examples.remove_columns("paragraphs")
+    return examples.add_column("paragraphs", paragraphs.tolist())
+
+
+def retrieval_recall(paragraphs, relevant):
+    """Share of the questions whose `relevant` paragraph is among the retrieved `paragraphs`."""
+    if len(relevant) == 0:
+        return 0.0
+    return float(np.mean([answer in candidates for candidates, answer in zip(paragraphs, relevant)]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the BM25 index of the paragraphs of context.json")
+    parser.add_argument("--context_file", type=str, required=True, help="context.json")
+    parser.add_argument("--output_dir", type=str, required=True, help="Where to write the index.")
+    parser.add_argument("--max_ngram", type=int, default=2, help="Longest character n-grams indexed.")
+    parser.add_argument("--k1", type=float, default=1.2, help="Term frequency saturation of BM25.")
+    parser.add_argument("--b", type=float, default=0.75, help="Length normalization of BM25.")
+    args = parser.parse_args()
+
+    meta = build_bm25_index(args.context_file, args.output_dir, ngram_range=(1, args.max_ngram), k1=args.k1, b=args.b)
+    print(json.dumps(meta, indent=4))
+
+
+if __name__ == "__main__":
+    main()
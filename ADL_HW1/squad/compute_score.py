@@ -8,40 +8,82 @@ import sys
 from collections import Counter
 
 
-def normalize_answer(s):
+# A regex is much faster than `str.translate` on non-ASCII text.
+_PUNCTUATION = re.compile(f"[{re.escape(string.punctuation)}]")
+# Full-width punctuation of Chinese text, also removed with `cjk=True`.
+_CJK_PUNCTUATION = re.compile(f"[{re.escape(string.punctuation + '，。、；：？！「」『』（）《》〈〉【】〔〕—…·～＂＇')}]")
+_ARTICLES = re.compile(r"\b(a|an|the)\b")
+# Han, kana and hangul characters: with `cjk=True` each of them is a token of its own, and the other characters
+# form whitespace-separated tokens as usual.
+_CJK_RANGES = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af"
+_CJK_TOKEN = re.compile(f"[{_CJK_RANGES}]|[^\\s{_CJK_RANGES}]+")
+_NOT_CJK = re.compile(f"[^ {_CJK_RANGES}]")
+
+
+def normalize_answer(s, cjk=False):
     """Lower text and remove punctuation, articles and extra whitespace."""
+    s = (_CJK_PUNCTUATION if cjk else _PUNCTUATION).sub("", s.lower())
+    # Every article holds an "a" or a "the": Chinese answers skip the regex.
+    if "a" in s or "the" in s:
+        s = _ARTICLES.sub(" ", s)
+    return " ".join(s.split())
 
-    def remove_articles(text):
-        return re.sub(r"\b(a|an|the)\b", " ", text)
 
-    def white_space_fix(text):
-        return " ".join(text.split())
+def get_tokens(normalized_answer, cjk=False):
+    """Whitespace tokens of a normalized answer; with `cjk=True`, every CJK character is a token of its own."""
+    if cjk:
+        # Most Chinese answers hold nothing but CJK characters: they are split into characters without a regex.
+        if _NOT_CJK.search(normalized_answer) is None:
+            return list(normalized_answer.replace(" ", ""))
+        return _CJK_TOKEN.findall(normalized_answer)
+    return normalized_answer.split()
 
-    def remove_punc(text):
-        exclude = set(string.punctuation)
-        return "".join(ch for ch in text if ch not in exclude)
 
-    def lower(text):
-        return text.lower()
+def _count_tokens(tokens):
+    # Same as `Counter(tokens)` for the overlap of `_f1_from_counts`, several times faster on short answers.
+    counts = {}
+    for token in tokens:
+        counts[token] = counts.get(token, 0) + 1
+    return counts
 
-    return white_space_fix(remove_articles(remove_punc(lower(s))))
 
-
-def f1_score(prediction, ground_truth):
-    prediction_tokens = normalize_answer(prediction).split()
-    ground_truth_tokens = normalize_answer(ground_truth).split()
-    common = Counter(prediction_tokens) & Counter(ground_truth_tokens)
-    num_same = sum(common.values())
+def _f1_from_overlap(num_same, prediction_length, ground_truth_length):
     if num_same == 0:
         return 0
-    precision = 1.0 * num_same / len(prediction_tokens)
-    recall = 1.0 * num_same / len(ground_truth_tokens)
+    precision = 1.0 * num_same / prediction_length
+    recall = 1.0 * num_same / ground_truth_length
     f1 = (2 * precision * recall) / (precision + recall)
     return f1
 
 
-def exact_match_score(prediction, ground_truth):
-    return normalize_answer(prediction) == normalize_answer(ground_truth)
+def _f1_from_counts(prediction_counts, prediction_length, ground_truth_counts, ground_truth_length):
+    num_same = sum(
+        min(count, ground_truth_counts[token])
+        for token, count in prediction_counts.items()
+        if token in ground_truth_counts
+    )
+    return _f1_from_overlap(num_same, prediction_length, ground_truth_length)
+
+
+def _f1_from_characters(prediction, ground_truth):
+    # F1 of two strings whose tokens are their characters, without building any token counts.
+    num_same = 0
+    for char in set(prediction):
+        if char in ground_truth:
+            num_same += min(prediction.count(char), ground_truth.count(char))
+    return _f1_from_overlap(num_same, len(prediction), len(ground_truth))
+
+
+def f1_score(prediction, ground_truth, cjk=False):
+    prediction_tokens = get_tokens(normalize_answer(prediction, cjk), cjk)
+    ground_truth_tokens = get_tokens(normalize_answer(ground_truth, cjk), cjk)
+    return _f1_from_counts(
+        Counter(prediction_tokens), len(prediction_tokens), Counter(ground_truth_tokens), len(ground_truth_tokens)
+    )
+
+
+def exact_match_score(prediction, ground_truth, cjk=False):
+    return normalize_answer(prediction, cjk) == normalize_answer(ground_truth, cjk)
 
 
 def metric_max_over_ground_truths(metric_fn, prediction, ground_truths):
@@ -52,20 +94,69 @@ def metric_max_over_ground_truths(metric_fn, prediction, ground_truths):
     return max(scores_for_ground_truths)
 
 
-def compute_score(dataset, predictions):
+def compute_score_columns(predictions, ground_truths, cjk=False):
+    """
+    Columnar version of `compute_score`: `predictions[i]` is the predicted text of question i (None if unanswered)
+    and `ground_truths[i]` the list of its answer texts. Every distinct string is normalized once and tokenized (once)
+    only when it is compared with a different string: a prediction equal to an answer once normalized skips the token
+    overlap. With `cjk=True`, answers made only of CJK characters are compared character by character directly.
+    """
+    if len(predictions) != len(ground_truths):
+        raise ValueError(f"Got {len(predictions)} predictions for {len(ground_truths)} questions.")
+    normalized = {}
+    tokenized = {}
+
+    def normalize(text):
+        normalized_text = normalized.get(text)
+        if normalized_text is None:
+            normalized_text = normalized[text] = normalize_answer(text, cjk)
+        return normalized_text
+
+    def tokenize(normalized_text):
+        # The string without spaces when each of its characters is a token, else its token counts and length.
+        tokens = tokenized.get(normalized_text)
+        if tokens is None:
+            if cjk and _NOT_CJK.search(normalized_text) is None:
+                tokens = normalized_text.replace(" ", "")
+            else:
+                token_list = get_tokens(normalized_text, cjk)
+                tokens = (_count_tokens(token_list), len(token_list))
+            tokenized[normalized_text] = tokens
+        return tokens
+
+    def f1_of(prediction, answer):
+        prediction_tokens = tokenize(prediction)
+        answer_tokens = tokenize(answer)
+        if isinstance(prediction_tokens, str) and isinstance(answer_tokens, str):
+            return _f1_from_characters(prediction_tokens, answer_tokens)
+        if isinstance(prediction_tokens, str):
+            prediction_tokens = (_count_tokens(prediction_tokens), len(prediction_tokens))
+        if isinstance(answer_tokens, str):
+            answer_tokens = (_count_tokens(answer_tokens), len(answer_tokens))
+        return _f1_from_counts(*prediction_tokens, *answer_tokens)
+
     f1 = exact_match = total = 0
-    for article in dataset:
-        for paragraph in article["paragraphs"]:
-            for qa in paragraph["qas"]:
-                total += 1
-                if qa["id"] not in predictions:
-                    message = "Unanswered question " + qa["id"] + " will receive score 0."
-                    print(message, file=sys.stderr)
-                    continue
-                ground_truths = list(map(lambda x: x["text"], qa["answers"]))
-                prediction = predictions[qa["id"]]
-                exact_match += metric_max_over_ground_truths(exact_match_score, prediction, ground_truths)
-                f1 += metric_max_over_ground_truths(f1_score, prediction, ground_truths)
+    for prediction, answers in zip(predictions, ground_truths):
+        total += 1
+        if prediction is None:
+            continue
+        prediction = normalize(prediction)
+        question_exact_match = False
+        question_f1 = None
+        for answer in answers:
+            answer = normalize(answer)
+            if answer == prediction:
+                question_exact_match = True
+                # A non-empty normalized answer has at least one token.
+                answer_f1 = 1.0 if prediction else 0
+            else:
+                answer_f1 = f1_of(prediction, answer)
+            if question_f1 is None or answer_f1 > question_f1:
+                question_f1 = answer_f1
+        if question_f1 is None:
+            raise ValueError("A question has no ground truth answer.")
+        exact_match += question_exact_match
+        f1 += question_f1
 
     exact_match = 100.0 * exact_match / total
     f1 = 100.0 * f1 / total
@@ -73,11 +164,30 @@ def compute_score(dataset, predictions):
     return {"exact_match": exact_match, "f1": f1}
 
 
+def compute_score(dataset, predictions, cjk=False):
+    ids = []
+    ground_truths = []
+    for article in dataset:
+        for paragraph in article["paragraphs"]:
+            for qa in paragraph["qas"]:
+                ids.append(qa["id"])
+                ground_truths.append([answer["text"] for answer in qa["answers"]])
+    for qa_id in ids:
+        if qa_id not in predictions:
+            message = "Unanswered question " + qa_id + " will receive score 0."
+            print(message, file=sys.stderr)
+
+    return compute_score_columns([predictions.get(qa_id) for qa_id in ids], ground_truths, cjk=cjk)
+
+
 if __name__ == "__main__":
     expected_version = "1.1"
     parser = argparse.ArgumentParser(description="Evaluation for SQuAD " + expected_version)
     parser.add_argument("dataset_file", help="Dataset file")
     parser.add_argument("prediction_file", help="Prediction File")
+    parser.add_argument(
+        "--cjk", action="store_true", help="Score Chinese answers by character instead of by whitespace token."
+    )
     args = parser.parse_args()
     with open(args.dataset_file) as dataset_file:
         dataset_json = json.load(dataset_file)
@@ -89,4 +199,4 @@ if __name__ == "__main__":
         dataset = dataset_json["data"]
     with open(args.prediction_file) as prediction_file:
         predictions = json.load(prediction_file)
-    print(json.dumps(compute_score(dataset, predictions)))
+    print(json.dumps(compute_score(dataset, predictions, cjk=args.cjk)))
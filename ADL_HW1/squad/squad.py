@@ -13,11 +13,13 @@
 # limitations under the License.
 """ SQuAD metric. """
 
+import sys
+
 import datasets
 
 import evaluate
 
-from .compute_score import compute_score
+from .compute_score import compute_score_columns
 
 
 _CITATION = """\
@@ -51,6 +53,7 @@ Args:
                 'answer_start': list of start positions for the answer, as a list of ints
             }
             Note that answer_start values are not taken into account to compute the metric.
+    cjk: If True, the answers are compared by character for CJK text instead of by whitespace token.
 Returns:
     'exact_match': Exact match (the normalized answer exactly match the gold answer)
     'f1': The F-score of predicted tokens versus the gold answer
@@ -90,22 +93,15 @@ class Squad(evaluate.Metric):
             reference_urls=["https://rajpurkar.github.io/SQuAD-explorer/"],
         )
 
-    def _compute(self, predictions, references):
+    def _compute(self, predictions, references, cjk=False):
         pred_dict = {prediction["id"]: prediction["prediction_text"] for prediction in predictions}
-        dataset = [
-            {
-                "paragraphs": [
-                    {
-                        "qas": [
-                            {
-                                "answers": [{"text": answer_text} for answer_text in ref["answers"]["text"]],
-                                "id": ref["id"],
-                            }
-                            for ref in references
-                        ]
-                    }
-                ]
-            }
-        ]
-        score = compute_score(dataset=dataset, predictions=pred_dict)
+        for ref in references:
+            if ref["id"] not in pred_dict:
+                message = "Unanswered question " + ref["id"] + " will receive score 0."
+                print(message, file=sys.stderr)
+        score = compute_score_columns(
+            predictions=[pred_dict.get(ref["id"]) for ref in references],
+            ground_truths=[ref["answers"]["text"] for ref in references],
+            cjk=cjk,
+        )
         return score
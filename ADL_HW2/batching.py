@@ -0,0 +1,93 @@
+# coding=utf-8
+"""
+Batch sampler for the generation dataloader.
+
+With dynamic padding every batch is padded to its longest article, so batching the articles in file order spends a
+lot of the compute on pad tokens. `LengthGroupedBatchSampler` sorts the tokenized articles by length and packs them in
+batches of at most `max_tokens` padded source tokens, so short articles go in large batches and long ones in small
+batches. The summaries are put back in file order with the `example_index` column of the features.
+"""
+
+import numpy as np
+from torch.utils.data import Sampler
+
+
+def feature_lengths(features):
+    """
+    The number of source tokens of each feature of a tokenized dataset, read from the offsets of the Arrow
+    `input_ids` column so that the token ids are never loaded.
+    """
+    # A slice of the table without an indices mapping, else only the `input_ids` column is gathered (in Arrow).
+    input_ids = features.with_format("arrow", columns=["input_ids"])[:]["input_ids"]
+    lengths = [np.diff(np.asarray(chunk.offsets, dtype=np.int64)) for chunk in input_ids.chunks]
+    return np.concatenate(lengths) if lengths else np.zeros(0, dtype=np.int64)
+
+
+def padded_size(batch_size, max_length, pad_to_multiple_of=None):
+    """Number of input positions (real and pad tokens) of a batch once the collator has padded it."""
+    if pad_to_multiple_of is not None and max_length % pad_to_multiple_of != 0:
+        max_length = (max_length // pad_to_multiple_of + 1) * pad_to_multiple_of
+    return batch_size * max_length
+
+
+class LengthGroupedBatchSampler(Sampler):
+    """
+    Batch sampler yielding batches of articles of similar lengths, longest first (so that running out of memory
+    happens on the first batch).
+
+    Args:
+        lengths (:obj:`np.ndarray`):
+            The number of source tokens of each feature (see `feature_lengths`).
+        max_tokens (:obj:`int`):
+            Every batch takes as many features as fit in `max_tokens` input positions once padded (pad tokens
+            included). A feature longer than the budget gets a batch of its own.
+        pad_to_multiple_of (:obj:`int`, `optional`):
+            The `pad_to_multiple_of` of the data collator.
+    """
+
+    def __init__(self, lengths, max_tokens, pad_to_multiple_of=None):
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.max_tokens = max_tokens
+        self.pad_to_multiple_of = pad_to_multiple_of
+        # The stable sort keeps the file order among equal lengths.
+        self.order = np.argsort(-self.lengths, kind="stable")
+        self.batches = self._cut_batches(self.order)
+
+    def _cut_batches(self, indices):
+        batches = []
+        batch = []
+        max_length = 0
+        for index in indices.tolist():
+            length = max(max_length, int(self.lengths[index]))
+            if batch and padded_size(len(batch) + 1, length, self.pad_to_multiple_of) > self.max_tokens:
+                batches.append(batch)
+                batch = []
+                length = int(self.lengths[index])
+            batch.append(index)
+            max_length = length
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def __iter__(self):
+        yield from self.batches
+
+    def __len__(self):
+        return len(self.batches)
+
+    def _padded_size(self, batch):
+        return padded_size(len(batch), int(np.max(self.lengths[batch])), self.pad_to_multiple_of)
+
+    def summary(self):
+        """
+        One-line comparison of the padding of these batches with the one of batches cut the same way in file order,
+        for the logs.
+        """
+        num_tokens = int(np.sum(self.lengths))
+        in_order = sum(self._padded_size(batch) for batch in self._cut_batches(np.arange(len(self.lengths))))
+        grouped = sum(self._padded_size(batch) for batch in self.batches)
+        ratio = (in_order - grouped) / in_order if in_order > 0 else 0.0
+        return (
+            f"Length-grouped batches: {len(self.batches)} batches, {grouped - num_tokens} padding tokens instead "
+            f"of {in_order - num_tokens}, {in_order - grouped} input positions saved ({ratio:.1%})."
+        )
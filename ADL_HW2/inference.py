@@ -55,6 +55,8 @@ from transformers import (
 from transformers.utils import check_min_version, is_offline_mode, send_example_telemetry
 from transformers.utils.versions import require_version
 
+from batching import LengthGroupedBatchSampler, feature_lengths
+
 
 # Will error if the minimal version of Transformers is not installed. Remove at your own risks.
 # check_min_version("4.35.0.dev0")
@@ -176,6 +178,45 @@ def parse_args():
         action="store_true",
         help="If passed, pad all samples to `max_length`. Otherwise, dynamic padding is used.",
     )
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        help=(
+            "If passed, the validation file is read and tokenized as a stream while generating, instead of being "
+            "converted to an Arrow cache first."
+        ),
+    )
+    parser.add_argument(
+        "--pipeline",
+        action="store_true",
+        help=(
+            "If passed, the articles are tokenized batch by batch when the dataloader reads them (in its worker "
+            "processes with `--dataloader_num_workers`), while the model generates, instead of all before the first "
+            "batch."
+        ),
+    )
+    parser.add_argument(
+        "--dataloader_num_workers",
+        type=int,
+        default=0,
+        help="Number of worker processes preparing the batches of the dataloader (0 for the main process).",
+    )
+    parser.add_argument(
+        "--dataloader_prefetch_factor",
+        type=int,
+        default=2,
+        help="Number of batches prepared in advance by each dataloader worker.",
+    )
+    parser.add_argument(
+        "--max_tokens_per_batch",
+        type=int,
+        default=None,
+        help=(
+            "If passed, the articles are sorted by length and packed in batches of at most this many padded source "
+            "tokens, instead of batches of `per_device_eval_batch_size` articles. The summaries are written in the "
+            "order of the input file either way."
+        ),
+    )
     parser.add_argument(
         "--model_name_or_path",
         type=str,
@@ -323,38 +364,20 @@ def parse_args():
         if args.train_file is not None:
             extension = args.train_file.split(".")[-1]
             assert extension in ["csv", "json", "jsonl"], "`train_file` should be a csv or a json file."
-            if extension == "jsonl":
-              json_objects = []
-              with open(args.train_file, 'r') as jsonl_file:
-                for line in jsonl_file:
-                    # Parse each line as a JSON object and append it to the list
-                    json_objects.append(json.loads(line))
-              # print(json_objects)
-
-              args.train_file = args.train_file.replace(".jsonl", ".json")
-              args.train_file = args.train_file
-              train_file = ''
-
-              with open(args.train_file, 'w') as json_file:
-                json.dump(json_objects, json_file, indent=4)
-
         if args.validation_file is not None:
             extension = args.validation_file.split(".")[-1]
             assert extension in ["csv", "json", "jsonl"], "`validation_file` should be a csv or a json file."
-            if extension == "jsonl":
-              json_objects = []
-              with open(args.validation_file, 'r') as jsonl_file:
-                for line in jsonl_file:
-                    # Parse each line as a JSON object and append it to the list
-                    json_objects.append(json.loads(line))
-
-              args.validation_file = "tmp.json"
-            #   args.validation_file = 'json/' + args.validation_file
-
-              with open(args.validation_file, 'w') as json_file:
-                json.dump(json_objects, json_file, indent=4)
-
 
+    if args.streaming and args.max_tokens_per_batch is not None:
+        raise ValueError(
+            "`--max_tokens_per_batch` needs the lengths of all the articles and cannot be used with `--streaming`."
+        )
+    if args.pipeline and args.max_tokens_per_batch is not None:
+        raise ValueError(
+            "`--max_tokens_per_batch` needs the lengths of all the articles and cannot be used with `--pipeline`."
+        )
+    if args.pipeline and args.streaming:
+        raise ValueError("`--streaming` already tokenizes the articles while generating, do not pass `--pipeline`.")
 
     if args.push_to_hub:
         assert args.output_dir is not None, "Need an `output_dir` to create a repo when `--push_to_hub` is passed."
@@ -449,7 +472,10 @@ def main():
         if args.validation_file is not None:
             data_files["validation"] = args.validation_file
         extension = args.validation_file.split(".")[-1]
-        raw_datasets = load_dataset(extension, data_files=data_files)
+        if extension == "jsonl":
+            # JSON Lines files are read directly by the json loading script.
+            extension = "json"
+        raw_datasets = load_dataset(extension, data_files=data_files, streaming=args.streaming)
     # See more about loading any type of standard or custom dataset (from files, python dict, pandas DataFrame, etc) at
     # https://huggingface.co/docs/datasets/loading_datasets.html.
 
@@ -502,7 +528,11 @@ def main():
 
     # Preprocessing the datasets.
     # First we tokenize all the texts.
-    column_names = raw_datasets["validation"].column_names
+    if args.streaming:
+        # The columns of a streamed json file are only known once its first row is read.
+        column_names = list(next(iter(raw_datasets["validation"])).keys())
+    else:
+        column_names = raw_datasets["validation"].column_names
 
     # Get the column names for input/target.
     # dataset_columns = summarization_name_mapping.get(args.dataset_name, None)
@@ -530,7 +560,7 @@ def main():
     max_target_length = args.max_target_length
     padding = "max_length" if args.pad_to_max_length else False
 
-    def preprocess_function(examples):
+    def preprocess_function(examples, indices):
         inputs = examples["maintext"]
         # targets = examples["title"]
         # print("-------id-------")
@@ -550,8 +580,10 @@ def main():
 
         # print("-------inputs_id-------")
         # print(model_inputs["input_ids"][0])
-        input_length = len(model_inputs["input_ids"][0])
-        model_inputs["id"] = [[int(i) for j in range(input_length)] for i in examples["id"]]
+        # One id per row, plus the position of the article in the input file: the batches can come in any order (length
+        # grouping, several processes), the gathered positions put the titles back in the order of the file.
+        model_inputs["id"] = [int(i) for i in examples["id"]]
+        model_inputs["example_index"] = indices
 
         # model_inputs["labels"] = labels["input_ids"]
         # len = len(model_inputs["input_ids"])
@@ -570,14 +602,35 @@ def main():
 
         # Temporarily set max_target_length for validation.
         max_target_length = args.val_max_target_length
-        eval_dataset = raw_datasets["validation"].map(
-            preprocess_function,
-            batched=True,
-            num_proc=args.preprocessing_num_workers,
-            remove_columns=column_names,
-            load_from_cache_file=not args.overwrite_cache,
-            desc="Running tokenizer on dataset",
-        )
+        if args.streaming:
+            # Articles are read and tokenized lazily, batch by batch, as the dataloader asks for them. A streamed map
+            # removes the columns after the function ran, so "id" (which it rewrites) must be kept.
+            eval_dataset = raw_datasets["validation"].map(
+                preprocess_function,
+                batched=True,
+                with_indices=True,
+                remove_columns=[name for name in column_names if name != "id"],
+            )
+        elif args.pipeline:
+            # Articles are tokenized when the dataloader reads them, a batch at a time (in its workers, if any), so the
+            # tokenization of the next batches overlaps the generation of the current one.
+            validation_examples = raw_datasets["validation"]
+            eval_dataset = validation_examples.add_column(
+                "example_index", list(range(len(validation_examples)))
+            ).with_transform(
+                lambda examples: preprocess_function(examples, examples["example_index"]),
+                columns=["maintext", "id", "example_index"],
+            )
+        else:
+            eval_dataset = raw_datasets["validation"].map(
+                preprocess_function,
+                batched=True,
+                with_indices=True,
+                num_proc=args.preprocessing_num_workers,
+                remove_columns=column_names,
+                load_from_cache_file=not args.overwrite_cache,
+                desc="Running tokenizer on dataset",
+            )
 
     # Log a few random samples from the training set:
     # for index in random.sample(range(len(train_dataset)), 1):
@@ -604,7 +657,33 @@ def main():
     # train_dataloader = DataLoader(
     #     train_dataset, shuffle=True, collate_fn=data_collator, batch_size=args.per_device_train_batch_size
     # )
-    eval_dataloader = DataLoader(eval_dataset, collate_fn=data_collator, batch_size=args.per_device_eval_batch_size)
+    # The batches are collated (and, with `--pipeline` or `--streaming`, tokenized) in worker processes with
+    # `--dataloader_num_workers`, ahead of the generation.
+    dataloader_worker_kwargs = {"num_workers": args.dataloader_num_workers}
+    if args.dataloader_num_workers > 0:
+        dataloader_worker_kwargs["prefetch_factor"] = args.dataloader_prefetch_factor
+    eval_sampler = None
+    if args.max_tokens_per_batch is not None:
+        if accelerator.num_processes > 1:
+            raise ValueError(
+                "`--max_tokens_per_batch` gives batches of different sizes, which only works on a single process."
+            )
+        eval_sampler = LengthGroupedBatchSampler(
+            feature_lengths(eval_dataset),
+            pad_to_multiple_of=data_collator.pad_to_multiple_of,
+            max_tokens=args.max_tokens_per_batch,
+        )
+        logger.info(eval_sampler.summary())
+        eval_dataloader = DataLoader(
+            eval_dataset, collate_fn=data_collator, batch_sampler=eval_sampler, **dataloader_worker_kwargs
+        )
+    else:
+        eval_dataloader = DataLoader(
+            eval_dataset,
+            collate_fn=data_collator,
+            batch_size=args.per_device_eval_batch_size,
+            **dataloader_worker_kwargs,
+        )
 
     # Optimizer
     # Split weights in two groups, one with weight decay and the other not.
@@ -763,6 +842,7 @@ def main():
     preds_list = []
     labels_list = []
     id_list = []
+    index_list = []
 
     for step, batch in enumerate(eval_dataloader):
         with torch.no_grad():
@@ -775,10 +855,12 @@ def main():
             generated_tokens = accelerator.pad_across_processes(
                 generated_tokens, dim=1, pad_index=tokenizer.pad_token_id
             )
-            generated_tokens, id = accelerator.gather_for_metrics((generated_tokens, batch["id"]))
+            generated_tokens, id, example_index = accelerator.gather_for_metrics(
+                (generated_tokens, batch["id"], batch["example_index"])
+            )
             generated_tokens = generated_tokens.cpu().numpy()
             # labels = labels.cpu().numpy()
-            id_sublist = [str(i[0]) for i in batch["id"].cpu().numpy()]
+            id_sublist = [str(i) for i in id.cpu().numpy()]
             # id_sublist = id_sublist.cpu().numpy()
 
             # if args.ignore_pad_token_for_loss:
@@ -792,12 +874,17 @@ def main():
             decoded_preds = postprocess_text(decoded_preds)
             preds_list.append(decoded_preds)
             id_list.append(id_sublist)
+            index_list.append(example_index.cpu().numpy())
             # metric.add_batch(
             #     predictions=decoded_preds,
             # )
     # print(preds)
     preds_flt_list = [item for sublist in preds_list for item in sublist]
     id_flt_list = [item for sublist in id_list for item in sublist]
+    # Back to the order of the input file.
+    order = np.argsort(np.concatenate(index_list), kind="stable") if index_list else []
+    preds_flt_list = [preds_flt_list[i] for i in order]
+    id_flt_list = [id_flt_list[i] for i in order]
     # labels_flt_list = [item for sublist in labels_list for item in sublist]
     # print(preds_flt_list)
     # print(labels_flt_list)
@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+ROUGE scores of the generated titles, the way `get_rouge` of ADL_HW2.ipynb computes them (ckiptagger word
+segmentation, then `rouge.Rouge().get_scores`), without its cost on a whole evaluation set:
+
+- the segmentation of every text is kept in a JSONL cache keyed by the hash of the text, so the references are only
+  segmented once (and ckiptagger is not even loaded when everything is cached);
+- the pairs are scored in a process pool;
+- the n-gram overlaps and the longest common subsequences are computed on numpy arrays of word ids.
+
+The numbers are the ones of the `rouge` package (n-gram sets, summary-level ROUGE-L over the sentences split on
+"."), averaged in the same order.
+
+    python scoring.py --prediction_file output.jsonl --reference_file public.jsonl \
+        --ckip_data_dir ./ckiptagger/data --segmentation_cache ./segmentation.jsonl
+"""
+
+import argparse
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+
+METRICS = ["rouge-1", "rouge-2", "rouge-l"]
+STATS = ["r", "p", "f"]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Compute the ROUGE scores of generated titles")
+    parser.add_argument(
+        "--prediction_file", type=str, required=True, help="A jsonl file with the `id` and generated `title`."
+    )
+    parser.add_argument(
+        "--reference_file", type=str, required=True, help="A jsonl file with the `id` and reference `title`."
+    )
+    parser.add_argument("--ckip_data_dir", type=str, default=None, help="The data dir of ckiptagger (with model_ws).")
+    parser.add_argument(
+        "--segmentation_cache",
+        type=str,
+        default=None,
+        help="A jsonl file keeping the segmentation of the texts across runs. Created if it does not exist.",
+    )
+    parser.add_argument(
+        "--num_workers", type=int, default=os.cpu_count(), help="Number of processes scoring the pairs."
+    )
+    parser.add_argument(
+        "--ignore_empty", action="store_true", help="If passed, the pairs with an empty title are not scored."
+    )
+    parser.add_argument("--output_file", type=str, default=None, help="Where to write the scores, as json.")
+    return parser.parse_args()
+
+
+def text_hash(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+class CachedSegmenter:
+    """
+    Segments texts with ckiptagger `WS` and returns them with their words joined by spaces (`tokenize_and_join` of the
+    notebook). The segmentation of every text is kept by hash in memory and, with `cache_path`, appended to a JSONL
+    file of `{"hash", "text"}` lines read back by the next runs. `WS` is only loaded once a text is not in the cache.
+    """
+
+    def __init__(self, data_dir=None, cache_path=None, disable_cuda=True):
+        self.data_dir = data_dir
+        self.cache_path = cache_path
+        self.disable_cuda = disable_cuda
+        self.cache = {}
+        self.hits = 0
+        self.misses = 0
+        self._ws = None
+        if cache_path is not None and os.path.exists(cache_path):
+            with open(cache_path, "r", encoding="utf-8") as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A last line cut by an interrupted run.
+                        continue
+                    self.cache[entry["hash"]] = entry["text"]
+
+    @property
+    def ws(self):
+        if self._ws is None:
+            if self.data_dir is None:
+                raise ValueError("Some texts are not in the segmentation cache: need the ckiptagger data dir.")
+            try:
+                from ckiptagger import WS
+            except ImportError:
+                raise ImportError("Segmenting the texts needs ckiptagger: `pip install ckiptagger`.")
+            self._ws = WS(self.data_dir, disable_cuda=self.disable_cuda)
+        return self._ws
+
+    def __call__(self, texts):
+        hashes = [text_hash(text) for text in texts]
+        missing = {}
+        for key, text in zip(hashes, texts):
+            if key not in self.cache and key not in missing:
+                missing[key] = text
+        self.misses += len(missing)
+        self.hits += len(texts) - len(missing)
+        if missing:
+            segmented = [" ".join(tokens) for tokens in self.ws(list(missing.values()))]
+            new_entries = dict(zip(missing.keys(), segmented))
+            self.cache.update(new_entries)
+            if self.cache_path is not None:
+                with open(self.cache_path, "a", encoding="utf-8") as file:
+                    for key, text in new_entries.items():
+                        file.write(json.dumps({"hash": key, "text": text}, ensure_ascii=False) + "\n")
+        return [self.cache[key] for key in hashes]
+
+
+def _sentences(text):
+    return [" ".join(sentence.split()) for sentence in text.split(".") if len(sentence) > 0]
+
+
+def _word_ids(sentences, vocab):
+    return [np.array([vocab.setdefault(word, len(vocab)) for word in sentence.split(" ")]) for sentence in sentences]
+
+
+def _ngrams(ids, n, vocab_size):
+    """The distinct n-grams of `ids`, each encoded as one integer."""
+    if len(ids) < n:
+        return np.zeros(0, dtype=np.int64)
+    codes = ids[: len(ids) - n + 1].astype(np.int64)
+    for k in range(1, n):
+        codes = codes * vocab_size + ids[k : len(ids) - n + 1 + k]
+    return np.unique(codes)
+
+
+def _f_r_p(overlap, evaluated_count, reference_count):
+    precision = 0.0 if evaluated_count == 0 else overlap / evaluated_count
+    recall = 0.0 if reference_count == 0 else overlap / reference_count
+    f1_score = 2.0 * ((precision * recall) / (precision + recall + 1e-8))
+    return {"r": recall, "p": precision, "f": f1_score}
+
+
+def _lcs_words(x, y):
+    """
+    The words of x in the longest common subsequence of x and y, reconstructed as `rouge` does. The rows of the table
+    are computed at once: row i is the running maximum of `max(row[i - 1][j], row[i - 1][j - 1] + match)`.
+    """
+    table = np.zeros((len(x) + 1, len(y) + 1), dtype=np.int64)
+    match = x[:, None] == y[None, :]
+    for i in range(1, len(x) + 1):
+        previous = table[i - 1]
+        table[i, 1:] = np.maximum.accumulate(np.maximum(previous[1:], previous[:-1] + match[i - 1]))
+    words = []
+    i, j = len(x), len(y)
+    while i > 0 and j > 0:
+        if x[i - 1] == y[j - 1]:
+            words.append(x[i - 1])
+            i, j = i - 1, j - 1
+        elif table[i - 1, j] > table[i, j - 1]:
+            i -= 1
+        else:
+            j -= 1
+    return words
+
+
+def score_pair(hypothesis, reference):
+    """The rouge-1, rouge-2 and rouge-l `{"r", "p", "f"}` scores of a segmented hypothesis against its reference."""
+    hypothesis_sentences = _sentences(hypothesis)
+    reference_sentences = _sentences(reference)
+    if len(hypothesis_sentences) == 0:
+        raise ValueError("Hypothesis is empty.")
+    if len(reference_sentences) == 0:
+        raise ValueError("Reference is empty.")
+
+    vocab = {}
+    hypothesis_ids = _word_ids(hypothesis_sentences, vocab)
+    reference_ids = _word_ids(reference_sentences, vocab)
+    hypothesis_words = np.concatenate(hypothesis_ids)
+    reference_words = np.concatenate(reference_ids)
+
+    scores = {}
+    for n in (1, 2):
+        evaluated = _ngrams(hypothesis_words, n, len(vocab))
+        referenced = _ngrams(reference_words, n, len(vocab))
+        overlap = len(np.intersect1d(evaluated, referenced, assume_unique=True))
+        scores[f"rouge-{n}"] = _f_r_p(overlap, len(evaluated), len(referenced))
+
+    # Summary level: the union of the words of the LCS of every (reference, hypothesis) sentence pair.
+    lcs_union = set()
+    for reference_sentence in reference_ids:
+        for hypothesis_sentence in hypothesis_ids:
+            lcs_union.update(_lcs_words(reference_sentence, hypothesis_sentence))
+    llcs = len(lcs_union)
+    r_lcs = llcs / len(np.unique(reference_words))
+    p_lcs = llcs / len(np.unique(hypothesis_words))
+    scores["rouge-l"] = {"r": r_lcs, "p": p_lcs, "f": 2.0 * ((p_lcs * r_lcs) / (p_lcs + r_lcs + 1e-8))}
+    return scores
+
+
+def score_pairs(hypotheses, references, num_workers=1):
+    """The `score_pair` of every pair, in order, computed by `num_workers` processes."""
+    if num_workers is None or num_workers <= 1 or len(hypotheses) < 2 * num_workers:
+        return [score_pair(hypothesis, reference) for hypothesis, reference in zip(hypotheses, references)]
+    chunksize = max(1, len(hypotheses) // (4 * num_workers))
+    with ProcessPoolExecutor(num_workers) as executor:
+        return list(executor.map(score_pair, hypotheses, references, chunksize=chunksize))
+
+
+def get_rouge(preds, refs, avg=True, ignore_empty=False, segmenter=None, num_workers=1):
+    """
+    Drop-in for `get_rouge` of the notebook.
+
+    Args:
+        preds: string or list of strings
+        refs: string or list of strings
+        avg: bool, return the average metrics if set to True
+        ignore_empty: bool, ignore empty pairs if set to True
+        segmenter: a `CachedSegmenter`, or None if the texts are already segmented
+        num_workers: number of processes scoring the pairs
+    """
+    if not isinstance(preds, list):
+        preds = [preds]
+    if not isinstance(refs, list):
+        refs = [refs]
+    if len(preds) != len(refs):
+        raise ValueError(f"Got {len(preds)} predictions for {len(refs)} references.")
+    if segmenter is not None:
+        preds, refs = segmenter(preds), segmenter(refs)
+    if ignore_empty:
+        pairs = [(pred, ref) for pred, ref in zip(preds, refs) if len(pred) > 0 and len(ref) > 0]
+        preds, refs = [pred for pred, _ in pairs], [ref for _, ref in pairs]
+
+    scores = score_pairs(preds, refs, num_workers=num_workers)
+    if not avg:
+        return scores
+    # Summed in order, like `rouge`, so that the averages are the same floats.
+    totals = {metric: {stat: 0 for stat in STATS} for metric in METRICS}
+    for score in scores:
+        for metric in METRICS:
+            totals[metric] = {stat: totals[metric][stat] + score[metric][stat] for stat in STATS}
+    return {metric: {stat: totals[metric][stat] / len(scores) for stat in STATS} for metric in METRICS}
+
+
+def read_titles(path):
+    titles = {}
+    with open(path, "r", encoding="utf-8") as file:
+        for line in file:
+            if line.strip():
+                example = json.loads(line)
+                titles[str(example["id"])] = example["title"]
+    return titles
+
+
+def main():
+    args = parse_args()
+
+    predictions = read_titles(args.prediction_file)
+    references = read_titles(args.reference_file)
+    missing = [key for key in references if key not in predictions]
+    if missing:
+        raise ValueError(f"{len(missing)} references have no prediction, e.g. id {missing[0]}.")
+    keys = list(references.keys())
+
+    segmenter = CachedSegmenter(args.ckip_data_dir, args.segmentation_cache)
+    result = get_rouge(
+        [predictions[key] for key in keys],
+        [references[key] for key in keys],
+        ignore_empty=args.ignore_empty,
+        segmenter=segmenter,
+        num_workers=args.num_workers,
+    )
+    print(f"Segmentation cache: {segmenter.hits} hits, {segmenter.misses} texts segmented.")
+    print(json.dumps(result, indent=2))
+    if args.output_file is not None:
+        with open(args.output_file, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,8 +6,8 @@ from peft import PeftModel
 from peft.tuners.lora import LoraLayer
 import argparse
 import json
-from utils import get_prompt, get_bnb_config
-import bitsandbytes as bnb
+from utils import SYSTEM_PROMPT, OutputShardWriter, get_prompt, get_bnb_config
+from scheduler import ContinuousBatchingGenerator, PrefixCache, left_pad, to_model_cache
 # import accelerator
 
 # def get_last_checkpoint(checkpoint_dir):
@@ -52,7 +52,30 @@ if __name__ == "__main__":
         required=True,
         help="User question."
     )
-
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=1,
+        help="Number of questions generated together. The prompts are sorted by length and padded on the left."
+    )
+    parser.add_argument(
+        "--continuous_batching",
+        action="store_true",
+        help="If passed, a finished answer frees its slot for the next question right away, instead of waiting for "
+        "the whole batch. `--batch_size` is then the number of slots, and the answers are written as they finish."
+    )
+    parser.add_argument(
+        "--prefix_cache",
+        action="store_true",
+        help="If passed, the system preamble of the prompts is prefilled once and every batch starts from a copy of "
+        "its KV cache."
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="If passed, the answers already in the `<output_data_path>.partial.jsonl` shard of an interrupted run are "
+        "kept and only the missing ids are generated."
+    )
 
 
     args = parser.parse_args()
@@ -76,7 +99,7 @@ if __name__ == "__main__":
     max_new_tokens = 1024
     top_p = 0.5
     temperature=0.7
-    bnb_config = get_bnb_config()
+    bnb_config = get_bnb_config() if torch.cuda.is_available() else None
 
     # Base model
     model_name_or_path = args.base_model_path
@@ -94,15 +117,24 @@ if __name__ == "__main__":
     tokenizer = AutoTokenizer.from_pretrained(model_name_or_path)
     # Fixing some of the early LLaMA HF conversion issues.
     tokenizer.bos_token_id = 1
-
-    # Load the model (use bf16 for faster inference)
-    model = AutoModelForCausalLM.from_pretrained(
-        model_name_or_path,
-        torch_dtype=torch.bfloat16,
-        device_map={"": 0},
-        load_in_4bit=True,
-        quantization_config=bnb_config
-    )
+    # The prompts of a batch are padded on the left, so that all the answers start at the same position.
+    tokenizer.padding_side = "left"
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    if device == "cuda":
+        # Load the model (use bf16 for faster inference)
+        model = AutoModelForCausalLM.from_pretrained(
+            model_name_or_path,
+            torch_dtype=torch.bfloat16,
+            device_map={"": 0},
+            load_in_4bit=True,
+            quantization_config=bnb_config
+        )
+    else:
+        # bitsandbytes 4-bit quantization needs a GPU: on CPU (e.g. a tiny model for testing) the model runs in fp32.
+        model = AutoModelForCausalLM.from_pretrained(model_name_or_path, torch_dtype=torch.float32)
 
     if (adapter_path is not None):
         model = PeftModel.from_pretrained(model, adapter_path)
@@ -117,39 +149,79 @@ if __name__ == "__main__":
 
     # prompt = get_prompt()
 
-    def generate(model, user_question, max_new_tokens=max_new_tokens, top_p=top_p, temperature=temperature):
+    generation_config = GenerationConfig(
+        do_sample=True,
+        max_new_tokens=max_new_tokens,
+        top_p=top_p,
+        temperature=temperature,
+        pad_token_id=tokenizer.pad_token_id,
+    )
+
+    def generate(model, user_questions):
         # inputs = tokenizer(prompt.format(user_question=user_question), return_tensors="pt").to('cuda')
-        inputs = tokenizer(user_question, return_tensors="pt").to('cuda')
+        if prefix_cache is None:
+            inputs = tokenizer(user_questions, return_tensors="pt", padding=True).to(device)
+        else:
+            # Start from the cached preamble: only the rest of the prompts is prefilled.
+            suffixes = [prefix_cache.strip(input_ids) for input_ids in tokenizer(user_questions)["input_ids"]]
+            suffix_input_ids, suffix_attention_mask = left_pad(suffixes, tokenizer.pad_token_id)
+            input_ids, attention_mask, past_key_values = prefix_cache.prepend(
+                suffix_input_ids.to(device), suffix_attention_mask.to(device)
+            )
+            inputs = {
+                "input_ids": input_ids,
+                "attention_mask": attention_mask,
+                "past_key_values": to_model_cache(past_key_values),
+            }
 
         outputs = model.generate(
             **inputs,
-            generation_config=GenerationConfig(
-                do_sample=True,
-                max_new_tokens=max_new_tokens,
-                top_p=top_p,
-                temperature=temperature,
-            )
+            generation_config=generation_config
         )
 
-        text = tokenizer.decode(outputs[0], skip_special_tokens=True)
-        full_text = tokenizer.decode(outputs[0], skip_special_tokens=True)
-        trimmed_text = full_text.replace(user_question, "", 1).strip()  # Removes the first occurrence of the prompt
-        print(trimmed_text)
-        return trimmed_text
+        # Only decode the generated tokens: the (left-padded) prompts take the first input_length positions.
+        input_length = inputs["input_ids"].shape[1]
+        texts = tokenizer.batch_decode(outputs[:, input_length:], skip_special_tokens=True)
+        trimmed_texts = [text.strip() for text in texts]
+        for trimmed_text in trimmed_texts:
+            print(trimmed_text)
+        return trimmed_texts
         # return text
 
-    output = []
-
-    for i in range(len(data)):
-        user_question = get_prompt(data[i]['instruction'])
-        text = generate(model, user_question)
-        output.append({
-            'id': data[i]['id'],
-            'output': text
-        })
-
-
-    print (output)
-
-    with open(args.output_data_path, 'w') as outfile:
-        json.dump(output, outfile)
+    prompts = [get_prompt(data[i]['instruction']) for i in range(len(data))]
+    # Longest prompts first, so that the prompts of a batch have similar lengths and need little padding.
+    prompt_lengths = [len(input_ids) for input_ids in tokenizer(prompts)["input_ids"]]
+    schedule = sorted(range(len(data)), key=lambda i: prompt_lengths[i], reverse=True)
+
+    prefix_cache = None
+    if args.prefix_cache:
+        prefix_cache = PrefixCache.from_prompts(model, tokenizer, SYSTEM_PROMPT, tokenizer(prompts)["input_ids"])
+
+    # The answers are appended to a JSONL shard as they are generated, and merged into the output file at the end.
+    shard_path = args.output_data_path + ".partial.jsonl"
+    writer = OutputShardWriter(shard_path, resume=args.resume)
+    schedule = [i for i in schedule if data[i]['id'] not in writer.completed]
+    if args.resume:
+        print(f"Resuming from {shard_path}: {len(writer.completed)} answers done, {len(schedule)} to generate.")
+
+    if args.continuous_batching:
+        generator = ContinuousBatchingGenerator(
+            model, tokenizer, generation_config, num_slots=args.batch_size, prefix_cache=prefix_cache
+        )
+        for i, text in generator.generate(prompts, order=schedule):
+            print(text)
+            writer.write(data[i]['id'], text)
+
+    else:
+        for start in range(0, len(schedule), args.batch_size):
+            batch_indices = schedule[start:start + args.batch_size]
+            batch_texts = generate(model, [prompts[i] for i in batch_indices])
+            for i, text in zip(batch_indices, batch_texts):
+                writer.write(data[i]['id'], text)
+
+    writer.close()
+    writer.merge([data[i]['id'] for i in range(len(data))], args.output_data_path)
+    os.remove(shard_path)
+
+    if prefix_cache is not None:
+        print(prefix_cache.summary())
@@ -0,0 +1,293 @@
+import time
+from collections import deque
+
+import torch
+from transformers import LogitsProcessorList, TemperatureLogitsWarper, TopKLogitsWarper, TopPLogitsWarper
+
+try:
+    from transformers import DynamicCache
+except ImportError:  # transformers < 4.36 only knows the legacy tuple caches
+    DynamicCache = None
+
+
+def to_legacy_cache(past_key_values):
+    '''Returns the cache as a tuple of (key, value) tensors of shape (batch, heads, length, head_dim) per layer.'''
+    if hasattr(past_key_values, "to_legacy_cache"):
+        return past_key_values.to_legacy_cache()
+    return past_key_values
+
+
+def to_model_cache(legacy_cache):
+    '''Converts a legacy tuple cache back to the cache class the model expects.'''
+    if DynamicCache is not None:
+        return DynamicCache.from_legacy_cache(legacy_cache)
+    return legacy_cache
+
+
+def pad_cache_left(legacy_cache, length):
+    '''Left-pads the keys and values of every layer with zeros up to `length` positions.'''
+    padded = []
+    for key, value in legacy_cache:
+        missing = length - key.shape[2]
+        if missing > 0:
+            key = torch.cat([key.new_zeros(key.shape[:2] + (missing,) + key.shape[3:]), key], dim=2)
+            value = torch.cat([value.new_zeros(value.shape[:2] + (missing,) + value.shape[3:]), value], dim=2)
+        padded.append((key, value))
+    return tuple(padded)
+
+
+def left_pad(input_ids_list, pad_token_id):
+    '''Left-pads lists of token ids into `(input_ids, attention_mask)` tensors.'''
+    length = max(len(input_ids) for input_ids in input_ids_list)
+    input_ids = torch.full((len(input_ids_list), length), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(input_ids_list), length), dtype=torch.long)
+    for row, ids in enumerate(input_ids_list):
+        input_ids[row, length - len(ids):] = torch.tensor(ids, dtype=torch.long)
+        attention_mask[row, length - len(ids):] = 1
+    return input_ids, attention_mask
+
+
+class PrefixCache:
+    '''
+    KV cache of the token prefix all the prompts share (the system preamble of `get_prompt`), computed once.
+
+    Each batch then starts from a copy of it, laid out as `[prefix][left padding][rest of the prompt]`: the attention
+    mask skips the padding and the position ids continue after the prefix, so the model sees the same positions as
+    for the full prompt.
+
+    Use `from_prompts` to build it: the prefix is the longest run of tokens that the tokenized preamble and every
+    tokenized prompt start with, since the tokenizer may merge the last characters of the preamble with the text
+    that follows.
+    '''
+
+    def __init__(self, model, prefix_input_ids):
+        self.input_ids = list(prefix_input_ids)
+        self.num_reuses = 0
+        start = time.perf_counter()
+        with torch.no_grad():
+            outputs = model(input_ids=torch.tensor([self.input_ids], device=model.device), use_cache=True)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        self.prefill_seconds = time.perf_counter() - start
+        self.cache = to_legacy_cache(outputs.past_key_values)
+
+    @classmethod
+    def from_prompts(cls, model, tokenizer, prefix_text, prompts_input_ids):
+        '''Returns the cache of the tokens of `prefix_text` all the prompts start with, or `None` if there are none.'''
+        prefix_input_ids = tokenizer(prefix_text)["input_ids"]
+        length = len(prefix_input_ids)
+        for input_ids in prompts_input_ids:
+            # Keep at least one token of every prompt to compute the logits of the first answer token from.
+            length = min(length, len(input_ids) - 1)
+            while length > 0 and list(input_ids[:length]) != prefix_input_ids[:length]:
+                length -= 1
+        if length == 0:
+            return None
+        return cls(model, prefix_input_ids[:length])
+
+    def __len__(self):
+        return len(self.input_ids)
+
+    def strip(self, input_ids):
+        '''Removes the cached prefix from the token ids of a prompt.'''
+        if list(input_ids[:len(self)]) != self.input_ids:
+            raise ValueError("The prompt does not start with the cached prefix.")
+        return input_ids[len(self):]
+
+    def prepend(self, input_ids, attention_mask):
+        '''
+        Puts the prefix in front of left-padded prompt suffixes. Returns the full `(input_ids, attention_mask)` and
+        the cache of the prefix for the batch (the input ids of the prefix are only needed by `model.generate`).
+        '''
+        batch_size = input_ids.shape[0]
+        prefix_input_ids = torch.tensor([self.input_ids], dtype=input_ids.dtype).to(input_ids.device)
+        input_ids = torch.cat([prefix_input_ids.expand(batch_size, -1), input_ids], dim=1)
+        attention_mask = torch.cat([attention_mask.new_ones((batch_size, len(self))), attention_mask], dim=1)
+        self.num_reuses += batch_size
+        cache = tuple(
+            (key.expand(batch_size, -1, -1, -1), value.expand(batch_size, -1, -1, -1)) for key, value in self.cache
+        )
+        return input_ids, attention_mask, cache
+
+    def summary(self):
+        '''One-line report of the prefill work the cache saved.'''
+        saved_tokens = max(self.num_reuses - 1, 0) * len(self)
+        saved_seconds = max(self.num_reuses - 1, 0) * self.prefill_seconds
+        return (
+            f"Prefix cache: {len(self)} prefix tokens prefilled once in {self.prefill_seconds:.3f}s and reused by "
+            f"{self.num_reuses} prompts, {saved_tokens} prefill tokens skipped (about {saved_seconds:.1f}s of "
+            "single-prompt prefill saved)."
+        )
+
+
+class ContinuousBatchingGenerator:
+    '''
+    Iteration-level scheduler for sampling answers from a causal LM.
+
+    Up to `num_slots` sequences are decoded together, one token per step. As soon as a sequence ends (end of sentence
+    token or `max_new_tokens`), its slot is freed and the next prompt is prefilled into it, instead of waiting for the
+    longest sequence of a static batch. The running sequences share one left-padded KV cache, one row per slot:
+    admitting prompts pads the shorter of the running and the new caches on the left, finished rows are dropped, and
+    the columns that no running sequence attends to any more are trimmed.
+
+    Args:
+        model: The causal LM (a `PeftModel` works too).
+        tokenizer: Its tokenizer, used to encode the prompts and decode the answers.
+        generation_config (`GenerationConfig`): `max_new_tokens`, `do_sample`, `temperature`, `top_k`, `top_p` and
+            `eos_token_id` are used, with the same meaning as in `model.generate`.
+        num_slots (`int`): Maximum number of sequences decoded at the same time.
+        prefix_cache (`PrefixCache`, *optional*): If given, the prompts are prefilled from a copy of its cache.
+    '''
+
+    def __init__(self, model, tokenizer, generation_config, num_slots, prefix_cache=None):
+        self.model = model
+        self.prefix_cache = prefix_cache
+        self.tokenizer = tokenizer
+        self.generation_config = generation_config
+        self.num_slots = num_slots
+        self.device = model.device
+        eos_token_id = generation_config.eos_token_id
+        if eos_token_id is None:
+            eos_token_id = tokenizer.eos_token_id
+        self.eos_token_ids = set(eos_token_id if isinstance(eos_token_id, list) else [eos_token_id])
+        self.pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else 0
+
+        self.logits_warper = LogitsProcessorList()
+        if generation_config.do_sample:
+            # Same warpers, in the same order, as `model.generate` for sampling.
+            if generation_config.temperature is not None and generation_config.temperature != 1.0:
+                self.logits_warper.append(TemperatureLogitsWarper(generation_config.temperature))
+            if generation_config.top_k is not None and generation_config.top_k != 0:
+                self.logits_warper.append(TopKLogitsWarper(top_k=generation_config.top_k, min_tokens_to_keep=1))
+            if generation_config.top_p is not None and generation_config.top_p < 1.0:
+                self.logits_warper.append(TopPLogitsWarper(top_p=generation_config.top_p, min_tokens_to_keep=1))
+
+    def generate(self, prompts, order=None):
+        '''
+        Generates an answer for every prompt, admitting them in `order` (by default the order of `prompts`).
+
+        Yields `(index, text)` pairs as soon as each answer is complete, so in completion order.
+        '''
+        prompt_input_ids = self.tokenizer(prompts)["input_ids"]
+        if self.prefix_cache is not None:
+            prompt_input_ids = [self.prefix_cache.strip(input_ids) for input_ids in prompt_input_ids]
+        pending = deque(range(len(prompts)) if order is None else order)
+
+        # State of the running sequences, one row per occupied slot.
+        self.indices = []
+        self.generated = []
+        self.cache = None
+        self.attention_mask = None
+        self.positions = None
+        self.next_tokens = None
+
+        while pending or self.indices:
+            free_slots = self.num_slots - len(self.indices)
+            if free_slots > 0 and pending:
+                admitted = [pending.popleft() for _ in range(min(free_slots, len(pending)))]
+                yield from self._admit(admitted, [prompt_input_ids[i] for i in admitted])
+            if self.indices:
+                yield from self._step()
+
+    def _sample(self, input_ids, logits):
+        logits = self.logits_warper(input_ids, logits.float())
+        if self.generation_config.do_sample:
+            return torch.multinomial(torch.softmax(logits, dim=-1), num_samples=1).squeeze(1)
+        return torch.argmax(logits, dim=-1)
+
+    @torch.no_grad()
+    def _admit(self, indices, input_ids_list):
+        '''Prefills the new prompts together and adds them to the running batch.'''
+        input_ids, attention_mask = left_pad(input_ids_list, self.pad_token_id)
+        input_ids = input_ids.to(self.device)
+        attention_mask = attention_mask.to(self.device)
+        past_key_values = None
+        if self.prefix_cache is not None:
+            _, attention_mask, past_key_values = self.prefix_cache.prepend(input_ids, attention_mask)
+            past_key_values = to_model_cache(past_key_values)
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)[:, -input_ids.shape[1]:]
+        length = attention_mask.shape[1]
+
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=past_key_values,
+            use_cache=True,
+        )
+        cache = to_legacy_cache(outputs.past_key_values)
+        next_tokens = self._sample(input_ids, outputs.logits[:, -1, :])
+
+        if self.indices:
+            total_length = max(length, self.attention_mask.shape[1])
+            self.cache = tuple(
+                (torch.cat([old_key, new_key]), torch.cat([old_value, new_value]))
+                for (old_key, old_value), (new_key, new_value) in zip(
+                    pad_cache_left(self.cache, total_length), pad_cache_left(cache, total_length)
+                )
+            )
+            self.attention_mask = torch.cat(
+                [
+                    torch.nn.functional.pad(self.attention_mask, (total_length - self.attention_mask.shape[1], 0)),
+                    torch.nn.functional.pad(attention_mask, (total_length - length, 0)),
+                ]
+            )
+            self.positions = torch.cat([self.positions, attention_mask.sum(-1)])
+            self.next_tokens = torch.cat([self.next_tokens, next_tokens])
+        else:
+            self.cache = cache
+            self.attention_mask = attention_mask
+            self.positions = attention_mask.sum(-1)
+            self.next_tokens = next_tokens
+        self.indices.extend(indices)
+        self.generated.extend([token] for token in next_tokens.tolist())
+        yield from self._release_finished()
+
+    @torch.no_grad()
+    def _step(self):
+        '''Decodes one more token for every running sequence.'''
+        attention_mask = torch.nn.functional.pad(self.attention_mask, (0, 1), value=1)
+        input_ids = self.next_tokens[:, None]
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=self.positions[:, None],
+            past_key_values=to_model_cache(self.cache),
+            use_cache=True,
+        )
+        self.cache = to_legacy_cache(outputs.past_key_values)
+        self.attention_mask = attention_mask
+        self.positions = self.positions + 1
+        self.next_tokens = self._sample(input_ids, outputs.logits[:, -1, :])
+        for generated, token in zip(self.generated, self.next_tokens.tolist()):
+            generated.append(token)
+        yield from self._release_finished()
+
+    def _release_finished(self):
+        '''Yields the finished sequences and frees their slots.'''
+        finished = [
+            generated[-1] in self.eos_token_ids or len(generated) >= self.generation_config.max_new_tokens
+            for generated in self.generated
+        ]
+        if not any(finished):
+            return
+        for index, generated, done in zip(self.indices, self.generated, finished):
+            if done:
+                yield index, self.tokenizer.decode(generated, skip_special_tokens=True).strip()
+
+        keep = [row for row, done in enumerate(finished) if not done]
+        self.indices = [self.indices[row] for row in keep]
+        self.generated = [self.generated[row] for row in keep]
+        if not keep:
+            self.cache = self.attention_mask = self.positions = self.next_tokens = None
+            return
+        keep = torch.tensor(keep, device=self.device)
+        self.attention_mask = self.attention_mask[keep]
+        # Drop the leading columns that only belonged to the finished sequences.
+        first_column = int(self.attention_mask.any(dim=0).nonzero()[0])
+        self.attention_mask = self.attention_mask[:, first_column:]
+        self.cache = tuple(
+            (key[keep, :, first_column:], value[keep, :, first_column:]) for key, value in self.cache
+        )
+        self.positions = self.positions[keep]
+        self.next_tokens = self.next_tokens[keep]
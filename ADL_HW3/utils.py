@@ -1,9 +1,16 @@
+import json
+import os
+
 from transformers import BitsAndBytesConfig
 import torch
 
+# The system preamble every prompt starts with (see `PrefixCache` in scheduler.py).
+SYSTEM_PROMPT = "你是人工智慧助理，以下是用戶和人工智能助理之間的對話。你要對用戶的問題提供有用、安全、詳細和禮貌的回答。"
+
+
 def get_prompt(instruction: str) -> str:
     '''Format the instruction as a prompt for LLM.'''
-    return f"你是人工智慧助理，以下是用戶和人工智能助理之間的對話。你要對用戶的問題提供有用、安全、詳細和禮貌的回答。USER: {instruction} ASSISTANT:"
+    return f"{SYSTEM_PROMPT}USER: {instruction} ASSISTANT:"
 
 
 def get_bnb_config() -> BitsAndBytesConfig:
@@ -15,4 +22,51 @@ def get_bnb_config() -> BitsAndBytesConfig:
         bnb_4bit_compute_dtype=torch.float32,
         bnb_4bit_use_double_quant=True,
         bnb_4bit_quant_type='nf4',
-    )
\ No newline at end of file
+    )
+
+
+class OutputShardWriter:
+    '''
+    Append-only JSONL shard of the answers, one `{"id", "output"}` line per answer, flushed as soon as it is written,
+    so a crash only loses the answers being generated.
+
+    With `resume=True`, the answers of an existing shard are kept in `completed` (keyed by id) and new ones are
+    appended after them; a last line cut by the crash is dropped. Otherwise the shard is started over.
+    '''
+
+    def __init__(self, shard_path: str, resume: bool = False):
+        self.shard_path = shard_path
+        self.completed = {}
+        if resume and os.path.exists(shard_path):
+            with open(shard_path, "rb") as f:
+                content = f.read()
+            # Everything after the last newline is an incomplete line.
+            complete_length = content.rfind(b"\n") + 1
+            for line in content[:complete_length].decode("utf-8").splitlines():
+                if line.strip():
+                    record = json.loads(line)
+                    self.completed[record["id"]] = record["output"]
+            with open(shard_path, "r+b") as f:
+                f.truncate(complete_length)
+            self.file = open(shard_path, "a", encoding="utf-8")
+        else:
+            self.file = open(shard_path, "w", encoding="utf-8")
+
+    def write(self, id: str, output: str):
+        '''Appends one answer and makes sure it reached the disk.'''
+        self.file.write(json.dumps({"id": id, "output": output}, ensure_ascii=False) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.completed[id] = output
+
+    def close(self):
+        self.file.close()
+
+    def merge(self, ids, output_path: str):
+        '''Writes the answers of `ids`, in that order, as a json dict keyed by id (the shape of prediction.json).'''
+        missing = [id for id in ids if id not in self.completed]
+        if missing:
+            raise ValueError(f"{len(missing)} ids have no answer in {self.shard_path}, e.g. {missing[0]}.")
+        predictions = {id: {"id": id, "output": self.completed[id]} for id in ids}
+        with open(output_path, "w", encoding="utf-8") as f:
+            json.dump(predictions, f, ensure_ascii=False, indent=2)